@@ -2,10 +2,22 @@
 Imports done in init to navigate easily through the lib.
 '''
 
+from arao_secret import agent
+from arao_secret import aio
+from arao_secret import archive
+from arao_secret import auth
+from arao_secret import cache
 from arao_secret import conf
 from arao_secret import db
+from arao_secret import executor
 from arao_secret import helper
+from arao_secret import importer
+from arao_secret import indexer
+from arao_secret import keypool
+from arao_secret import keyring
 from arao_secret import manager
+from arao_secret import ratelimit
+from arao_secret import rekey
 
 
 ENCODING = 'UTF-8'
@@ -14,7 +26,8 @@ ENCODING = 'UTF-8'
 # During user session, we need its master password to decrypt his linked secrets
 # Keep in mind that this is just offuscation, if a system user can dump memory,
 # he won't see the clear password, but still can decrypt it identifing where this credentials are
-# Note: We can't use multiple workers in uwsgi, because we would create multiple keys ???
+# Note: This key is by process, to use multiple workers in uwsgi, run the key agent
+#       (see arao_secret.agent), it owns a key shared by all workers
 APP_KEY = {
     'aes_iv': helper.aes_iv_gen(),
     'aes_key': helper.aes_key_gen(),
@@ -0,0 +1,340 @@
+'''
+Key agent, local daemon owning the session key and credentials of all web workers.
+
+Session key is generated per process (see arao_secret.APP_KEY), so credentials
+offuscated by a web worker can't be read by the others. When [Agent] socket is
+configured, helper.encrypt_for_session() and helper.decrypt_from_session() are done
+by the agent instead, and logged users credentials are kept by it under random handles,
+so any worker of the host can serve any user.
+
+Protocol over Unix socket, binary frames, request and response:
+
+    request:  operation (1 byte), payload length (4 bytes), payload
+    response: status (1 byte), payload length (4 bytes), payload
+
+Usage example:
+
+    python3 -m arao_secret.agent    # Socket from [Agent] section
+
+'''
+
+import argparse
+import logging
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+import SecureString
+
+from Crypto.Cipher import AES
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Operations
+OP_ENCRYPT = 1
+OP_DECRYPT = 2
+OP_PUT = 3
+OP_GET = 4
+OP_DEL = 5
+OP_HAS = 6
+
+# Response status
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_NOT_FOUND = 2
+
+FRAME = struct.Struct('>BI')
+MAX_PAYLOAD = 1 << 16
+HANDLE_SIZE = 16
+
+# Process client, see get_client()
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+class AgentError(Exception):
+    '''
+    Key agent unreachable or request failed.
+    '''
+
+
+def _read(sock, size):
+    '''
+    Read exactly size bytes from socket, None if closed before any byte.
+    '''
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ConnectionError('Truncated frame !')
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+def _read_frame(sock):
+    '''
+    Get code and payload of next frame, None if connection closed.
+    '''
+    header = _read(sock, FRAME.size)
+    if header is None:
+        return None
+    code, length = FRAME.unpack(header)
+    if length > MAX_PAYLOAD:
+        raise ConnectionError('Frame too long !')
+    payload = _read(sock, length) if length else b''
+    if payload is None:
+        raise ConnectionError('Truncated frame !')
+    return code, payload
+
+
+class KeyAgent:
+    '''
+    Session key and credentials store, the agent state.
+    '''
+    def __init__(self, credentials_size=10000, credentials_ttl=None):
+        self._key = arao_secret.helper.aes_key_gen()
+        self._iv = arao_secret.helper.aes_iv_gen()
+        # Credentials by handle, encrypted by session key
+        self.credentials = arao_secret.cache.LRUCache(credentials_size, ttl=credentials_ttl,
+                                                      on_evict=SecureString.clearmem)
+
+    def decrypt(self, data_enc):
+        '''
+        Decrypt by session key.
+        '''
+        if not data_enc or len(data_enc) % AES.block_size:
+            raise ValueError('Invalid encrypted data length !')
+        return AES.new(self._key, AES.MODE_CBC, self._iv).decrypt(data_enc)
+
+    def encrypt(self, data):
+        '''
+        Encrypt by session key.
+        Note: Given data is cleaned from memory.
+        '''
+        data_fill = arao_secret.helper.fill_out_to_mod_16(data)
+        data_enc = AES.new(self._key, AES.MODE_CBC, self._iv).encrypt(data_fill)
+        SecureString.clearmem(data_fill)
+        return data_enc
+
+    def handle(self, operation, payload):
+        '''
+        Run operation, get response status and payload.
+        '''
+        if operation == OP_ENCRYPT:
+            return STATUS_OK, self.encrypt(payload)
+        if operation == OP_DECRYPT:
+            return STATUS_OK, self.decrypt(payload)
+        if operation == OP_PUT:
+            handle = os.urandom(HANDLE_SIZE)
+            self.credentials.set(handle, self.encrypt(payload))
+            return STATUS_OK, handle
+        if operation == OP_GET:
+            # Evicted credentials are cleaned, so they are decrypted before they can leave
+            data = self.credentials.apply(payload, self.decrypt)
+            if data is None:
+                return STATUS_NOT_FOUND, b''
+            return STATUS_OK, data
+        if operation == OP_DEL:
+            self.credentials.pop(payload)
+            return STATUS_OK, b''
+        if operation == OP_HAS:
+            # Credentials are not decrypted, their use is updated as by OP_GET
+            if self.credentials.get(payload) is None:
+                return STATUS_NOT_FOUND, b''
+            return STATUS_OK, b''
+        raise ValueError('Unknown operation {} !'.format(operation))
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    '''
+    Client connection, requests are served until it's closed.
+    '''
+    def handle(self):
+        while True:
+            try:
+                frame = _read_frame(self.request)
+            except (ConnectionError, OSError) as error:
+                LOGGER.warning('Key agent connection dropped: %s', error)
+                return
+            if frame is None:
+                return
+            try:
+                status, payload = self.server.agent.handle(*frame)
+            except ValueError as error:
+                status, payload = STATUS_ERROR, str(error).encode(arao_secret.ENCODING)
+            self.request.sendall(FRAME.pack(status, len(payload)) + payload)
+            # Memory clean, single bytes are shared by the interpreter
+            if len(frame[1]) > 1:
+                SecureString.clearmem(frame[1])
+            # Handles of new credentials are the keys of credentials cache
+            if status == STATUS_OK and frame[0] != OP_PUT and len(payload) > 1:
+                SecureString.clearmem(payload)
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Key agent Unix socket server, only the owner user can connect.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, agent):
+        self.agent = agent
+        if os.path.exists(path):
+            os.unlink(path)
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(umask)
+
+
+class AgentClient:
+    '''
+    Key agent client, one persistent connection by thread.
+    '''
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        '''
+        Get connection of current thread.
+        '''
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        '''
+        Close connection of current thread.
+        '''
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def call(self, operation, payload):
+        '''
+        Send request to agent, get response payload.
+        Raises AgentError if agent is unreachable or request fails, KeyError if not found.
+        '''
+        request = FRAME.pack(operation, len(payload)) + payload
+        # Agent restarts drop connections, so try once again with a new one
+        for attempt in (1, 2):
+            try:
+                sock = self._connect()
+                sock.sendall(request)
+                frame = _read_frame(sock)
+                if frame is None:
+                    raise ConnectionError('Connection closed by key agent !')
+                break
+            except OSError as error:
+                self._close()
+                if attempt == 2:
+                    raise AgentError('Key agent unreachable: {}'.format(error))
+        # Memory clean
+        SecureString.clearmem(request)
+        status, response = frame
+        if status == STATUS_NOT_FOUND:
+            raise KeyError('Not found on key agent !')
+        if status != STATUS_OK:
+            raise AgentError(response.decode(arao_secret.ENCODING))
+        return response
+
+    def decrypt(self, data_enc):
+        '''
+        Decrypt by agent session key.
+        '''
+        return self.call(OP_DECRYPT, data_enc)
+
+    def delete(self, handle):
+        '''
+        Remove credentials from agent.
+        '''
+        self.call(OP_DEL, handle)
+
+    def encrypt(self, data):
+        '''
+        Encrypt by agent session key.
+        Note: Given data is cleaned from memory.
+        '''
+        data_enc = self.call(OP_ENCRYPT, data)
+        SecureString.clearmem(data)
+        return data_enc
+
+    def get(self, handle):
+        '''
+        Get credentials from agent, raises KeyError if they expired.
+        Note: After use them, clean them from memory.
+        '''
+        return self.call(OP_GET, handle)
+
+    def has(self, handle):
+        '''
+        Check if credentials are on agent, they are removed by logout of any process.
+        '''
+        try:
+            self.call(OP_HAS, handle)
+        except KeyError:
+            return False
+        return True
+
+    def put(self, data):
+        '''
+        Save credentials on agent, get their handle.
+        Note: Given data is cleaned from memory.
+        '''
+        handle = self.call(OP_PUT, data)
+        SecureString.clearmem(data)
+        return handle
+
+
+def get_client():
+    '''
+    Get process key agent client, None if [Agent] socket is not configured.
+    '''
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            path = arao_secret.conf.get('Agent', 'socket', fallback='')
+            if not path:
+                return None
+            _CLIENT = AgentClient(path, arao_secret.conf.get('Agent', 'timeout', int, fallback=5))
+        return _CLIENT
+
+
+def parse_arguments(argv):
+    '''
+    Arguments parser.
+    '''
+    parser = argparse.ArgumentParser(description='AraoSecret key agent')
+    parser.add_argument('--socket', type=str, help='Unix socket path, configured one by default.')
+    return parser.parse_args(argv[1:])
+
+
+if __name__ == '__main__':
+    ARGS = parse_arguments(sys.argv)
+    SOCKET = ARGS.socket or arao_secret.conf.get('Agent', 'socket')
+    SERVER = AgentServer(SOCKET, KeyAgent(
+        arao_secret.conf.get('Agent', 'credentials_size', int, fallback=10000),
+        arao_secret.conf.get('Agent', 'credentials_ttl', int, fallback=43200)
+    ))
+    LOGGER.info('Key agent listening on %s', SOCKET)
+    try:
+        SERVER.serve_forever()
+    finally:
+        SERVER.server_close()
+        os.unlink(SOCKET)
@@ -0,0 +1,466 @@
+'''
+Asyncio DataBase access and user manager.
+
+Interactive features of arao_secret.manager (groups, secrets, pages and search; batch jobs
+are not included, see AsyncUserManager), for ASGI front ends: DataBase I/O is awaited on an
+async SQLAlchemy engine, and CPU bound crypto runs in the loop executor (RSA work goes on
+to the crypto process pool if enabled, see arao_secret.executor), so idle connections
+don't hold a thread each.
+
+Needs SQLAlchemy >= 1.4 and an async driver: asyncpg, aiomysql or aiosqlite.
+
+Usage example:
+
+    import arao_secret
+
+    async def main():
+        db_session = arao_secret.aio.create_session()
+        manager = await arao_secret.aio.get_user(db_session, 'alias_test', 'pass_test')
+        for group_id, group_name in await manager.list_groups(db_session):
+            print(group_id, group_name)
+        await manager.logout()
+        await db_session.close()
+
+'''
+
+import asyncio
+import functools
+import logging
+import os
+import threading
+
+import SecureString
+import sqlalchemy
+
+try:
+    from sqlalchemy.ext import asyncio as sa_asyncio
+except ImportError:  # SQLAlchemy < 1.4
+    sa_asyncio = None
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Async drivers by DataBase URI scheme, see get_uri()
+DRIVERS = {
+    'mysql': 'mysql+aiomysql',
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+# Process ID and async engine by URI, see get_engine()
+_ENGINES = dict()
+_ENGINES_LOCK = threading.Lock()
+
+
+async def run(function, *args):
+    '''
+    Run blocking function in loop executor.
+    '''
+    return await asyncio.get_running_loop().run_in_executor(None,
+                                                            functools.partial(function, *args))
+
+
+def get_uri(uri=None):
+    '''
+    Get async DataBase URI, [DB] async_uri or configured URI with its async driver.
+    '''
+    uri = uri or arao_secret.conf.get('DB', 'async_uri', fallback=None)
+    if uri:
+        return uri
+    uri = arao_secret.conf.get('DB', 'URI')
+    scheme, rest = uri.split('://', 1)
+    driver = DRIVERS.get(scheme.split('+')[0])
+    if driver is None:
+        raise ValueError('No async driver for DataBase "{}" !'.format(scheme))
+    return '{}://{}'.format(driver, rest)
+
+
+def get_engine(uri=None):
+    '''
+    Get process async engine for given URI, configured one by default.
+    Pool is configured by [DB] section, as sync engine, see arao_secret.db.get_engine().
+    '''
+    if sa_asyncio is None:
+        raise RuntimeError('Asyncio DataBase access needs SQLAlchemy >= 1.4 !')
+    uri = get_uri(uri)
+    with _ENGINES_LOCK:
+        pid, engine = _ENGINES.get(uri, (None, None))
+        # Connections can't be shared with forked processes, async engines take no attributes
+        if engine is None or pid != os.getpid():
+            kwargs = dict()
+            if not uri.startswith('sqlite'):
+                kwargs['pool_size'] = arao_secret.conf.get('DB', 'pool_size', int, fallback=5)
+                kwargs['max_overflow'] = arao_secret.conf.get('DB', 'max_overflow', int,
+                                                              fallback=10)
+            engine = sa_asyncio.create_async_engine(
+                uri,
+                pool_pre_ping=arao_secret.conf.get('DB', 'pool_pre_ping', bool, fallback=True),
+                pool_recycle=arao_secret.conf.get('DB', 'pool_recycle', int, fallback=3600),
+                **kwargs
+            )
+            _ENGINES[uri] = (os.getpid(), engine)
+        return engine
+
+
+async def dispose_engine(uri=None):
+    '''
+    Close process async engine connections for given URI, configured one by default.
+    '''
+    with _ENGINES_LOCK:
+        _, engine = _ENGINES.pop(get_uri(uri), (None, None))
+    if engine is not None:
+        await engine.dispose()
+
+
+def create_session(autoflush=False, uri=None):
+    '''
+    Create a new async DataBase session.
+    Objects are not expired on commit, attributes can't be lazy loaded from async code.
+    '''
+    return sa_asyncio.AsyncSession(get_engine(uri), autoflush=autoflush, expire_on_commit=False)
+
+
+async def create_tables(db_session):
+    '''
+    Create tables into existent DataBase, upgrading schema of previous versions.
+    '''
+    await db_session.run_sync(arao_secret.db.create_tables)
+
+
+async def create_user(db_session, alias, email, password):
+    pass_bytes = arao_secret.helper.to_bytes(password)
+    SecureString.clearmem(password)
+    # RSA key generation and password hash are CPU bound
+    # Generated by crypto executor if pool is empty, see User.generate_key()
+    rsa_key = arao_secret.keypool.take()
+    user = await run(arao_secret.db.model.User, alias, email, pass_bytes, rsa_key)
+    db_session.add(user)
+    await db_session.commit()
+    # Password was just hashed, so it's not verified again, nor pooled keys imported again
+    return AsyncUserManager(await run(arao_secret.manager.UserManager, user, pass_bytes,
+                                      rsa_key))
+
+
+async def get_user(db_session, alias, password):
+    '''
+    Login user, password is verified by authentication pool.
+    Raises NoResultFound for wrong alias or password and LoginOverloaded if pool is full.
+    '''
+    pass_bytes = arao_secret.helper.to_bytes(password)
+    result = await db_session.execute(
+        sqlalchemy.select(arao_secret.db.model.User)
+        .where(arao_secret.db.model.User.alias == alias)
+    )
+    user = result.scalar_one_or_none()
+    pass_hash = user.pass_hash if user else arao_secret.auth.get_dummy_hash()
+    if not await run(arao_secret.auth.get_pool().verify, pass_bytes, pass_hash) or user is None:
+        SecureString.clearmem(pass_bytes)
+        raise sqlalchemy.orm.exc.NoResultFound('Wrong alias or password !')
+    hasher = arao_secret.auth.get_hasher()
+    if hasher.needs_update(user.pass_hash):
+        LOGGER.info('Updating password hash of user %i to %s', user.id, hasher.name)
+        user.pass_hash = await run(hasher.hash, pass_bytes)
+        await db_session.commit()
+    return AsyncUserManager(await run(arao_secret.manager.UserManager, user, pass_bytes))
+
+
+class AsyncUserManager:
+    '''
+    User manager for asyncio, see arao_secret.manager.UserManager.
+
+    Credentials are kept by the wrapped sync manager, relationships are loaded
+    by queries because they can't be lazy loaded. Crypto runs in executor threads, the
+    keyring is shared by them and guards its key and cached group keys with its lock.
+
+    Batch jobs (import, export, restore and re-encryption) use process pools and server side
+    cursors, so they are not available here: run them from their modules or with the sync
+    manager. Console output (show_secret) is not available either.
+    '''
+    def __init__(self, manager):
+        self.manager = manager
+        self.user = manager.user
+
+    async def _get_group_key(self, db_session, group_id):
+        '''
+        Get user group key with its group and user in a single query.
+        '''
+        result = await db_session.execute(
+            sqlalchemy.select(arao_secret.db.model.UserGroupKey)
+            .where(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
+            .where(arao_secret.db.model.UserGroupKey.group_id == group_id)
+            .options(sqlalchemy.orm.joinedload(arao_secret.db.model.UserGroupKey.group),
+                     sqlalchemy.orm.joinedload(arao_secret.db.model.UserGroupKey.user))
+        )
+        return result.scalar_one()
+
+    async def create_group(self, db_session, name, cipher=None):
+        group = arao_secret.db.model.Group(cipher)
+        db_session.add(group)
+        await db_session.flush()  # We need the Group ID to create UserGroupKey
+        group_name = arao_secret.helper.to_bytes(name)
+        group_key = arao_secret.helper.aes_key_gen()
+        user_group_key = await run(arao_secret.db.model.UserGroupKey, self.user, group,
+                                   group_name, group_key)
+        # Memory clean check
+        if not arao_secret.helper.cleaned(group_name):
+            raise RuntimeError('Group name NOT cleaned from memory !')
+        if not arao_secret.helper.cleaned(group_key):
+            raise RuntimeError('Group key NOT cleaned from memory !')
+        db_session.add(user_group_key)
+        await db_session.commit()
+        return group, user_group_key
+
+    async def create_secret(self, db_session, group_id, name, url, login, password, comment):
+        user_group_key = await self._get_group_key(db_session, group_id)
+        keyring = self.manager._get_keyring()
+
+        def encrypt(_):
+            return arao_secret.db.model.Secret(keyring, user_group_key,
+                                               name, url, login, password, comment)
+
+        try:
+            # Group key is unwrapped in executor and cached by keyring, so only AES runs in loop
+            SecureString.clearmem(await run(user_group_key.get_key, keyring,
+                                            user_group_key.get_write_version()))
+            # AES-GCM secrets are flushed on creation to get their ID, so it runs in session
+            secret = await db_session.run_sync(encrypt)
+            db_session.add(secret)
+            await db_session.commit()
+        except Exception:
+            # Flushed secret must not be committed later without its data
+            await db_session.rollback()
+            raise
+        finally:
+            # Clean sensitive data from memory
+            for string in (name, url, login, password, comment):
+                SecureString.clearmem(string)
+        return secret
+
+    async def get_clear_many(self, db_session, group_id, fields=('id', 'name'), after_id=None,
+                             limit=None):
+        '''
+        Decrypt given fields for group secrets, unwrapping group key once.
+        See UserManager.get_clear_many().
+        Note: After use them, call to clear() of every record.
+        '''
+        for field in fields:
+            if field not in arao_secret.manager.SecretRecord.__slots__:
+                raise ValueError('Unknown secret field "{}" !'.format(field))
+        group_key = await self._get_group_key(db_session, group_id)
+        LOGGER.info('User %i reading %s from group %i secrets',
+                    self.user.id, ', '.join(fields), group_id)
+        secret = arao_secret.db.model.Secret
+        # Only needed columns, legacy ones or packed data
+        columns = {'id', 'group_id', 'key_version', 'record_format', 'data'}.union(fields)
+        query = (sqlalchemy.select(*[getattr(secret, column) for column in sorted(columns)])
+                 .where(secret.group_id == group_id)
+                 .order_by(secret.id))
+        if after_id is not None:
+            query = query.where(secret.id > after_id)
+        if limit is not None:
+            query = query.limit(limit)
+        rows = (await db_session.execute(query)).all()
+
+        def decrypt():
+            keys = group_key.get_keys(self.manager._get_keyring())
+            records = list()
+            try:
+                for row in rows:
+                    records.append(arao_secret.manager.SecretRecord(
+                        **secret.decrypt_fields(group_key.group, keys, row, fields)
+                    ))
+            finally:
+                # Memory clean
+                for key in keys.values():
+                    SecureString.clearmem(key)
+            return records
+
+        return await run(decrypt)
+
+    async def list_secrets_page(self, db_session, group_id, cursor=None, limit=None,
+                                fields=('id', 'name')):
+        '''
+        Get a page of group secrets and the cursor for next page, None if it's the last one.
+        See UserManager.list_secrets_page().
+        Note: After use them, call to clear() of every record.
+        '''
+        limit = max(1, min(limit or arao_secret.manager.PAGE_SIZE,
+                           arao_secret.manager.PAGE_SIZE_MAX))
+        after_id = arao_secret.manager.decode_cursor(cursor) if cursor else None
+        fields = tuple(fields) if 'id' in fields else ('id', ) + tuple(fields)
+        # One more secret to know if there is a next page
+        records = await self.get_clear_many(db_session, group_id, fields=fields,
+                                            after_id=after_id, limit=limit + 1)
+        next_cursor = None
+        if len(records) > limit:
+            records.pop().clear()
+            next_cursor = arao_secret.manager.encode_cursor(records[-1].id)
+        return records, next_cursor
+
+    async def get_secret(self, db_session, secret_id):
+        '''
+        Get secret record with all fields.
+        Note: After use it, call to its clear()
+        '''
+        secret = arao_secret.db.model.Secret
+        group_key = arao_secret.db.model.UserGroupKey
+        fields = ('id', 'group_id') + secret.FIELDS
+        # Secret with its group key and group in a single query
+        result = await db_session.execute(
+            sqlalchemy.select(secret, group_key)
+            .join(group_key, group_key.group_id == secret.group_id)
+            .where(secret.id == secret_id)
+            .where(group_key.user_id == self.user.id)
+            .options(sqlalchemy.orm.joinedload(group_key.group))
+        )
+        row, user_group_key = result.one()
+        LOGGER.info('User %i reading all from secret %i', self.user.id, secret_id)
+
+        def decrypt():
+            keys = user_group_key.get_keys(self.manager._get_keyring())
+            try:
+                return arao_secret.manager.SecretRecord(
+                    **secret.decrypt_fields(user_group_key.group, keys, row, fields)
+                )
+            finally:
+                # Memory clean
+                for key in keys.values():
+                    SecureString.clearmem(key)
+
+        return await run(decrypt)
+
+    async def search_secrets(self, db_session, text, fields=('id', 'group_id', 'name')):
+        '''
+        Search secrets with all words of text in their name or URL, in all user groups.
+        See UserManager.search_secrets().
+        Note: After use them, call to clear() of every record.
+        '''
+        for field in fields:
+            if field not in arao_secret.manager.SecretRecord.__slots__:
+                raise ValueError('Unknown secret field "{}" !'.format(field))
+        words = arao_secret.helper.normalize_words(text)
+        if not words:
+            return list()
+        secret = arao_secret.db.model.Secret
+        token = arao_secret.db.model.SecretToken
+        result = await db_session.execute(
+            sqlalchemy.select(arao_secret.db.model.UserGroupKey)
+            .where(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
+            .options(sqlalchemy.orm.joinedload(arao_secret.db.model.UserGroupKey.group))
+        )
+        group_keys = result.scalars().all()
+        if not group_keys:
+            return list()
+        groups = {group_key.group_id: group_key.group for group_key in group_keys}
+
+        def get_keys():
+            keyring = self.manager._get_keyring()
+            return {group_key.group_id: group_key.get_keys(keyring) for group_key in group_keys}
+
+        # Keys by group and version, every version is searched while group is re-encrypted
+        keys = await run(get_keys)
+        try:
+            conditions = [sqlalchemy.and_(token.group_id == group_id,
+                                          token.token.in_(set().union(*[
+                                              secret.index_tokens(key, words)
+                                              for key in versions.values()
+                                          ])))
+                          for group_id, versions in keys.items()]
+            matches = (sqlalchemy.select(token.secret_id)
+                       .where(sqlalchemy.or_(*conditions))
+                       .group_by(token.secret_id)
+                       .having(sqlalchemy.func.count(sqlalchemy.distinct(token.token))
+                               == len(words)))
+            # Only needed columns, legacy ones or packed data
+            columns = {'id', 'group_id', 'key_version', 'record_format', 'data'}.union(fields)
+            rows = (await db_session.execute(
+                sqlalchemy.select(*[getattr(secret, column) for column in sorted(columns)])
+                .where(secret.id.in_(matches))
+                .order_by(secret.group_id, secret.id)
+            )).all()
+
+            def decrypt():
+                records = list()
+                for row in rows:
+                    LOGGER.info('User %i reading %s from secret %i found by search',
+                                self.user.id, ', '.join(fields), row.id)
+                    records.append(arao_secret.manager.SecretRecord(**secret.decrypt_fields(
+                        groups[row.group_id], keys[row.group_id], row, fields
+                    )))
+                return records
+
+            return await run(decrypt)
+        finally:
+            # Memory clean
+            for versions in keys.values():
+                for key in versions.values():
+                    SecureString.clearmem(key)
+
+    async def index_group(self, db_session, group_id):
+        '''
+        Add to blind index group secrets saved before it existed, see UserManager.index_group().
+        '''
+        secret = arao_secret.db.model.Secret
+        token = arao_secret.db.model.SecretToken
+        group_key = await self._get_group_key(db_session, group_id)
+        indexed = (sqlalchemy.select(token.secret_id)
+                   .where(token.group_id == group_id)
+                   .distinct())
+        rows = (await db_session.execute(
+            sqlalchemy.select(secret.id, secret.key_version, secret.record_format, secret.data,
+                              secret.name, secret.url)
+            .where(secret.group_id == group_id)
+            .where(secret.id.notin_(indexed))
+            .order_by(secret.id)
+        )).all()
+
+        def get_tokens():
+            # Tokens depend on the key of every secret, see Secret.key_version
+            keys = group_key.get_keys(self.manager._get_keyring())
+            tokens = list()
+            try:
+                for row in rows:
+                    record = arao_secret.manager.SecretRecord(**secret.decrypt_fields(
+                        group_key.group, keys, row, ('id', 'name', 'url')
+                    ))
+                    tokens.extend({'secret_id': record.id, 'group_id': group_id, 'token': value}
+                                  for value in secret.index_tokens(keys[row.key_version],
+                                                                   (record.name, record.url)))
+                    record.clear()
+            finally:
+                # Memory clean
+                for key in keys.values():
+                    SecureString.clearmem(key)
+            return tokens
+
+        tokens = await run(get_tokens)
+        if tokens:
+            await db_session.execute(sqlalchemy.insert(token), tokens)
+        await db_session.commit()
+
+    async def list_groups(self, db_session):
+        '''
+        Get group ID and name tuples of user groups.
+        '''
+        result = await db_session.execute(
+            sqlalchemy.select(arao_secret.db.model.UserGroupKey)
+            .where(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
+            .order_by(arao_secret.db.model.UserGroupKey.group_id)
+        )
+        group_keys = result.scalars().all()
+
+        def decrypt():
+            keyring = self.manager._get_keyring()
+            return [(group_key.group_id, arao_secret.helper.from_bytes(
+                group_key.get_name(keyring)
+            )) for group_key in group_keys]
+
+        return await run(decrypt)
+
+    async def logout(self):
+        '''
+        Remove user credentials from memory.
+        '''
+        self.manager.logout()
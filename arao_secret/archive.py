@@ -0,0 +1,274 @@
+'''
+Encrypted group exports, for disaster recovery.
+
+Archive is a header and a sequence of chunks, every chunk holds some secrets encrypted
+with AES-GCM by a key derived from a passphrase (scrypt), so archives don't depend on
+users RSA keys and can be restored into any group.
+
+    header: magic, version, scrypt parameters (log2 n, r, p) and salt
+    chunk:  length, encrypted data (nonce + ciphertext + tag)
+
+Chunks authenticate the header, their index and if they are the last one,
+so reordered, truncated or modified archives are rejected.
+Header and chunk lengths are read before they can be authenticated, so scrypt cost and
+chunk lengths beyond configured maximums are rejected without deriving the key.
+Secrets are streamed from a server side cursor on export and restored by chunks
+(see arao_secret.importer), so memory use doesn't depend on group size.
+
+Usage example:
+
+    python3 -m arao_secret.archive --alias admin --group 3 export group_3.arao
+    python3 -m arao_secret.archive --alias admin --group 5 restore group_3.arao
+
+'''
+
+import argparse
+import getpass
+import hashlib
+import logging
+import os
+import struct
+import sys
+
+import SecureString
+import sqlalchemy
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'ARAOEXP'
+VERSION = 1
+HEADER = struct.Struct('>7sBBBB16s')
+CHUNK_LENGTH = struct.Struct('>I')
+# Chunk index and last chunk flag, authenticated with the header
+CHUNK_AAD = struct.Struct('>QB')
+KEY_SIZE = 32
+
+
+def check_cost(log2_n, r, p):
+    '''
+    Check scrypt parameters against configured maximums.
+    Raises ValueError if they are out of range.
+    '''
+    limits = (
+        (log2_n, arao_secret.conf.get('Archive', 'max_scrypt_log2_n', int, fallback=20)),
+        (r, arao_secret.conf.get('Archive', 'max_scrypt_r', int, fallback=16)),
+        (p, arao_secret.conf.get('Archive', 'max_scrypt_p', int, fallback=4)),
+    )
+    if any(not 1 <= value <= maximum for value, maximum in limits):
+        raise ValueError('Archive scrypt cost {}, {}, {} out of range !'.format(log2_n, r, p))
+
+
+def get_max_chunk_size():
+    '''
+    Get maximum secrets by archive chunk.
+    '''
+    return arao_secret.conf.get('Archive', 'max_chunk_size', int, fallback=5000)
+
+
+def get_max_chunk_length():
+    '''
+    Get maximum encrypted chunk length, by maximum secrets by chunk.
+    '''
+    # Packed secrets with their lengths, Secret.data holds them encrypted
+    record_size = CHUNK_LENGTH.size + arao_secret.db.model.Secret.data.type.length
+    return (get_max_chunk_size() * record_size + arao_secret.helper.AEAD_NONCE_SIZE
+            + arao_secret.helper.AEAD_TAG_SIZE)
+
+
+def derive_key(passphrase, salt, log2_n, r, p):
+    '''
+    Get archive key from passphrase.
+    Raises ValueError if scrypt cost is out of range or needs more than configured memory.
+    Note: After use it, clean it from memory.
+    '''
+    check_cost(log2_n, r, p)
+    n = 1 << log2_n
+    maxmem = min(256 * n * r + 2 ** 20,
+                 arao_secret.conf.get('Archive', 'max_scrypt_mem', int, fallback=2 ** 29))
+    pass_bytes = passphrase
+    if not isinstance(passphrase, bytes):
+        pass_bytes = passphrase.encode(arao_secret.ENCODING)
+    try:
+        key = hashlib.scrypt(pass_bytes, salt=salt, n=n, r=r, p=p, maxmem=maxmem,
+                             dklen=KEY_SIZE)
+    finally:
+        # Memory clean
+        if pass_bytes is not passphrase:
+            SecureString.clearmem(pass_bytes)
+    return key
+
+
+def _encrypt_chunk(key, header, index, last, records):
+    '''
+    Get archive chunk from packed records.
+    '''
+    data = b''.join(records)
+    data_enc = arao_secret.helper.aead_encrypt(key, data,
+                                               header + CHUNK_AAD.pack(index, int(last)))
+    # Memory clean
+    SecureString.clearmem(data)
+    for record in records:
+        SecureString.clearmem(record)
+    return CHUNK_LENGTH.pack(len(data_enc)) + data_enc
+
+
+def export_group(db_session, user_group_key, keyring, passphrase, chunk_size=500):
+    '''
+    Get encrypted archive of group secrets, by pieces.
+    '''
+    if not arao_secret.helper.AEAD_AVAILABLE:
+        raise RuntimeError('Exports need AES-GCM, please, upgrade crypto library !')
+    # Restore rejects longer chunks
+    if chunk_size > get_max_chunk_size():
+        raise ValueError('Chunk size {} exceeds configured maximum !'.format(chunk_size))
+    # Archives can be attacked offline, so their cost doesn't follow login hashes
+    log2_n = arao_secret.conf.get('Archive', 'scrypt_log2_n', int, fallback=16)
+    r = arao_secret.conf.get('Archive', 'scrypt_r', int, fallback=8)
+    p = arao_secret.conf.get('Archive', 'scrypt_p', int, fallback=1)
+    salt = os.urandom(16)
+    header = HEADER.pack(MAGIC, VERSION, log2_n, r, p, salt)
+    group = user_group_key.group
+    LOGGER.info('User %i exporting group %i', user_group_key.user_id, group.id)
+    fields = arao_secret.db.model.Secret.FIELDS
+    table = arao_secret.db.model.Secret.__table__
+    query = (sqlalchemy.select([table.c[column]
+                                for column in ('id', 'key_version', 'record_format', 'data')
+                                + fields])
+             .where(table.c.group_id == group.id)
+             .order_by(table.c.id))
+    key = derive_key(passphrase, salt, log2_n, r, p)
+    group_keys = user_group_key.get_keys(keyring)
+    exported = 0
+    try:
+        yield header
+        with db_session.get_bind().connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(query)
+            index = 0
+            rows = result.fetchmany(chunk_size)
+            while True:
+                records = list()
+                for row in rows:
+                    clear = arao_secret.db.model.Secret.decrypt_fields(group, group_keys, row,
+                                                                       fields)
+                    record = arao_secret.helper.pack([clear[field] for field in fields])
+                    records.append(CHUNK_LENGTH.pack(len(record)) + record)
+                    SecureString.clearmem(record)
+                exported += len(rows)
+                # Read ahead to know if this is the last chunk
+                rows = result.fetchmany(chunk_size) if rows else rows
+                yield _encrypt_chunk(key, header, index, not rows, records)
+                if not rows:
+                    break
+                index += 1
+    finally:
+        # Memory clean
+        SecureString.clearmem(key)
+        for group_key in group_keys.values():
+            SecureString.clearmem(group_key)
+    LOGGER.info('User %i exported %i secrets of group %i',
+                user_group_key.user_id, exported, group.id)
+
+
+def _read(stream, size):
+    '''
+    Read exactly size bytes from stream.
+    '''
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated archive !')
+    return data
+
+
+def read_archive(stream, passphrase):
+    '''
+    Get secret fields dictionaries from archive, one by secret.
+    Chunks are verified before their secrets are returned.
+    Raises ValueError for wrong passphrase, modified or truncated archives.
+    '''
+    header = _read(stream, HEADER.size)
+    magic, version, log2_n, r, p, salt = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unknown archive format !')
+    fields = arao_secret.db.model.Secret.FIELDS
+    key = derive_key(passphrase, salt, log2_n, r, p)
+    max_length = get_max_chunk_length()
+    try:
+        index = 0
+        last = False
+        while not last:
+            length = CHUNK_LENGTH.unpack(_read(stream, CHUNK_LENGTH.size))[0]
+            if length > max_length:
+                raise ValueError('Archive chunk of {} bytes exceeds maximum !'.format(length))
+            data_enc = _read(stream, length)
+            try:
+                data = arao_secret.helper.aead_decrypt(key, data_enc,
+                                                       header + CHUNK_AAD.pack(index, 0))
+            except ValueError:
+                # Only the last chunk is authenticated as last
+                data = arao_secret.helper.aead_decrypt(key, data_enc,
+                                                       header + CHUNK_AAD.pack(index, 1))
+                last = True
+            offset = 0
+            with memoryview(data) as view:
+                while offset < len(data):
+                    length = CHUNK_LENGTH.unpack_from(data, offset)[0]
+                    offset += CHUNK_LENGTH.size
+                    record = bytes(view[offset:offset + length])
+                    offset += length
+                    yield {field: arao_secret.helper.unpack(record, position)
+                           for position, field in enumerate(fields)}
+                    SecureString.clearmem(record)
+            SecureString.clearmem(data)
+            index += 1
+        if stream.read(1):
+            raise ValueError('Unexpected data after last archive chunk !')
+    finally:
+        # Memory clean
+        SecureString.clearmem(key)
+
+
+def restore_group(db_session, user_group_key, keyring, stream, passphrase, chunk_size=500,
+                  workers=None, progress=None):
+    '''
+    Import archive secrets into group of given user group key.
+    Note: Chunks read before a broken one are already saved.
+    Get the number of restored secrets.
+    '''
+    return arao_secret.importer.import_secrets(db_session, user_group_key, keyring,
+                                               read_archive(stream, passphrase),
+                                               chunk_size=chunk_size, workers=workers,
+                                               progress=progress)
+
+
+def parse_arguments(argv):
+    '''
+    Arguments parser.
+    '''
+    parser = argparse.ArgumentParser(description='AraoSecret group export and restore')
+    parser.add_argument('--alias', type=str, required=True, help='Alias of group member.')
+    parser.add_argument('--group', type=int, required=True, help='Group ID.')
+    parser.add_argument('--chunk-size', type=int, default=500, help='Secrets by chunk.')
+    parser.add_argument('action', type=str, choices=('export', 'restore'), help='Action.')
+    parser.add_argument('path', type=str, help='Archive file.')
+    return parser.parse_args(argv[1:])
+
+
+if __name__ == '__main__':
+    ARGS = parse_arguments(sys.argv)
+    DB_SESSION = arao_secret.db.create_session()
+    MANAGER = arao_secret.manager.get_user(DB_SESSION, ARGS.alias, getpass.getpass())
+    PASSPHRASE = getpass.getpass('Archive passphrase: ')
+    if ARGS.action == 'export':
+        with open(ARGS.path, 'xb') as STREAM:
+            for PIECE in MANAGER.export_group(DB_SESSION, ARGS.group, PASSPHRASE,
+                                              chunk_size=ARGS.chunk_size):
+                STREAM.write(PIECE)
+    else:
+        with open(ARGS.path, 'rb') as STREAM:
+            TOTAL = MANAGER.restore_group(DB_SESSION, ARGS.group, STREAM, PASSPHRASE,
+                                          chunk_size=ARGS.chunk_size)
+        print('Restore finished: {} secrets'.format(TOTAL))
+    MANAGER.logout()
@@ -0,0 +1,199 @@
+'''
+User authentication, password hashers and login verification pool.
+
+Hashers are pluggable, stored hashes identify their hasher, so old hashes keep working
+and they are updated to configured hasher on next login.
+'''
+
+import concurrent.futures
+import functools
+import hashlib
+import hmac
+import logging
+import os
+import struct
+import threading
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Verification pool, see get_pool()
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class LoginOverloaded(Exception):
+    '''
+    Too many logins in progress, try again later.
+    '''
+
+
+class Sha3Hasher:
+    '''
+    Legacy hasher, unsalted SHA3-512.
+    '''
+    name = 'sha3'
+
+    def hash(self, password):
+        '''
+        Get hash from password.
+        '''
+        return arao_secret.helper.get_pass_hash(password)
+
+    def identify(self, pass_hash):
+        '''
+        Check if hash was created by this hasher.
+        '''
+        return len(pass_hash) == 64
+
+    def needs_update(self, pass_hash):
+        '''
+        Check if hash must be created again with current parameters.
+        '''
+        return not self.identify(pass_hash)
+
+    def verify(self, password, pass_hash):
+        '''
+        Check password against hash.
+        '''
+        return hmac.compare_digest(self.hash(password), pass_hash)
+
+
+class ScryptHasher:
+    '''
+    Salted and memory hard hasher, cost tunable by configuration.
+    Hash is prefix, cost parameters (log2 n, r, p), salt and derived key.
+    '''
+    name = 'scrypt'
+    prefix = b'$s1$'
+    params = struct.Struct('>BBB')
+    salt_size = 16
+    key_size = 32
+
+    def __init__(self, log2_n=None, r=None, p=None):
+        self.log2_n = log2_n or arao_secret.conf.get('Auth', 'scrypt_log2_n', int, fallback=14)
+        self.r = r or arao_secret.conf.get('Auth', 'scrypt_r', int, fallback=8)
+        self.p = p or arao_secret.conf.get('Auth', 'scrypt_p', int, fallback=1)
+
+    def _derive(self, password, salt, log2_n, r, p):
+        '''
+        Derive key from password.
+        '''
+        n = 1 << log2_n
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20,
+                              dklen=self.key_size)
+
+    def hash(self, password):
+        '''
+        Get hash from password.
+        '''
+        salt = os.urandom(self.salt_size)
+        return (self.prefix + self.params.pack(self.log2_n, self.r, self.p) + salt
+                + self._derive(password, salt, self.log2_n, self.r, self.p))
+
+    def identify(self, pass_hash):
+        '''
+        Check if hash was created by this hasher.
+        '''
+        return pass_hash.startswith(self.prefix)
+
+    def needs_update(self, pass_hash):
+        '''
+        Check if hash must be created again with current parameters.
+        '''
+        if not self.identify(pass_hash):
+            return True
+        return self.params.unpack_from(pass_hash, len(self.prefix)) != (self.log2_n, self.r, self.p)
+
+    def verify(self, password, pass_hash):
+        '''
+        Check password against hash.
+        '''
+        start = len(self.prefix) + self.params.size
+        log2_n, r, p = self.params.unpack_from(pass_hash, len(self.prefix))
+        salt = pass_hash[start:start + self.salt_size]
+        return hmac.compare_digest(self._derive(password, salt, log2_n, r, p),
+                                   pass_hash[start + self.salt_size:])
+
+
+HASHERS = {hasher.name: hasher for hasher in (ScryptHasher, Sha3Hasher)}
+
+
+@functools.lru_cache(maxsize=1)
+def get_dummy_hash():
+    '''
+    Get hash to verify against when user doesn't exist, so it takes as long as a real login.
+    '''
+    return get_hasher().hash(os.urandom(16))
+
+
+def get_hasher():
+    '''
+    Get configured hasher, for new hashes.
+    '''
+    return HASHERS[arao_secret.conf.get('Auth', 'hasher', fallback=ScryptHasher.name)]()
+
+
+def verify(password, pass_hash):
+    '''
+    Check password against hash created by any known hasher.
+    '''
+    for hasher in (ScryptHasher(), Sha3Hasher()):
+        if hasher.identify(pass_hash):
+            return hasher.verify(password, pass_hash)
+    LOGGER.error('Unknown password hash format !')
+    return False
+
+
+class VerificationPool:
+    '''
+    Bounded worker pool for password verification.
+
+    Logins beyond workers and queue size are rejected at once with LoginOverloaded,
+    instead of waiting on an unbounded queue.
+    '''
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rejected = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+
+    def stats(self):
+        '''
+        Get pool counters.
+        '''
+        with self._lock:
+            return {'workers': self.workers, 'queue_size': self.queue_size,
+                    'rejected': self.rejected}
+
+    def verify(self, password, pass_hash, timeout=None):
+        '''
+        Check password against hash in a worker.
+        '''
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise LoginOverloaded('Too many logins in progress !')
+        try:
+            future = self._executor.submit(verify, password, pass_hash)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result(timeout)
+
+
+def get_pool():
+    '''
+    Get process verification pool.
+    '''
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = VerificationPool(arao_secret.conf.get('Auth', 'workers', int, fallback=2),
+                                     arao_secret.conf.get('Auth', 'queue_size', int, fallback=8))
+        return _POOL
@@ -0,0 +1,129 @@
+'''
+In memory caches.
+'''
+
+import collections
+import threading
+import time
+
+
+# Missing value marker, see LRUCache.apply()
+_MISSING = object()
+
+
+class LRUCache:
+    '''
+    Bounded cache with least recently used and time to live eviction.
+
+    on_evict is called with every value leaving the cache (eviction, expiration, pop or clear),
+    use it to clean sensitive values from memory. Values cleaned this way can be cleaned while
+    other threads still hold them, so read them with apply() instead of get().
+    '''
+    def __init__(self, size, ttl=None, on_evict=None):
+        self.size = size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()  # key -> (expiration, value)
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._data:
+                return False
+            expiration, _ = self._data[key]
+            if expiration is not None and expiration < time.monotonic():
+                self._evict(key)
+                return False
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def _evict(self, key):
+        _, value = self._data.pop(key)
+        self.evictions += 1
+        if self.on_evict:
+            self.on_evict(value)
+
+    def apply(self, key, function, default=None):
+        '''
+        Get function result on value, default if it's not present or expired.
+        Value can't leave the cache while function runs.
+        '''
+        with self._lock:
+            value = self.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            return function(value)
+
+    def clear(self):
+        '''
+        Remove all values.
+        '''
+        with self._lock:
+            for key in list(self._data):
+                self._evict(key)
+
+    def expire(self):
+        '''
+        Remove expired values.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            for key in [key for key, (expiration, _) in self._data.items()
+                        if expiration is not None and expiration < now]:
+                self._evict(key)
+
+    def get(self, key, default=None):
+        '''
+        Get value, default if it's not present or expired.
+        '''
+        with self._lock:
+            if key in self._data:
+                expiration, value = self._data[key]
+                if expiration is None or expiration >= time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._evict(key)
+            self.misses += 1
+            return default
+
+    def items(self):
+        '''
+        Get key and value pairs, least recently used first, without updating their use.
+        '''
+        with self._lock:
+            return [(key, value) for key, (_, value) in self._data.items()]
+
+    def pop(self, key):
+        '''
+        Remove value if present.
+        '''
+        with self._lock:
+            if key in self._data:
+                self._evict(key)
+
+    def set(self, key, value):
+        '''
+        Add value, evicting the least recently used if cache is full.
+        '''
+        with self._lock:
+            if key in self._data:
+                self._evict(key)
+            expiration = time.monotonic() + self.ttl if self.ttl else None
+            self._data[key] = (expiration, value)
+            while len(self._data) > self.size:
+                self._evict(next(iter(self._data)))
+
+    def stats(self):
+        '''
+        Get cache counters.
+        '''
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
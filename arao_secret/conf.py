@@ -20,10 +20,14 @@ CONF_PATH = '/etc/arao_secret/main.conf'
 CONF = _configparser.ConfigParser(allow_no_value=True)
 CONF.read(os.path.expanduser(CONF_PATH))
 
+# Marker to know when no fallback was given, None is a valid fallback
+_NO_FALLBACK = object()
 
-def get(section, key, data_type=str):
+
+def get(section, key, data_type=str, fallback=_NO_FALLBACK):
     '''
     Get configured parameter.
+    If fallback is given, it's returned when the section or the key are not configured.
     '''
     try:
         if data_type == bool:
@@ -34,7 +38,11 @@ def get(section, key, data_type=str):
             return CONF.getfloat(section, key)
         else:
             return CONF.get(section, key)
-    except _configparser.NoSectionError as nse:
+    except (_configparser.NoSectionError, _configparser.NoOptionError) as nse:
+        if fallback is not _NO_FALLBACK:
+            return fallback
+        if isinstance(nse, _configparser.NoOptionError):
+            raise
         _LOGGER.error(nse)
         raise Exception('Please check inside "{}" file, "{}" section and "{}" attribute !'
                         .format(CONF_PATH, section, key))
@@ -2,35 +2,331 @@
 Data Base connection.
 '''
 
+import itertools as _itertools
+import logging as _logging
+import os as _os
+import threading as _threading
+import time as _time
+
 from sqlalchemy.ext.declarative import declarative_base as _declarative_base
 from sqlalchemy import create_engine as _create_engine
+from sqlalchemy import event as _event
+from sqlalchemy import text as _text
+from sqlalchemy.orm import Session as _Session
 from sqlalchemy.orm import scoped_session as _scoped_session
 from sqlalchemy.orm import sessionmaker as _sessionmaker
+from sqlalchemy.pool import QueuePool as _QueuePool
+from sqlalchemy.sql.expression import Select as _Select
 
+from arao_secret import cache as _cache
 from arao_secret import conf
 
 
-def create_session(autocommit=False, autoflush=False, pool_recycle=3600):
+_LOGGER = _logging.getLogger(__name__)
+
+# Process engines by URI, see get_engine()
+_ENGINES = dict()
+_ENGINES_LOCK = _threading.Lock()
+
+# Process read replicas, see get_replicas()
+_REPLICAS = None
+_REPLICAS_LOCK = _threading.Lock()
+
+# Last writes time by sticky key, see RoutingSession
+_WRITES = None
+
+
+class PoolStats:
+    '''
+    Connection pool counters.
+    '''
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = _threading.Lock()
+
+    def add(self, counter, value=1):
+        '''
+        Increment counter.
+        '''
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def add_wait(self, seconds):
+        '''
+        Add time waited for a connection checkout.
+        '''
+        with self._lock:
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def as_dict(self):
+        '''
+        Get counters, wait times in seconds.
+        '''
+        with self._lock:
+            return {'connects': self.connects, 'checkouts': self.checkouts,
+                    'checkins': self.checkins, 'checked_out': self.checkouts - self.checkins,
+                    'wait_avg': self.wait_total / self.waits if self.waits else 0.0,
+                    'wait_max': self.wait_max}
+
+
+class TimedQueuePool(_QueuePool):
+    '''
+    Queue pool measuring time waited for connections.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()  # Replaced by engine ones, see get_engine()
+
+    def _do_get(self):
+        start = _time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            self.stats.add_wait(_time.monotonic() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def get_engine(uri=None, pool_recycle=None):
+    '''
+    Get process engine for given URI, configured one by default.
+
+    Engine and its connection pool are created once per process and URI,
+    pool is configured by [DB] section: pool_size, max_overflow, pool_pre_ping, pool_recycle.
+    Statements are timed if [Profiler] is enabled, see arao_secret.db.profiler.
+    '''
+    uri = uri or conf.get('DB', 'URI')
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(uri)
+        # Connections can't be shared with forked processes, and they are still used by parent
+        # one, so they are dropped without closing them
+        if engine is not None and engine.pid != _os.getpid():
+            engine.dispose(close=False)
+            engine = None
+        if engine is None:
+            kwargs = dict()
+            if not uri.startswith('sqlite'):
+                kwargs['poolclass'] = TimedQueuePool
+                kwargs['pool_size'] = conf.get('DB', 'pool_size', int, fallback=5)
+                kwargs['max_overflow'] = conf.get('DB', 'max_overflow', int, fallback=10)
+            engine = _create_engine(
+                uri,
+                convert_unicode=True,
+                pool_pre_ping=conf.get('DB', 'pool_pre_ping', bool, fallback=True),
+                pool_recycle=pool_recycle or conf.get('DB', 'pool_recycle', int, fallback=3600),
+                **kwargs
+            )
+            engine.pid = _os.getpid()
+            engine.pool_stats = stats = PoolStats()
+            if isinstance(engine.pool, TimedQueuePool):
+                engine.pool.stats = stats
+            _event.listen(engine, 'connect', lambda *_: stats.add('connects'))
+            _event.listen(engine, 'checkout', lambda *_: stats.add('checkouts'))
+            _event.listen(engine, 'checkin', lambda *_: stats.add('checkins'))
+            if profiler.is_enabled():
+                profiler.install(engine)
+            _ENGINES[uri] = engine
+        return engine
+
+
+def pool_stats(uri=None):
+    '''
+    Get connection pool counters of process engine for given URI, configured one by default.
+    '''
+    return get_engine(uri).pool_stats.as_dict()
+
+
+def dispose_engine(uri=None):
+    '''
+    Close process engine connections for given URI, configured one by default.
+    '''
+    with _ENGINES_LOCK:
+        engine = _ENGINES.pop(uri or conf.get('DB', 'URI'), None)
+    if engine is not None:
+        engine.dispose()
+
+
+class ReplicaSet:
+    '''
+    Read replicas, chosen by round-robin among healthy ones.
+
+    Replicas are checked with a trivial query every check interval by a checker thread,
+    so requests never wait for a check, failed ones are skipped until a later check succeeds.
+    '''
+    def __init__(self, uris, check_interval=30):
+        self.uris = list(uris)
+        self.check_interval = check_interval
+        self._healthy = {uri: True for uri in self.uris}
+        self._next = _itertools.cycle(self.uris)
+        self._checker_pid = None
+        self._lock = _threading.Lock()
+
+    def _check(self, uri):
+        '''
+        Check replica health.
+        '''
+        try:
+            with get_engine(uri).connect() as connection:
+                connection.execute(_text('SELECT 1'))
+            healthy = True
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception('Read replica %i failed health check', self.uris.index(uri))
+            healthy = False
+        with self._lock:
+            if healthy != self._healthy[uri]:
+                _LOGGER.warning('Read replica %i is %s', self.uris.index(uri),
+                                'back' if healthy else 'down')
+            self._healthy[uri] = healthy
+        return healthy
+
+    def _run_checks(self):
+        '''
+        Checker thread, check every replica each check interval.
+        '''
+        while True:
+            _time.sleep(self.check_interval)
+            for uri in self.uris:
+                self._check(uri)
+
+    def _start_checker(self):
+        '''
+        Start checker thread of this process if not started yet.
+        '''
+        with self._lock:
+            # Threads don't survive fork, so uwsgi workers start their own one
+            if self._checker_pid != _os.getpid():
+                _threading.Thread(target=self._run_checks, name='replica-checker',
+                                  daemon=True).start()
+                self._checker_pid = _os.getpid()
+
+    def get(self):
+        '''
+        Get engine of next healthy replica, None if all of them are down.
+        '''
+        self._start_checker()
+        with self._lock:
+            for _ in self.uris:
+                uri = next(self._next)
+                if self._healthy[uri]:
+                    break
+            else:
+                return None
+        return get_engine(uri)
+
+    def stats(self):
+        '''
+        Get healthy state by replica index.
+        '''
+        with self._lock:
+            return [self._healthy[uri] for uri in self.uris]
+
+
+def get_replicas():
+    '''
+    Get process read replicas, None if [DB] replica_uris is not configured.
+    '''
+    global _REPLICAS, _WRITES
+    with _REPLICAS_LOCK:
+        if _REPLICAS is None:
+            uris = [uri.strip() for uri in conf.get('DB', 'replica_uris', fallback='').split(',')
+                    if uri.strip()]
+            if not uris:
+                return None
+            _REPLICAS = ReplicaSet(uris, conf.get('DB', 'replica_check_interval', int,
+                                                  fallback=30))
+            _WRITES = _cache.LRUCache(conf.get('DB', 'sticky_size', int, fallback=10000),
+                                      ttl=conf.get('DB', 'read_your_writes', int, fallback=5))
+        return _REPLICAS
+
+
+class RoutingSession(_Session):
+    '''
+    Session sending reads to replicas and anything else to primary DataBase.
+
+    Flushes, locking reads (FOR UPDATE / FOR SHARE), statements after a flush in the same
+    transaction and reads within [DB] read_your_writes seconds after a write of the same
+    session or with the same sticky key (session info, usually the user ID) go to primary,
+    so users read their own writes, like objects expired by commit of a new user.
+    '''
+    def get_bind(self, mapper=None, clause=None, **kwargs):  # pylint: disable=W0221
+        primary = super().get_bind(mapper, clause, **kwargs)
+        if self._flushing or self.info.get('wrote') or not isinstance(clause, _Select):
+            return primary
+        # Replicas can't lock primary rows
+        if clause._for_update_arg is not None:  # pylint: disable=W0212
+            return primary
+        if _WRITES is not None:
+            wrote_at = self.info.get('wrote_at')
+            if wrote_at is not None and _time.monotonic() - wrote_at < _WRITES.ttl:
+                return primary
+            sticky_key = self.info.get('sticky_key')
+            if sticky_key is not None and _WRITES.get(sticky_key) is not None:
+                return primary
+        replicas = get_replicas()
+        return (replicas and replicas.get()) or primary
+
+
+@_event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, _):
+    '''
+    Send following statements to primary.
+    '''
+    session.info['wrote'] = True
+    session.info['wrote_at'] = _time.monotonic()
+    # Without read_your_writes time, cache entries would never expire
+    if session.info.get('sticky_key') is not None and _WRITES is not None and _WRITES.ttl:
+        _WRITES.set(session.info['sticky_key'], _time.monotonic())
+
+
+@_event.listens_for(RoutingSession, 'after_commit')
+@_event.listens_for(RoutingSession, 'after_rollback')
+def _after_transaction(session):
+    '''
+    Transaction finished, reads can go to replicas again.
+    '''
+    session.info.pop('wrote', None)
+
+
+def create_session(autocommit=False, autoflush=False, pool_recycle=None, uri=None,
+                   sticky_key=None):
     '''
     Create a new MySQL/PostgreSQL session.
+    Sessions share process engine and its connection pool, see get_engine().
 
     Parameters
     ----------
     autocommit : Boolean (False), see sqlalchemy documentation.
     autoflush : Boolean (False), see sqlalchemy documentation.
-    pool_recycle : Integer (7200), causes the pool to recycle connections
-                   after the given number of seconds has passed.
+    pool_recycle : Integer (None), causes the pool to recycle connections
+                   after the given number of seconds has passed, configured one by default.
+                   Only used when process engine is created.
+    uri : String (None), DataBase URI, configured one by default.
+          If not given and [DB] replica_uris is configured, reads go to replicas.
+    sticky_key : (None), key of writes to read from primary for a while, see RoutingSession.
 
     Returns
     -------
     session : Database session.
     '''
-    engine = _create_engine(conf.get('DB', 'URI'),
-                            convert_unicode=True,
-                            pool_recycle=pool_recycle)
+    engine = get_engine(uri, pool_recycle)
+    kwargs = dict()
+    if uri is None and get_replicas() is not None:
+        kwargs['class_'] = RoutingSession
+        kwargs['info'] = {'sticky_key': sticky_key}
     session = _scoped_session(_sessionmaker(autocommit=autocommit,
                                             autoflush=autoflush,
-                                            bind=engine))
+                                            bind=engine,
+                                            **kwargs))
 
     # The following dumb assignments on session are just to trick pylint
     # so that it doesn't report "missing attribute" every time the session is used
@@ -48,10 +344,13 @@ def create_session(autocommit=False, autoflush=False, pool_recycle=3600):
 
 BASE = _declarative_base()
 from arao_secret.db import model
+from arao_secret.db import migrate
+from arao_secret.db import profiler
 
 
 def create_tables(db_session):
     '''
-    Create tables into existent DataBase.
+    Create tables into existent DataBase, upgrading schema of previous versions.
     '''
     BASE.metadata.create_all(db_session.bind)
+    migrate.upgrade(db_session)
@@ -0,0 +1,235 @@
+'''
+DataBase schema migrations.
+
+Every migration upgrades schema one version and it's saved on schema_version table.
+Migrations check current schema before change it, so they are safe on new DataBases
+created by create_tables() and on partially migrated ones.
+
+Usage example:
+
+    python3 -m arao_secret.db.migrate            # Upgrade configured DataBase
+    python3 -m arao_secret.db.migrate --check    # Report missing indexes
+
+'''
+
+import argparse
+import datetime
+import logging
+import sys
+
+import sqlalchemy
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _quote(connection, name):
+    '''
+    Quote identifier, "user" and "group" are reserved words.
+    '''
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def _add_column(connection, inspector, column):
+    '''
+    Add model column to its table if missing.
+    '''
+    table = column.table.name
+    if column.name in {col['name'] for col in inspector.get_columns(table)}:
+        return
+    sql = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+        _quote(connection, table), _quote(connection, column.name),
+        column.type.compile(dialect=connection.dialect)
+    )
+    if column.server_default is not None:
+        sql += " DEFAULT '{}'".format(column.server_default.arg)
+    if not column.nullable:
+        sql += ' NOT NULL'
+    LOGGER.info(sql)
+    connection.execute(sqlalchemy.text(sql))
+
+
+def _drop_not_null(connection, inspector, column):
+    '''
+    Allow NULL on model column if not allowed yet.
+    '''
+    table = column.table.name
+    for col in inspector.get_columns(table):
+        if col['name'] == column.name and not col['nullable']:
+            if connection.dialect.name == 'sqlite':
+                _rebuild_table(connection, inspector, column.table)
+                return
+            if connection.dialect.name == 'postgresql':
+                sql = 'ALTER TABLE {} ALTER COLUMN {} DROP NOT NULL'
+            elif connection.dialect.name == 'mysql':
+                sql = 'ALTER TABLE {} MODIFY {} ' + column.type.compile(dialect=connection.dialect)
+            else:
+                LOGGER.warning("Can't allow NULL on %s.%s with %s, please, do it by hand !",
+                               table, column.name, connection.dialect.name)
+                return
+            sql = sql.format(_quote(connection, table), _quote(connection, column.name))
+            LOGGER.info(sql)
+            connection.execute(sqlalchemy.text(sql))
+
+
+def _rebuild_table(connection, inspector, table):
+    '''
+    Rebuild table with model definition, SQLite can't alter columns.
+
+    Following SQLite procedure, rows are copied to a new table that replaces the old one,
+    so foreign keys of other tables keep referencing it. Columns missing on DataBase get
+    their defaults and indexes are created again.
+    '''
+    name = table.name
+    new_name = '_new_{}'.format(name)
+    existent = {col['name'] for col in inspector.get_columns(name)}
+    columns = ', '.join(_quote(connection, column.name) for column in table.columns
+                        if column.name in existent)
+    LOGGER.info('Rebuilding table %s', name)
+    metadata = sqlalchemy.MetaData()
+    # Referenced tables resolve foreign keys of new one
+    for foreign_key in table.foreign_keys:
+        foreign_key.column.table.to_metadata(metadata)
+    new_table = table.to_metadata(metadata, name=new_name)
+    connection.execute(sqlalchemy.schema.CreateTable(new_table))
+    connection.execute(sqlalchemy.text('INSERT INTO {} ({}) SELECT {} FROM {}'.format(
+        _quote(connection, new_name), columns, columns, _quote(connection, name)
+    )))
+    connection.execute(sqlalchemy.text('DROP TABLE {}'.format(_quote(connection, name))))
+    connection.execute(sqlalchemy.text('ALTER TABLE {} RENAME TO {}'.format(
+        _quote(connection, new_name), _quote(connection, name)
+    )))
+    for index in table.indexes:
+        index.create(connection)
+    # Inspector caches previous definition
+    inspector.info_cache.clear()
+
+
+def missing_indexes(connection):
+    '''
+    Get model indexes missing on DataBase.
+    '''
+    inspector = sqlalchemy.inspect(connection)
+    tables = set(inspector.get_table_names())
+    missing = list()
+    for table in arao_secret.db.BASE.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existent = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in sorted(table.indexes, key=lambda index: index.name)
+                       if index.name not in existent)
+    return missing
+
+
+def upgrade_1(connection, inspector):
+    '''
+    Packed and AES-GCM secrets.
+    '''
+    secret = arao_secret.db.model.Secret.__table__
+    group = arao_secret.db.model.Group.__table__
+    _add_column(connection, inspector, secret.c.record_format)
+    _add_column(connection, inspector, secret.c.data)
+    _add_column(connection, inspector, group.c.cipher)
+    for field in arao_secret.db.model.Secret.FIELDS:
+        _drop_not_null(connection, inspector, secret.c[field])
+
+
+def upgrade_2(connection, _):
+    '''
+    Indexes for group keys and secrets lookups.
+    '''
+    for index in missing_indexes(connection):
+        LOGGER.info('Creating index %s', index.name)
+        index.create(connection)
+
+
+def upgrade_3(connection, _):
+    '''
+    Blind index of secret names and URLs.
+    '''
+    arao_secret.db.model.SecretToken.__table__.create(connection, checkfirst=True)
+
+
+def upgrade_4(connection, inspector):
+    '''
+    Secrets version, for clients caches.
+    '''
+    _add_column(connection, inspector, arao_secret.db.model.Secret.__table__.c.version)
+
+
+def upgrade_5(connection, inspector):
+    '''
+    Group key versions, for group re-encryption.
+    '''
+    _add_column(connection, inspector, arao_secret.db.model.Group.__table__.c.key_version)
+    _add_column(connection, inspector, arao_secret.db.model.Secret.__table__.c.key_version)
+    _add_column(connection, inspector,
+                arao_secret.db.model.UserGroupKey.__table__.c.next_group_key)
+    arao_secret.db.model.GroupRekey.__table__.create(connection, checkfirst=True)
+
+
+def upgrade_6(connection, inspector):
+    '''
+    RSA-OAEP flags of group keys, previous ones are raw RSA.
+    '''
+    _add_column(connection, inspector, arao_secret.db.model.UserGroupKey.__table__.c.oaep)
+
+
+MIGRATIONS = [upgrade_1, upgrade_2, upgrade_3, upgrade_4, upgrade_5, upgrade_6]
+
+
+def check(db_session):
+    '''
+    Get names of model indexes missing on DataBase.
+    '''
+    return [index.name for index in missing_indexes(db_session.connection())]
+
+
+def current_version(db_session):
+    '''
+    Get last applied migration version, 0 if none.
+    '''
+    version = db_session.query(sqlalchemy.func.max(arao_secret.db.model.SchemaVersion.version))
+    return version.scalar() or 0
+
+
+def upgrade(db_session):
+    '''
+    Apply pending migrations, each one in its own transaction.
+    '''
+    arao_secret.db.model.SchemaVersion.__table__.create(db_session.get_bind(), checkfirst=True)
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version <= current_version(db_session):
+            continue
+        description = migration.__doc__.strip()
+        LOGGER.info('Applying migration %i: %s', version, description)
+        connection = db_session.connection()
+        migration(connection, sqlalchemy.inspect(connection))
+        db_session.add(arao_secret.db.model.SchemaVersion(version=version,
+                                                          description=description,
+                                                          applied=datetime.datetime.utcnow()))
+        db_session.commit()
+
+
+def parse_arguments(argv):
+    '''
+    Arguments parser.
+    '''
+    parser = argparse.ArgumentParser(description='AraoSecret DataBase migrations')
+    parser.add_argument('--check', action='store_true',
+                        help='Only report missing indexes, exit with error if any.')
+    return parser.parse_args(argv[1:])
+
+
+if __name__ == '__main__':
+    ARGS = parse_arguments(sys.argv)
+    DB_SESSION = arao_secret.db.create_session()
+    if ARGS.check:
+        MISSING = check(DB_SESSION)
+        for NAME in MISSING:
+            print('Missing index: {}'.format(NAME))
+        sys.exit(1 if MISSING else 0)
+    upgrade(DB_SESSION)
+    print('Schema version: {}'.format(current_version(DB_SESSION)))
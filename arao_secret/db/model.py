@@ -9,6 +9,7 @@ DataBase models for AraoSecret.
 
 
 import logging
+import struct
 
 import SecureString
 
@@ -18,10 +19,15 @@ from Crypto.PublicKey import RSA
 
 from sqlalchemy import Boolean
 from sqlalchemy import Column
+from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import LargeBinary
 from sqlalchemy import String
+from sqlalchemy.orm import backref
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.orm import object_session
 from sqlalchemy.orm import relationship
 
 import arao_secret
@@ -31,6 +37,20 @@ from arao_secret.db import BASE
 LOGGER = logging.getLogger(__name__)
 
 
+class SchemaVersion(BASE):
+    '''
+    Applied schema migrations, see arao_secret.db.migrate.
+    '''
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(128), nullable=False)
+    applied = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return '{}, {}'.format(self.version, self.description)
+
+
 class User(BASE):
     '''
     AraoSecret user.
@@ -45,28 +65,44 @@ class User(BASE):
     rsa_key = Column(LargeBinary(3310), nullable=False)
     rsa_key_pub = Column(LargeBinary(799), nullable=False)
 
-    def __init__(self, alias, email, password):
+    def __init__(self, alias, email, password, rsa_key=None):
         self.alias = alias
         self.email = email
-        self.pass_hash = arao_secret.helper.get_pass_hash(password)
-        # RSA
-        rsa_key = RSA.generate(4096)
-        self.rsa_key = rsa_key.exportKey(passphrase=password)
-        self.rsa_key_pub = rsa_key.publickey().exportKey()
+        self.pass_hash = arao_secret.auth.get_hasher().hash(password)
+        # RSA, generated if no pre-generated key is given
+        if rsa_key is None:
+            self.rsa_key, self.rsa_key_pub = self.generate_key(password)
+        else:
+            self.rsa_key = rsa_key.exportKey(passphrase=password)
+            self.rsa_key_pub = rsa_key.publickey().exportKey()
         # TODO : Clean rsa_key from memory
 
     def __repr__(self):
         return '{}, {}'.format(self.id, self.alias)
 
-    def decrypt(self, password, text_enc):
-        rsa_key = RSA.importKey(self.rsa_key, passphrase=password)
-        text = rsa_key.decrypt(text_enc)
-        # TODO : Clean rsa_key from memory
-        return text
+    @staticmethod
+    def generate_key(password):
+        '''
+        Generate RSA key by crypto executor, get private key protected by password and public
+        key, so the clear private key never leaves the executor worker.
+        '''
+        return arao_secret.executor.run(arao_secret.executor.rsa_generate,
+                                        arao_secret.keypool.RSA_BITS, password)
+
+    def decrypt(self, password, text_enc, oaep=True, size=None):
+        '''
+        Decrypt with user private key, RSA-OAEP or legacy raw RSA (see helper.rsa_decrypt).
+        Password can be the master password or the unlocked session keyring of the user.
+        '''
+        if isinstance(password, arao_secret.keyring.Keyring):
+            return password.decrypt(text_enc, oaep, size)
+        # Private key and password are not sent to crypto executor
+        return arao_secret.helper.rsa_decrypt(RSA.importKey(self.rsa_key, passphrase=password),
+                                              text_enc, oaep, size)
 
     def encrypt(self, text):
-        rsa_key = RSA.importKey(self.rsa_key_pub)
-        text_enc = rsa_key.encrypt(text, None)[0]
+        # Inline, clear text would be sent to crypto executor for a cheap operation
+        text_enc = arao_secret.helper.rsa_encrypt(RSA.importKey(self.rsa_key_pub), text)
         SecureString.clearmem(text)
         return text_enc
 
@@ -90,18 +126,65 @@ class User(BASE):
 class Group(BASE):
     '''
     AraoSecret group.
+
+    Cipher selects how new group secrets are encrypted:
+      * CIPHER_CBC: Legacy AES-CBC with group IV and fill out.
+      * CIPHER_GCM: AES-GCM with a random nonce per record, authenticated and without fill out.
+    Secrets keep their own format, so group cipher can change without losing old secrets.
+
+    Key version is increased by every re-encryption, secrets keep the version of their key,
+    see arao_secret.rekey.
     '''
     __tablename__ = 'group'
 
+    CIPHER_CBC = 'cbc'
+    CIPHER_GCM = 'gcm'
+
     id = Column(Integer, primary_key=True)
     aes_iv = Column(LargeBinary(16), nullable=False)
+    cipher = Column(String(8), nullable=False, default=CIPHER_CBC, server_default=CIPHER_CBC)
+    key_version = Column(Integer, nullable=False, default=1, server_default='1')
 
-    def __init__(self):
+    def __init__(self, cipher=None):
         self.aes_iv = Random.new().read(AES.block_size)
+        if cipher is None:
+            cipher = arao_secret.conf.get(
+                'Crypto', 'group_cipher',
+                fallback=self.CIPHER_GCM if arao_secret.helper.AEAD_AVAILABLE else self.CIPHER_CBC
+            )
+        if cipher not in (self.CIPHER_CBC, self.CIPHER_GCM):
+            raise ValueError('Unknown group cipher "{}" !'.format(cipher))
+        self.cipher = cipher
 
     def __repr__(self):
         return str(self.id)
 
+    def decrypt(self, group_key, text_enc):
+        '''
+        Decrypt text with clear group key.
+        '''
+        return arao_secret.helper.from_bytes(self.decrypt_bytes(group_key, text_enc))
+
+    def decrypt_bytes(self, group_key, data_enc):
+        '''
+        Decrypt with clear group key, without removing fill out.
+        '''
+        key = AES.new(group_key, AES.MODE_CBC, self.aes_iv)
+        # TODO : Clean key from memory
+        return key.decrypt(data_enc)
+
+    def encrypt(self, group_key, text):
+        '''
+        Encrypt with clear group key.
+        '''
+        text_bytes = arao_secret.helper.to_bytes(text)
+        key = AES.new(group_key, AES.MODE_CBC, self.aes_iv)
+        text_enc = key.encrypt(text_bytes)
+        # Memory clean
+        # TODO : Clean key from memory
+        SecureString.clearmem(text_bytes)
+        return text_enc
+
 
 class UserGroupKey(BASE):
     '''
@@ -109,30 +192,44 @@ class UserGroupKey(BASE):
 
     All data except IDs is encrypted.
 
-    TODO : If user removed from group, all group data must be re-encrypted.
+    Note : If user removed from group, all group data must be re-encrypted (see arao_secret.rekey).
            If he has DB access and save the group key, he can access to future secrets of group.
+           While re-encrypting, next group key version is encrypted for remaining members.
+
+    RSA columns written before RSA-OAEP are raw RSA, oaep flags tell them apart by
+    RSA_COLUMNS bit, so a tampered record fails instead of being read as a legacy one.
     '''
     __tablename__ = 'user_group_key'
+    # User lookups use the leftmost column of the unique one
+    __table_args__ = (
+        Index('ix_user_group_key_user_id_group_id', 'user_id', 'group_id', unique=True),
+        Index('ix_user_group_key_group_id', 'group_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     group_id = Column(Integer, ForeignKey('group.id'), nullable=False)
     group_name = Column(LargeBinary(512), nullable=False)
     group_key = Column(LargeBinary(512), nullable=False)
+    next_group_key = Column(LargeBinary(512))
+    # Rows of previous versions are legacy raw RSA
+    oaep = Column(Integer, nullable=False, default=0, server_default='0')
 
     user = relationship(User, backref='group_keys')
     group = relationship(Group, backref='group_keys')
 
+    RSA_COLUMNS = ('group_name', 'group_key', 'next_group_key')
+
     # Cache
     _cache_ = dict()
 
     def __init__(self, user, group, group_name, group_key):
         self.user_id = user.id
         self.group_id = group.id
-        self.group_name = user.encrypt(group_name)
-        self.group_key = user.encrypt(group_key)
         self.user = user
         self.group = group
+        self.set_encrypted('group_name', group_name)
+        self.set_encrypted('group_key', group_key)
 
     def __repr__(self):
         return '{} -> {}'.format(self.user, self.group)
@@ -149,11 +246,9 @@ class UserGroupKey(BASE):
         '''
         Decrypt with group key.
         '''
-        group_key = self.user.decrypt(user_pass, self.group_key)
-        key = AES.new(group_key, AES.MODE_CBC, self.group.aes_iv)
-        text = arao_secret.helper.from_bytes(key.decrypt(text_enc))
+        group_key = self.get_key(user_pass)
+        text = self.group.decrypt(group_key, text_enc)
         # Memory clean
-        # TODO : Clean key from memory
         SecureString.clearmem(group_key)
         return text
 
@@ -161,50 +256,168 @@ class UserGroupKey(BASE):
         '''
         Encrypt with group key.
         '''
-        text_bytes = arao_secret.helper.to_bytes(text)
-        group_key = self.user.decrypt(user_pass, self.group_key)
-        key = AES.new(group_key, AES.MODE_CBC, self.group.aes_iv)
-        text_enc = key.encrypt(text_bytes)
+        group_key = self.get_key(user_pass)
+        text_enc = self.group.encrypt(group_key, text)
         # Memory clean
-        # TODO : Clean key from memory
         SecureString.clearmem(group_key)
-        SecureString.clearmem(text_bytes)
         return text_enc
 
+    def get_key(self, user_pass, key_version=None):
+        '''
+        Get clear group key of given version, current one by default.
+        Note: After use it, clean it from memory.
+        '''
+        if isinstance(user_pass, arao_secret.keyring.Keyring):
+            return user_pass.get_group_key(self, key_version)
+        key_enc, oaep = self.get_key_enc(key_version)
+        return self.user.decrypt(user_pass, key_enc, oaep, arao_secret.helper.AES_KEY_SIZE)
+
+    def get_key_enc(self, key_version=None):
+        '''
+        Get group key of given version encrypted for user, current one by default, and if
+        it's RSA-OAEP.
+        Next version is only available while group is re-encrypted.
+        Raises ValueError if user has no key of that version.
+        '''
+        if key_version is None or key_version == self.group.key_version:
+            return self.group_key, self.is_oaep('group_key')
+        if key_version == self.group.key_version + 1 and self.next_group_key is not None:
+            return self.next_group_key, self.is_oaep('next_group_key')
+        raise ValueError('User {} has no key version {} of group {} !'
+                         .format(self.user_id, key_version, self.group_id))
+
+    def get_keys(self, user_pass):
+        '''
+        Get clear group keys by version, next one too while group is re-encrypted.
+        Note: After use them, clean them from memory.
+        '''
+        keys = {self.group.key_version: self.get_key(user_pass)}
+        if self.next_group_key is not None:
+            keys[self.group.key_version + 1] = self.get_key(user_pass, self.group.key_version + 1)
+        return keys
+
+    def get_write_version(self):
+        '''
+        Get group key version for new and updated secrets, next one while re-encrypting.
+        '''
+        return self.group.key_version + (0 if self.next_group_key is None else 1)
+
     def get_clear(self, user_pass):
         '''
         Get clear info from object.
         Note: After use it, call to self.clear()
         '''
         self._cache_['group_id'] = self.group_id
-        self._cache_['group_name'] = arao_secret.helper.from_bytes(
-            self.user.decrypt(user_pass, self.group_name)
-        )
+        self._cache_['group_name'] = arao_secret.helper.from_bytes(self.get_name(user_pass))
         return self._cache_
 
+    def get_name(self, user_pass):
+        '''
+        Get clear group name.
+        Note: After use it, clean it from memory.
+        '''
+        return self.user.decrypt(user_pass, self.group_name, self.is_oaep('group_name'))
+
+    def is_oaep(self, column):
+        '''
+        Check if RSA column is encrypted with RSA-OAEP, legacy raw RSA otherwise.
+        '''
+        return bool((self.oaep or 0) & (1 << self.RSA_COLUMNS.index(column)))
+
+    def set_encrypted(self, column, text):
+        '''
+        Encrypt text for user on given RSA column, with RSA-OAEP.
+        '''
+        setattr(self, column, self.user.encrypt(text))
+        self.oaep = (self.oaep or 0) | (1 << self.RSA_COLUMNS.index(column))
+
     def update(self, group_name):
         '''
         Update object attributes.
         '''
-        self.group_name = self.user.encrypt(group_name)
+        self.set_encrypted('group_name', group_name)
         # Memory clean
         SecureString.clearmem(group_name)
 
 
+class GroupRekey(BASE):
+    '''
+    Group re-encryption in progress, see arao_secret.rekey.
+
+    New group key is the next key version of remaining members (see UserGroupKey),
+    only the user who started it can resume it.
+    '''
+    __tablename__ = 'group_rekey'
+
+    group_id = Column(Integer, ForeignKey('group.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    cipher = Column(String(8), nullable=False)
+    removed = Column(String(512), nullable=False, default='')  # Comma separated user IDs
+    last_secret_id = Column(Integer, nullable=False, default=0)
+
+    user = relationship(User)
+    group = relationship(Group)
+
+    def __init__(self, user, group, cipher, removed):
+        self.group_id = group.id
+        self.user_id = user.id
+        self.cipher = cipher
+        self.removed = ','.join(str(user_id) for user_id in sorted(removed))
+        self.last_secret_id = 0
+        self.user = user
+        self.group = group
+
+    def __repr__(self):
+        return '{} -> {}'.format(self.group, self.last_secret_id)
+
+    def get_removed(self):
+        '''
+        Get IDs of users removed from group.
+        '''
+        return {int(user_id) for user_id in self.removed.split(',') if user_id}
+
+
 class Secret(BASE):
     '''
     Secret data
 
     All data except IDs is encrypted.
+
+    Secrets are saved in one of these formats:
+      * FORMAT_COLUMNS: Legacy, every field encrypted on its own column.
+      * FORMAT_PACKED: All fields packed (see helper.pack) and encrypted once on data column.
+      * FORMAT_PACKED_GCM: As FORMAT_PACKED, but encrypted with AES-GCM (see Group.cipher),
+                           authenticating group and secret IDs, so records can't be moved.
+    All of them are readable, new and updated secrets are always packed.
+
+    Name and URL words are indexed on secret_token table, see SecretToken.
+    Key version is the version of the group key used to encrypt it, see Group.
     '''
     __tablename__ = 'secret'
+    __table_args__ = (
+        Index('ix_secret_group_id_id', 'group_id', 'id'),
+    )
+
+    FIELDS = ('name', 'url', 'login', 'password', 'comment')
+    FORMAT_COLUMNS = 1
+    FORMAT_PACKED = 2
+    FORMAT_PACKED_GCM = 3
+    # AES-GCM associated data: group and secret IDs
+    GCM_AAD = struct.Struct('>QQ')
 
     id = Column(Integer, primary_key=True)
     group_id = Column(Integer, ForeignKey('group.id'), nullable=False)
-    name = Column(LargeBinary(256), nullable=False)
-    url = Column(LargeBinary(512), nullable=False)
-    login = Column(LargeBinary(256), nullable=False)
-    password = Column(LargeBinary(512), nullable=False)
+    record_format = Column(Integer, nullable=False, default=FORMAT_COLUMNS,
+                           server_default=str(FORMAT_COLUMNS))
+    data = Column(LargeBinary(8192))
+    # Increased on every update, for clients caches
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    key_version = Column(Integer, nullable=False, default=1, server_default='1')
+    # Legacy columns, see FORMAT_COLUMNS
+    name = Column(LargeBinary(256))
+    url = Column(LargeBinary(512))
+    login = Column(LargeBinary(256))
+    password = Column(LargeBinary(512))
     comment = Column(LargeBinary(4096))
 
     group = relationship(Group, backref='secrets')
@@ -214,16 +427,80 @@ class Secret(BASE):
 
     def __init__(self, user_pass, user_group_key, name, url, login, password, comment):
         self.group_id = user_group_key.group.id
-        self.name = user_group_key.encrypt(user_pass, name)
-        self.url = user_group_key.encrypt(user_pass, url)
-        self.login = user_group_key.encrypt(user_pass, login)
-        self.password = user_group_key.encrypt(user_pass, password)
-        self.comment = user_group_key.encrypt(user_pass, comment)
         self.group = user_group_key.group
+        if self.group.cipher == Group.CIPHER_GCM:
+            # Record is authenticated with its ID, so it's needed before encryption.
+            # Caller rolls back on failure, so the row is never saved without data
+            db_session = object_session(user_group_key)
+            if db_session is None:
+                raise ValueError('AES-GCM secrets need a DataBase session to get their ID !')
+            db_session.add(self)
+            db_session.flush()
+        self._pack(user_pass, user_group_key, (name, url, login, password, comment))
 
     def __repr__(self):
         return self.id
 
+    def _pack(self, user_pass, user_group_key, texts):
+        '''
+        Save fields packed and encrypted together, with group key version for writes.
+        '''
+        db_session = object_session(user_group_key)
+        if db_session is not None:
+            # Group is locked until commit, so its re-encryption can't finish with this secret
+            # saved with previous key, see arao_secret.rekey. Keys and versions are reloaded by
+            # the same query, they may have changed meanwhile
+            with db_session.no_autoflush:
+                (db_session.query(UserGroupKey)
+                 .join(UserGroupKey.group)
+                 .options(contains_eager(UserGroupKey.group))
+                 .filter(UserGroupKey.id == user_group_key.id)
+                 .with_for_update(read=True, of=Group)
+                 .populate_existing()
+                 .one())
+        self.key_version = user_group_key.get_write_version()
+        group_key = user_group_key.get_key(user_pass, self.key_version)
+        # Name and URL index, before texts are cleaned by packing
+        self.tokens = [SecretToken(self.group_id, token)
+                       for token in sorted(self.index_tokens(group_key, texts[:2]))]
+        self.record_format, self.data = self.encrypt_fields(user_group_key.group, group_key, texts,
+                                                            self.id)
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        # Memory clean
+        SecureString.clearmem(group_key)
+
+    @classmethod
+    def decrypt_fields(cls, group, group_keys, row, fields):
+        '''
+        Decrypt given fields from secret object or query row with clear group keys by version.
+        Packed data is decrypted once and only requested fields are decoded.
+        Raises ValueError if key of secret version is not given.
+        '''
+        clear = dict()
+        data = None
+        if any(field in cls.FIELDS for field in fields):
+            group_key = group_keys.get(row.key_version)
+            if group_key is None:
+                raise ValueError('No group key version {} for secret {} !'
+                                 .format(row.key_version, row.id))
+            if row.record_format == cls.FORMAT_PACKED_GCM:
+                data = arao_secret.helper.aead_decrypt(group_key, row.data,
+                                                       cls.GCM_AAD.pack(group.id, row.id))
+            elif row.record_format == cls.FORMAT_PACKED:
+                data = group.decrypt_bytes(group_key, row.data)
+        for field in fields:
+            if field not in cls.FIELDS:
+                clear[field] = getattr(row, field)
+            elif data is not None:
+                clear[field] = arao_secret.helper.unpack(data, cls.FIELDS.index(field))
+            else:
+                clear[field] = group.decrypt(group_key, getattr(row, field))
+        # Memory clean
+        if data is not None:
+            SecureString.clearmem(data)
+        return clear
+
     def clear(self):
         '''
         Clean object info in memory.
@@ -232,6 +509,33 @@ class Secret(BASE):
             if not isinstance(self._cache_[key], int):
                 SecureString.clearmem(self._cache_[key])
 
+    @classmethod
+    def encrypt_fields(cls, group, group_key, texts, secret_id):
+        '''
+        Pack and encrypt fields texts of given secret with clear group key, following group cipher.
+        Get record format and encrypted data.
+        Note: Given texts are cleaned from memory.
+        '''
+        data = arao_secret.helper.pack(texts)
+        if group.cipher == Group.CIPHER_GCM:
+            data_enc = arao_secret.helper.aead_encrypt(group_key, data,
+                                                       cls.GCM_AAD.pack(group.id, secret_id))
+            SecureString.clearmem(data)
+            return cls.FORMAT_PACKED_GCM, data_enc
+        # Fill out cleans packed data
+        return cls.FORMAT_PACKED, group.encrypt(group_key, data)
+
+    @staticmethod
+    def index_tokens(group_key, texts):
+        '''
+        Get blind index tokens of texts with clear group key.
+        '''
+        index_key = arao_secret.helper.blind_index_key(group_key)
+        tokens = arao_secret.helper.blind_tokens(index_key, texts)
+        # Memory clean
+        SecureString.clearmem(index_key)
+        return tokens
+
     def get_clear(self, user_pass, user_group_key, attribute=None):
         '''
         Get clear info from object.
@@ -240,30 +544,50 @@ class Secret(BASE):
         if attribute:
             LOGGER.info('User %i reading %s from secret %i',
                         user_group_key.user.id, attribute, self.id)
-            if attribute.endswith('id'):
-                self._cache_[attribute] = eval('self.' + attribute)
-            else:
-                self._cache_[attribute] = user_group_key.decrypt(user_pass,
-                                                                 eval('self.' + attribute))
+            fields = (attribute, )
         else:
             LOGGER.info('User %i reading all from secret %i', user_group_key.user.id, self.id)
-            self._cache_['id'] = self.id
-            self._cache_['group_id'] = self.group_id
-            self._cache_['name'] = user_group_key.decrypt(user_pass, self.name)
-            self._cache_['url'] = user_group_key.decrypt(user_pass, self.url)
-            self._cache_['login'] = user_group_key.decrypt(user_pass, self.login)
-            self._cache_['password'] = user_group_key.decrypt(user_pass, self.password)
-            self._cache_['comment'] = user_group_key.decrypt(user_pass, self.comment)
+            fields = ('id', 'group_id') + self.FIELDS
+        group_keys = dict()
+        if any(field in self.FIELDS for field in fields):
+            group_keys = user_group_key.get_keys(user_pass)
+        self._cache_.update(self.decrypt_fields(user_group_key.group, group_keys, self, fields))
+        # Memory clean
+        for group_key in group_keys.values():
+            SecureString.clearmem(group_key)
         return self._cache_
 
     def update(self, user_pass, user_group_key, name, url, login, password, comment):
         '''
         Update object attributes.
         '''
-        self.name = user_group_key.encrypt(user_pass, name)
-        self.url = user_group_key.encrypt(user_pass, url)
-        self.login = user_group_key.encrypt(user_pass, login)
-        self.password = user_group_key.encrypt(user_pass, password)
-        self.comment = user_group_key.encrypt(user_pass, comment)
-        for string in (name, url, login, password, comment):
-            SecureString.clearmem(string)
+        self._pack(user_pass, user_group_key, (name, url, login, password, comment))
+        self.version = (self.version or 1) + 1
+
+
+class SecretToken(BASE):
+    '''
+    Blind index of secret names and URLs.
+
+    Tokens are keyed hashes of normalized words (see helper.blind_tokens), with a key
+    derived from group key, so secrets are searched in SQL without decrypting them.
+    '''
+    __tablename__ = 'secret_token'
+    __table_args__ = (
+        Index('ix_secret_token_group_id_token', 'group_id', 'token'),
+        Index('ix_secret_token_secret_id', 'secret_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    secret_id = Column(Integer, ForeignKey('secret.id'), nullable=False)
+    group_id = Column(Integer, ForeignKey('group.id'), nullable=False)
+    token = Column(LargeBinary(16), nullable=False)
+
+    secret = relationship(Secret, backref=backref('tokens', cascade='all, delete-orphan'))
+
+    def __init__(self, group_id, token):
+        self.group_id = group_id
+        self.token = token
+
+    def __repr__(self):
+        return '{} -> {}'.format(self.secret_id, self.group_id)
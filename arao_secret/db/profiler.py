@@ -0,0 +1,178 @@
+'''
+SQL profiler, queries stats by request.
+
+Engine events time every statement and add it to the profile of current thread,
+if any, see start() and stop(). Statements run many times with different parameters
+in the same profile are reported as repeated, usually lazy loads in a loop (N+1).
+A summary of all profiles is logged every [Profiler] summary_interval seconds.
+
+Usage example:
+
+    arao_secret.db.profiler.start()
+    ...  # Queries
+    profile = arao_secret.db.profiler.stop()
+    print(profile.count, profile.total, profile.get_repeated())
+
+'''
+
+import collections
+import heapq
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+from arao_secret import conf
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Profile of current thread, see start()
+_LOCAL = threading.local()
+
+
+class Profile:
+    '''
+    Queries stats of a request, times in seconds.
+    '''
+    def __init__(self, slowest_size=5, repeat_threshold=3):
+        self.slowest_size = slowest_size
+        self.repeat_threshold = repeat_threshold
+        self.count = 0
+        self.total = 0.0
+        self.slowest = list()  # Heap of (seconds, statement)
+        self.statements = collections.Counter()
+
+    def add(self, statement, seconds):
+        '''
+        Add executed statement.
+        '''
+        self.count += 1
+        self.total += seconds
+        self.statements[statement] += 1
+        if len(self.slowest) < self.slowest_size:
+            heapq.heappush(self.slowest, (seconds, statement))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, statement))
+
+    def get_repeated(self):
+        '''
+        Get statements run at least repeat threshold times and their count, most repeated first.
+        '''
+        return [(statement, count) for statement, count in self.statements.most_common()
+                if count >= self.repeat_threshold]
+
+    def get_slowest(self):
+        '''
+        Get slowest statements and their time, slowest first.
+        '''
+        return sorted(self.slowest, reverse=True)
+
+
+class Summary:
+    '''
+    Stats of all profiles since last flush, logged periodically.
+    '''
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._reset(time.monotonic())
+
+    def _reset(self, now):
+        '''
+        Start a new summary period.
+        '''
+        self.started = now
+        self.profiles = 0
+        self.count = 0
+        self.total = 0.0
+        self.repeated = collections.Counter()
+
+    def add(self, profile):
+        '''
+        Add finished profile, logging summary if interval expired.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            self.profiles += 1
+            self.count += profile.count
+            self.total += profile.total
+            for statement, _ in profile.get_repeated():
+                self.repeated[statement] += 1
+            if now - self.started < self.interval:
+                return
+            profiles, count, total = self.profiles, self.count, self.total
+            repeated = self.repeated.most_common(3)
+            self._reset(now)
+        LOGGER.info('SQL summary: %i requests, %i queries (%.1f by request), %.3fs SQL time',
+                    profiles, count, count / profiles, total)
+        for statement, requests in repeated:
+            LOGGER.info('SQL repeated statement in %i requests: %s', requests, statement)
+
+
+_SUMMARY = Summary(conf.get('Profiler', 'summary_interval', int, fallback=60))
+
+
+def _before_cursor_execute(connection, *_):
+    '''
+    Save statement start time.
+    '''
+    connection.info.setdefault('profiler_start', list()).append(time.monotonic())
+
+
+def _after_cursor_execute(connection, cursor, statement, *_):
+    '''
+    Add statement to profile of current thread.
+    '''
+    start = connection.info['profiler_start'].pop()
+    profile = getattr(_LOCAL, 'profile', None)
+    if profile is not None:
+        profile.add(statement, time.monotonic() - start)
+
+
+def _handle_error(context):
+    '''
+    Discard start time of failed statement.
+    '''
+    if context.connection is not None and context.connection.info.get('profiler_start'):
+        context.connection.info['profiler_start'].pop()
+
+
+def install(engine):
+    '''
+    Time engine statements.
+    '''
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+def is_enabled():
+    '''
+    Check if profiler is enabled by configuration.
+    '''
+    return conf.get('Profiler', 'enabled', bool, fallback=False)
+
+
+def start():
+    '''
+    Start profile of current thread.
+    '''
+    _LOCAL.profile = Profile(conf.get('Profiler', 'slowest', int, fallback=5),
+                             conf.get('Profiler', 'repeat_threshold', int, fallback=3))
+
+
+def stop():
+    '''
+    Stop profile of current thread and get it, None if not started.
+    Repeated statements are logged and profile is added to summary.
+    '''
+    profile = getattr(_LOCAL, 'profile', None)
+    _LOCAL.profile = None
+    if profile is None:
+        return None
+    for statement, count in profile.get_repeated():
+        LOGGER.warning('SQL statement repeated %i times, N+1 ?: %s', count, statement)
+    _SUMMARY.add(profile)
+    return profile
@@ -0,0 +1,147 @@
+'''
+Process pool for CPU bound crypto work.
+
+RSA operations hold the GIL of the web worker, so one heavy user blocks everyone else
+in the same process. When enabled by configuration, they run in a process pool sized
+to the cores instead.
+
+Only key generation is sent to the pool: new keys are protected with the master password
+in the worker, so that password is pickled through the worker pipe (local, never on disk),
+while clear private keys never leave the worker. Private keys of logged users, their
+imports and decryptions stay in the web process, where they are cached by the session
+keyring (see arao_secret.keyring), as sending them to workers would expose them too.
+Public key encryption is cheaper than sending its clear input, so it runs inline.
+Workers are started by a fork server, so the pool is safe to use from threads.
+'''
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from Crypto import Random
+from Crypto.PublicKey import RSA
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Process executor, see get_executor()
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def _init_worker():
+    '''
+    Worker process initialization.
+    '''
+    # Needed by PyCrypto after fork
+    Random.atfork()
+
+
+# Tasks, they must be module functions to be sent to worker processes
+
+def rsa_generate(bits, passphrase):
+    '''
+    Generate RSA key, get private key protected by passphrase and public key.
+    '''
+    rsa_key = RSA.generate(bits)
+    return rsa_key.exportKey(passphrase=passphrase), rsa_key.publickey().exportKey()
+
+
+class CryptoExecutor:
+    '''
+    Process pool with queue depth and latency stats.
+    '''
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.pid = os.getpid()
+        self.pending = 0
+        self.completed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context('forkserver'),
+            initializer=_init_worker
+        )
+        self._lock = threading.Lock()
+
+    def _done(self, start):
+        '''
+        Get callback to update stats when task finishes.
+        '''
+        def callback(_):
+            latency = time.monotonic() - start
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+        return callback
+
+    def result(self, future, timeout=None):
+        '''
+        Await task result.
+        '''
+        return future.result(timeout)
+
+    def run(self, function, *args, timeout=None):
+        '''
+        Submit task and await its result.
+        '''
+        return self.result(self.submit(function, *args), timeout)
+
+    def shutdown(self, wait=True):
+        '''
+        Stop worker processes.
+        '''
+        self._pool.shutdown(wait)
+
+    def stats(self):
+        '''
+        Get executor counters, latencies in seconds since submission.
+        '''
+        with self._lock:
+            return {'workers': self.workers, 'pending': self.pending, 'completed': self.completed,
+                    'latency_avg': self.latency_total / self.completed if self.completed else 0.0,
+                    'latency_max': self.latency_max}
+
+    def submit(self, function, *args):
+        '''
+        Submit task, get its future.
+        '''
+        with self._lock:
+            self.pending += 1
+        callback = self._done(time.monotonic())
+        future = self._pool.submit(function, *args)
+        future.add_done_callback(callback)
+        return future
+
+
+def get_executor():
+    '''
+    Get process executor, None if disabled by configuration.
+    '''
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if not arao_secret.conf.get('Crypto', 'executor', bool, fallback=False):
+            return None
+        # Pools don't survive fork, so uwsgi workers create their own one
+        if _EXECUTOR is None or _EXECUTOR.pid != os.getpid():
+            _EXECUTOR = CryptoExecutor(arao_secret.conf.get('Crypto', 'workers', int,
+                                                            fallback=None))
+            LOGGER.info('Crypto executor started with %i workers', _EXECUTOR.workers)
+        return _EXECUTOR
+
+
+def run(function, *args, timeout=None):
+    '''
+    Run task in process executor, or inline if executor is disabled.
+    '''
+    executor = get_executor()
+    if executor is None:
+        return function(*args)
+    return executor.run(function, *args, timeout=timeout)
@@ -3,8 +3,14 @@ Common functions.
 '''
 
 import hashlib
+import hmac
+import re
+import struct
+import unicodedata
 
 from Crypto.Cipher import AES
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Util import number
 from Crypto import Random
 import SecureString
 
@@ -15,6 +21,55 @@ import arao_secret
 hashlib.sha3_512 = hashlib.sha3_512
 SecureString.clearmem = SecureString.clearmem
 
+# Packed texts format version, see pack()
+PACK_VERSION = 1
+
+# Blind index, see blind_tokens()
+BLIND_INDEX_INFO = b'AraoSecret blind index'
+BLIND_INDEX_STOP_WORDS = {'http', 'https', 'www'}
+BLIND_TOKEN_SIZE = 16
+
+# AES-GCM, available on PyCryptodome, not on PyCrypto 2.6.1
+AEAD_AVAILABLE = hasattr(AES, 'MODE_GCM')
+AEAD_NONCE_SIZE = 12
+AEAD_TAG_SIZE = 16
+
+AES_KEY_SIZE = 32
+
+
+def aead_decrypt(key, data_enc, associated_data=None):
+    '''
+    Decrypt and verify AES-GCM record from aead_encrypt().
+    Raises ValueError if record was modified.
+    '''
+    nonce = data_enc[:AEAD_NONCE_SIZE]
+    tag = data_enc[-AEAD_TAG_SIZE:]
+    cipher = AES.new(key, AES.MODE_GCM, nonce)
+    if associated_data:
+        cipher.update(associated_data)
+    data = cipher.decrypt(data_enc[AEAD_NONCE_SIZE:-AEAD_TAG_SIZE])
+    try:
+        cipher.verify(tag)
+    except ValueError:
+        SecureString.clearmem(data)
+        raise
+    # TODO : Clear cipher
+    return data
+
+
+def aead_encrypt(key, data, associated_data=None):
+    '''
+    Encrypt with AES-GCM, random nonce per record and no fill out.
+    Record is nonce + ciphertext + tag.
+    '''
+    nonce = Random.new().read(AEAD_NONCE_SIZE)
+    cipher = AES.new(key, AES.MODE_GCM, nonce)
+    if associated_data:
+        cipher.update(associated_data)
+    data_enc = cipher.encrypt(data)
+    # TODO : Clear cipher
+    return nonce + data_enc + cipher.digest()
+
 
 def aes_iv_gen():
     '''
@@ -27,7 +82,27 @@ def aes_key_gen():
     '''
     Generate key for AES.
     '''
-    return Random.new().read(32)
+    return Random.new().read(AES_KEY_SIZE)
+
+
+def blind_index_key(group_key):
+    '''
+    Derive blind index key from group key, so tokens don't reveal the group key.
+    Note: After use it, clean it from memory.
+    '''
+    return hmac.new(group_key, BLIND_INDEX_INFO, hashlib.sha256).digest()
+
+
+def blind_tokens(index_key, texts):
+    '''
+    Get blind index tokens, keyed hashes of every normalized word in texts.
+    '''
+    tokens = set()
+    for text in texts:
+        for word in normalize_words(text):
+            tokens.add(hmac.new(index_key, word.encode(arao_secret.ENCODING),
+                                hashlib.sha256).digest()[:BLIND_TOKEN_SIZE])
+    return tokens
 
 
 def cleaned(text):
@@ -41,8 +116,11 @@ def cleaned(text):
 
 def decrypt_from_session(pass_enc):
     '''
-    Decrypt password from memory by session key.
+    Decrypt password from memory by session key, key agent one if configured.
     '''
+    client = arao_secret.agent.get_client()
+    if client is not None:
+        return client.decrypt(pass_enc)
     key = AES.new(arao_secret.APP_KEY['aes_key'], AES.MODE_CBC, arao_secret.APP_KEY['aes_iv'])
     # TODO : Clear key
     return key.decrypt(pass_enc)
@@ -50,13 +128,16 @@ def decrypt_from_session(pass_enc):
 
 def encrypt_for_session(password):
     '''
-    Encrypt password into memory by session key.
+    Encrypt password into memory by session key, key agent one if configured.
     '''
+    client = arao_secret.agent.get_client()
+    if client is not None:
+        return client.encrypt(fill_out_to_mod_16(password))
     key = AES.new(arao_secret.APP_KEY['aes_key'], AES.MODE_CBC, arao_secret.APP_KEY['aes_iv'])
     pass_fill = fill_out_to_mod_16(password)
-    pass_enc = key.encrypt(password)
+    pass_enc = key.encrypt(pass_fill)
     # TODO : Clear key
-    SecureString.clearmem(password)
+    SecureString.clearmem(pass_fill)
     return pass_enc
 
 
@@ -103,6 +184,89 @@ def get_pass_hash(password):
     return hashlib.sha3_512(password).digest()
 
 
+def normalize_words(text):
+    '''
+    Get searchable words from text: lower case, without accents nor URL noise.
+    '''
+    if not text:
+        return set()
+    if isinstance(text, bytes):
+        text = text.decode(arao_secret.ENCODING)
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return {word for word in re.findall(r'\w+', text) if word not in BLIND_INDEX_STOP_WORDS}
+
+
+def pack(texts):
+    '''
+    Pack texts into a single buffer, so they can be encrypted together.
+
+    Buffer starts with format version, number of texts and length of every text,
+    so any text can be read without decoding the others.
+    Note: Given texts are cleaned from memory.
+    '''
+    parts = list()
+    for text in texts:
+        if text is None:
+            part = b''
+        elif isinstance(text, bytes):
+            part = text
+        else:
+            part = text.encode(arao_secret.ENCODING)
+            # Clear memory of previous object, single characters are shared by the interpreter
+            if len(text) > 1:
+                SecureString.clearmem(text)
+        parts.append(part)
+    header = struct.pack('>BB{}I'.format(len(parts)), PACK_VERSION, len(parts),
+                         *[len(part) for part in parts])
+    data = b''.join([header] + parts)
+    # Clear memory of previous objects, but shared single bytes
+    for part in parts:
+        if len(part) > 1:
+            SecureString.clearmem(part)
+    return data
+
+
+def rsa_decrypt(rsa_key, text_enc, oaep=True, size=None):
+    '''
+    Decrypt with imported RSA private key, RSA-OAEP or legacy raw RSA records.
+    Legacy texts are unpadded to given size, or without leading zeros if not given.
+    Note: After use it, clean it from memory.
+    '''
+    if oaep:
+        return PKCS1_OAEP.new(rsa_key).decrypt(text_enc)
+    # Raw RSA records saved before OAEP, not public on PyCryptodome but on both libraries.
+    # Padded to modulus length, so texts starting with zeros (keys) keep them
+    # pylint: disable=W0212
+    text = number.long_to_bytes(rsa_key._decrypt(number.bytes_to_long(text_enc)),
+                                (int(rsa_key.n).bit_length() + 7) // 8)
+    result = text[-size:] if size else text.lstrip(b'\x00')
+    # Clear memory of previous object
+    if result is not text:
+        SecureString.clearmem(text)
+    return result
+
+
+def rsa_encrypt(rsa_key_pub, text):
+    '''
+    Encrypt with imported RSA public key, RSA-OAEP.
+    '''
+    return PKCS1_OAEP.new(rsa_key_pub).encrypt(text)
+
+
+def unpack(data, index):
+    '''
+    Get text from packed buffer by index, decoding only that text.
+    '''
+    version, count = struct.unpack_from('>BB', data)
+    if version != PACK_VERSION:
+        raise ValueError('Unknown packed format version {} !'.format(version))
+    lengths = struct.unpack_from('>{}I'.format(count), data, 2)
+    start = 2 + 4 * count + sum(lengths[:index])
+    with memoryview(data) as view:
+        return str(view[start:start + lengths[index]], arao_secret.ENCODING)
+
+
 def to_bytes(text):
     '''
     Convert string to bytes.
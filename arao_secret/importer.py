@@ -0,0 +1,260 @@
+'''
+Bulk import of secrets from CSV and KeePass XML files.
+
+Files are read incrementally, group key is unwrapped once, every chunk of records gets
+its row IDs by inserting placeholders (single statement where supported), is encrypted by
+worker processes and saved with a single update, in one short transaction per chunk, so
+memory use doesn't depend on file size.
+
+CSV files need a header row, columns are matched by name (KeePass and browsers
+exports names are known), unknown columns are ignored.
+KeePass XML files are KeePass 2 exports (not encrypted), entries history is ignored.
+
+Usage example:
+
+    python3 -m arao_secret.importer --alias admin --group 3 vault.csv
+    python3 -m arao_secret.importer --alias admin --group 3 --format keepass vault.xml
+
+'''
+
+import argparse
+import csv
+import getpass
+import itertools
+import logging
+import math
+import sys
+import xml.etree.ElementTree
+
+import sqlalchemy
+import SecureString
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+FIELDS = arao_secret.db.model.Secret.FIELDS
+
+# CSV columns names by secret field, lower case
+CSV_COLUMNS = {
+    'name': ('name', 'title', 'account'),
+    'url': ('url', 'web site', 'website', 'login_uri'),
+    'login': ('login', 'username', 'user name', 'login_username'),
+    'password': ('password', 'login_password'),
+    'comment': ('comment', 'comments', 'notes', 'extra'),
+}
+
+# KeePass entry strings by secret field
+KEEPASS_KEYS = {
+    'Title': 'name',
+    'URL': 'url',
+    'UserName': 'login',
+    'Password': 'password',
+    'Notes': 'comment',
+}
+
+
+def read_csv(stream):
+    '''
+    Get secret fields dictionaries from CSV file, one by row.
+    '''
+    reader = csv.reader(stream)
+    header = [column.strip().lower() for column in next(reader, [])]
+    indexes = dict()
+    for field, names in CSV_COLUMNS.items():
+        for name in names:
+            if name in header:
+                indexes[field] = header.index(name)
+                break
+    if 'name' not in indexes:
+        raise ValueError('CSV file has no name column !')
+    for row in reader:
+        if not any(row):
+            continue
+        yield {field: row[index] if index < len(row) else ''
+               for field, index in indexes.items()}
+
+
+def read_keepass(stream):
+    '''
+    Get secret fields dictionaries from KeePass 2 XML file, one by entry.
+    '''
+    history = 0
+    for event, element in xml.etree.ElementTree.iterparse(stream, events=('start', 'end')):
+        if element.tag == 'History':
+            history += 1 if event == 'start' else -1
+        elif event == 'end' and element.tag == 'Entry':
+            if not history:
+                record = dict()
+                for string in element.iterfind('String'):
+                    field = KEEPASS_KEYS.get(string.findtext('Key'))
+                    if field:
+                        record[field] = string.findtext('Value') or ''
+                yield record
+            # Parsed entries are not kept in memory
+            element.clear()
+
+
+READERS = {
+    'csv': read_csv,
+    'keepass': read_keepass,
+}
+
+
+def encrypt_chunk(group_id, group_key, aes_iv, cipher, ids, records):
+    '''
+    Encrypt secret records with their row IDs, worker process task.
+    Get ID, record format, encrypted data and blind index tokens for every record.
+    '''
+    group = arao_secret.db.model.Group(cipher)
+    group.id = group_id
+    group.aes_iv = aes_iv
+    result = list()
+    for secret_id, record in zip(ids, records):
+        texts = [record.get(field) or '' for field in FIELDS]
+        # Index before texts are cleaned by packing
+        tokens = arao_secret.db.model.Secret.index_tokens(group_key, texts[:2])
+        record_format, data = arao_secret.db.model.Secret.encrypt_fields(group, group_key, texts,
+                                                                         secret_id)
+        result.append((secret_id, record_format, data, tokens))
+    return result
+
+
+def _insert_chunk(db_session, group_id, key_version, count):
+    '''
+    Insert placeholder rows of a chunk, get their IDs in order.
+    Rows are inserted by a single statement returning their IDs where supported (PostgreSQL,
+    and SQLite >= 3.35 with SQLAlchemy 2), one by one otherwise. Placeholders have no data,
+    it's set before commit.
+    Raises RuntimeError if group key version was replaced by a re-encryption.
+    '''
+    group = arao_secret.db.model.Group
+    # Group is locked until commit, so its re-encryption can't finish meanwhile,
+    # and chunks saved with previous key before it finishes are re-encrypted by it
+    group_version = (db_session.query(group.key_version)
+                     .filter(group.id == group_id)
+                     .with_for_update(read=True)
+                     .scalar())
+    if group_version not in (key_version, key_version - 1):
+        raise RuntimeError('Group {} was re-encrypted while importing !'.format(group_id))
+    table = arao_secret.db.model.Secret.__table__
+    values = {'group_id': group_id, 'key_version': key_version,
+              'record_format': arao_secret.db.model.Secret.FORMAT_PACKED}
+    dialect = db_session.get_bind().dialect
+    returning = getattr(dialect, 'insert_returning', None)
+    if returning is None:
+        returning = dialect.full_returning
+    if returning:
+        result = db_session.execute(table.insert().values([values] * count)
+                                    .returning(table.c.id))
+        # Placeholders are equal, so any order is valid, sorted keeps records order
+        return sorted(secret_id for secret_id, in result)
+    return [db_session.execute(table.insert().values(values)).inserted_primary_key[0]
+            for _ in range(count)]
+
+
+def _save_chunk(db_session, group_id, rows):
+    '''
+    Save encrypted rows and their blind index, committing the chunk transaction.
+    '''
+    mappings = list()
+    tokens = list()
+    for secret_id, record_format, data, secret_tokens in rows:
+        mappings.append({'id': secret_id, 'record_format': record_format, 'data': data})
+        tokens.extend({'secret_id': secret_id, 'group_id': group_id, 'token': token}
+                      for token in secret_tokens)
+    db_session.bulk_update_mappings(arao_secret.db.model.Secret, mappings)
+    db_session.bulk_insert_mappings(arao_secret.db.model.SecretToken, tokens)
+    db_session.commit()
+
+
+def _clear(records):
+    '''
+    Clean records texts from memory.
+    '''
+    for record in records:
+        for value in record.values():
+            # Single characters are strings shared by the interpreter, missing values are None
+            if value is not None and len(value) > 1:
+                SecureString.clearmem(value)
+
+
+def import_secrets(db_session, user_group_key, keyring, records, chunk_size=500, workers=None,
+                   progress=None):
+    '''
+    Encrypt and save secret records (fields dictionaries) on group of given user group key.
+    Progress is called with the number of imported secrets after every chunk.
+    Get the number of imported secrets.
+    '''
+    group = user_group_key.group
+    key_version = user_group_key.get_write_version()
+    group_key = user_group_key.get_key(keyring, key_version)
+    records = iter(records)
+    imported = 0
+    executor = arao_secret.executor.CryptoExecutor(workers)
+    chunk = list(itertools.islice(records, chunk_size))
+    next_chunk = list()
+    try:
+        while chunk:
+            ids = _insert_chunk(db_session, group.id, key_version, len(chunk))
+            # Chunk is split between workers, next one is read meanwhile
+            size = math.ceil(len(chunk) / executor.workers)
+            futures = [executor.submit(encrypt_chunk, group.id, group_key, group.aes_iv,
+                                       group.cipher, ids[start:start + size],
+                                       chunk[start:start + size])
+                       for start in range(0, len(chunk), size)]
+            next_chunk = list(itertools.islice(records, chunk_size))
+            rows = list(itertools.chain.from_iterable(future.result() for future in futures))
+            # Records were sent to workers, so they can be cleaned now
+            _clear(chunk)
+            _save_chunk(db_session, group.id, rows)
+            imported += len(rows)
+            LOGGER.info('Imported %i secrets into group %i', imported, group.id)
+            if progress:
+                progress(imported)
+            chunk, next_chunk = next_chunk, list()
+    except Exception:
+        # Placeholder rows of current chunk must not be committed later
+        db_session.rollback()
+        raise
+    finally:
+        executor.shutdown()
+        _clear(chunk)
+        _clear(next_chunk)
+        # Memory clean
+        SecureString.clearmem(group_key)
+    return imported
+
+
+def parse_arguments(argv):
+    '''
+    Arguments parser.
+    '''
+    parser = argparse.ArgumentParser(description='AraoSecret secrets import')
+    parser.add_argument('--alias', type=str, required=True, help='Alias of group member.')
+    parser.add_argument('--group', type=int, required=True, help='Group ID.')
+    parser.add_argument('--format', type=str, choices=sorted(READERS), default='csv',
+                        help='File format.')
+    parser.add_argument('--chunk-size', type=int, default=500, help='Secrets by chunk.')
+    parser.add_argument('--workers', type=int, help='Worker processes, one per core by default.')
+    parser.add_argument('path', type=str, help='File to import.')
+    return parser.parse_args(argv[1:])
+
+
+if __name__ == '__main__':
+    ARGS = parse_arguments(sys.argv)
+    DB_SESSION = arao_secret.db.create_session()
+    MANAGER = arao_secret.manager.get_user(DB_SESSION, ARGS.alias, getpass.getpass())
+    # XML declares its own encoding
+    if ARGS.format == 'keepass':
+        STREAM = open(ARGS.path, 'rb')
+    else:
+        STREAM = open(ARGS.path, newline='', encoding=arao_secret.ENCODING)
+    with STREAM:
+        TOTAL = MANAGER.import_secrets(DB_SESSION, ARGS.group, READERS[ARGS.format](STREAM),
+                                       chunk_size=ARGS.chunk_size, workers=ARGS.workers,
+                                       progress=lambda count: print('{} secrets imported'
+                                                                    .format(count)))
+    MANAGER.logout()
+    print('Import finished: {} secrets'.format(TOTAL))
@@ -0,0 +1,56 @@
+'''
+Blind index of secrets saved before it existed, needed once after upgrading DataBase schema
+to version 3, see arao_secret.manager.UserManager.search_secrets().
+
+Tokens are HMACs of whole words, so they are computed with group keys and only members can
+index a group. Already indexed secrets are skipped, so it can be run again safely.
+
+Usage example:
+
+    python3 -m arao_secret.indexer --alias admin               # All groups of user
+    python3 -m arao_secret.indexer --alias admin --group 3
+
+'''
+
+import argparse
+import getpass
+import logging
+import sys
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def index_groups(db_session, manager, group_ids=None):
+    '''
+    Index secrets of given groups, all user groups by default.
+    '''
+    if group_ids is None:
+        group_key = arao_secret.db.model.UserGroupKey
+        group_ids = [row.group_id for row in (db_session.query(group_key.group_id)
+                                              .filter(group_key.user_id == manager.user.id)
+                                              .order_by(group_key.group_id))]
+    for group_id in group_ids:
+        LOGGER.info('Indexing group %i', group_id)
+        manager.index_group(db_session, group_id)
+
+
+def parse_arguments(argv):
+    '''
+    Arguments parser.
+    '''
+    parser = argparse.ArgumentParser(description='AraoSecret secrets blind index')
+    parser.add_argument('--alias', type=str, required=True, help='Alias of group member.')
+    parser.add_argument('--group', type=int, nargs='*',
+                        help='Group IDs, all groups of user by default.')
+    return parser.parse_args(argv[1:])
+
+
+if __name__ == '__main__':
+    ARGS = parse_arguments(sys.argv)
+    DB_SESSION = arao_secret.db.create_session()
+    MANAGER = arao_secret.manager.get_user(DB_SESSION, ARGS.alias, getpass.getpass())
+    index_groups(DB_SESSION, MANAGER, ARGS.group)
+    MANAGER.logout()
@@ -0,0 +1,126 @@
+'''
+Pool of pre-generated RSA keys for new users.
+
+RSA 4096 bits generation takes seconds of CPU, so background worker processes keep
+fresh keys ready and user registration doesn't have to wait for them.
+
+Forking from a threaded process is unsafe, so pool must be started by get_pool() when
+the application is created, before serving requests; take() never starts it.
+'''
+
+import logging
+import multiprocessing
+import queue
+import threading
+
+from Crypto import Random
+from Crypto.PublicKey import RSA
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+RSA_BITS = 4096
+
+# Process pool, see get_pool()
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _generate(keys, bits):
+    '''
+    Worker process, keep keys queue full.
+    '''
+    # Needed by PyCrypto after fork
+    Random.atfork()
+    while True:
+        keys.put(RSA.generate(bits).exportKey())
+
+
+class KeyPool:
+    '''
+    Fresh RSA keys generated by background worker processes.
+    '''
+    def __init__(self, depth, workers=1, bits=RSA_BITS):
+        self.depth = depth
+        self.workers = workers
+        self.bits = bits
+        self.taken = 0
+        self.exhausted = 0
+        self._keys = multiprocessing.Queue(depth)
+        self._processes = list()
+        self._lock = threading.Lock()
+
+    def start(self):
+        '''
+        Start worker processes.
+        '''
+        for _ in range(self.workers):
+            process = multiprocessing.Process(target=_generate, args=(self._keys, self.bits),
+                                              daemon=True)
+            process.start()
+            self._processes.append(process)
+        LOGGER.info('RSA key pool started, depth %i, %i workers', self.depth, self.workers)
+
+    def stats(self):
+        '''
+        Get pool counters.
+        '''
+        try:
+            size = self._keys.qsize()
+        except NotImplementedError:  # macOS
+            size = None
+        with self._lock:
+            return {'depth': self.depth, 'size': size, 'taken': self.taken,
+                    'exhausted': self.exhausted}
+
+    def stop(self):
+        '''
+        Stop worker processes.
+        '''
+        for process in self._processes:
+            process.terminate()
+        self._processes = list()
+
+    def take(self):
+        '''
+        Get a fresh RSA key, None if pool is empty.
+        '''
+        try:
+            key_pem = self._keys.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.exhausted += 1
+            LOGGER.warning('RSA key pool exhausted !')
+            return None
+        with self._lock:
+            self.taken += 1
+        return RSA.importKey(key_pem)
+
+
+def get_pool():
+    '''
+    Get process key pool, starting it if needed, None if disabled by configuration.
+    Note: Call it at application start, not from request threads.
+    '''
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            depth = arao_secret.conf.get('KeyPool', 'depth', int, fallback=0)
+            if depth <= 0:
+                return None
+            _POOL = KeyPool(depth, arao_secret.conf.get('KeyPool', 'workers', int, fallback=1))
+            _POOL.start()
+        return _POOL
+
+
+def take():
+    '''
+    Get a fresh RSA key from process pool, None if pool is not started or empty.
+    '''
+    with _POOL_LOCK:
+        pool = _POOL
+    if pool is None:
+        return None
+    return pool.take()
@@ -0,0 +1,179 @@
+'''
+User session keyring.
+'''
+
+import logging
+import os
+import threading
+import time
+import weakref
+
+from Crypto.PublicKey import RSA
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Unlocked keyrings of this process, locked by reaper thread when idle, see _reap()
+_UNLOCKED = weakref.WeakSet()
+_UNLOCKED_LOCK = threading.Lock()
+_REAPER_PID = None
+_REAPER_LOCK = threading.Lock()
+
+
+class KeyringLocked(Exception):
+    '''
+    Keyring must be unlocked with master password before use it.
+    '''
+
+
+def _reap_once():
+    '''
+    Lock keyrings whose idle timeout expired, even if they are not used again.
+    '''
+    # Request threads unlock and lock keyrings meanwhile
+    with _UNLOCKED_LOCK:
+        keyrings = list(_UNLOCKED)
+    for keyring in keyrings:
+        try:
+            keyring.is_locked()
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Keyring of user %i not locked by reaper', keyring.user.id)
+
+
+def _reap(interval):
+    '''
+    Reaper thread, see _reap_once().
+    '''
+    while True:
+        time.sleep(interval)
+        _reap_once()
+
+
+def _start_reaper():
+    '''
+    Start reaper thread of this process if not started yet.
+    '''
+    global _REAPER_PID
+    with _REAPER_LOCK:
+        # Threads don't survive fork, so uwsgi workers start their own one
+        if _REAPER_PID != os.getpid():
+            interval = arao_secret.conf.get('Session', 'idle_check_interval', int, fallback=60)
+            threading.Thread(target=_reap, args=(interval, ), name='keyring-reaper',
+                             daemon=True).start()
+            _REAPER_PID = os.getpid()
+
+
+class Keyring:
+    '''
+    User RSA private key, imported once per session.
+
+    Importing the passphrase protected key is the expensive part of every decryption,
+    so we import it once at login and keep the key object until logout or idle timeout.
+    Idle keyrings are locked by a reaper thread, and once locked the master password
+    is needed again, see on_lock.
+    Note: Key object is removed from memory, but Python integers can't be cleaned.
+
+    If group_keys cache is given, unwrapped group keys are kept there by group ID and key
+    version, offuscated by application key, so each group pays a single RSA decryption.
+    on_lock is called when an unlocked keyring is locked, by logout or idle timeout.
+    '''
+    def __init__(self, user, idle_timeout=None, group_keys=None, on_lock=None):
+        self.user = user
+        self.group_keys = group_keys
+        self.on_lock = on_lock
+        if idle_timeout is None:
+            idle_timeout = arao_secret.conf.get('Session', 'idle_timeout', int, fallback=900)
+        self.idle_timeout = idle_timeout
+        self._rsa_key = None
+        self._last_use = None
+        self._lock = threading.RLock()
+
+    def _get_rsa_key(self):
+        '''
+        Get imported private key, updating last use.
+        '''
+        with self._lock:
+            if self.is_locked():
+                raise KeyringLocked('Keyring of user {} is locked !'.format(self.user.id))
+            self._last_use = time.monotonic()
+            return self._rsa_key
+
+    def decrypt(self, text_enc, oaep=True, size=None):
+        '''
+        Decrypt with user private key, see helper.rsa_decrypt().
+        '''
+        return arao_secret.helper.rsa_decrypt(self._get_rsa_key(), text_enc, oaep, size)
+
+    def get_group_key(self, user_group_key, key_version=None):
+        '''
+        Get clear group key of given version, current one by default.
+        Note: After use it, clean it from memory.
+        '''
+        key_enc_user, oaep = user_group_key.get_key_enc(key_version)
+        if self.group_keys is None:
+            return self.decrypt(key_enc_user, oaep, arao_secret.helper.AES_KEY_SIZE)
+        if key_version is None:
+            key_version = user_group_key.group.key_version
+        rsa_key = self._get_rsa_key()
+        # By version, so keys replaced by re-encryption are never used again
+        cache_key = (user_group_key.group_id, key_version)
+        # Evicted keys are cleaned, so they are decrypted before they can leave the cache
+        group_key = self.group_keys.apply(cache_key, arao_secret.helper.decrypt_from_session)
+        if group_key is not None:
+            return group_key
+        # RSA runs unlocked, threads of the same user (async front ends) don't wait
+        key_enc = arao_secret.helper.encrypt_for_session(
+            arao_secret.helper.rsa_decrypt(rsa_key, key_enc_user, oaep,
+                                           arao_secret.helper.AES_KEY_SIZE)
+        )
+        group_key = arao_secret.helper.decrypt_from_session(key_enc)
+        with self._lock:
+            # Not cached again if keyring was locked meanwhile
+            if self._rsa_key is rsa_key:
+                self.group_keys.set(cache_key, key_enc)
+        return group_key
+
+    def is_locked(self):
+        '''
+        Check if keyring is locked, locking it when idle timeout expired.
+        '''
+        with self._lock:
+            if self._rsa_key is None:
+                return True
+            if time.monotonic() - self._last_use > self.idle_timeout:
+                LOGGER.info('Keyring of user %i locked by idle timeout', self.user.id)
+                self.lock()
+                return True
+            return False
+
+    def lock(self):
+        '''
+        Remove private key and cached group keys from memory.
+        '''
+        with self._lock:
+            unlocked = self._rsa_key is not None
+            if self.group_keys is not None:
+                self.group_keys.clear()
+            self._rsa_key = None
+            self._last_use = None
+            with _UNLOCKED_LOCK:
+                _UNLOCKED.discard(self)
+        if unlocked and self.on_lock:
+            self.on_lock()
+
+    def unlock(self, password, rsa_key=None):
+        '''
+        Import user private key with his master password.
+        If the imported key is given (new users), it's kept without importing it again.
+        Note: Master password is not cleaned, caller is the owner.
+        '''
+        if rsa_key is None:
+            rsa_key = RSA.importKey(self.user.rsa_key, passphrase=password)
+        with self._lock:
+            self._rsa_key = rsa_key
+            self._last_use = time.monotonic()
+            with _UNLOCKED_LOCK:
+                _UNLOCKED.add(self)
+        _start_reaper()
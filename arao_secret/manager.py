@@ -14,49 +14,255 @@ Usage example:
 
 '''
 
+import base64
+import binascii
+import hashlib
+import logging
+import secrets
+import struct
+import threading
+import time
+
 import SecureString
+import sqlalchemy
 
 import arao_secret
 
 
+LOGGER = logging.getLogger(__name__)
+
+
+# Secrets by page, see UserManager.list_secrets_page()
+PAGE_SIZE = 50
+PAGE_SIZE_MAX = 500
+
+# Pages cursor, last secret ID of previous page
+_CURSOR = struct.Struct('>Q')
+
+# Process session registry, see get_registry()
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def encode_cursor(secret_id):
+    '''
+    Get opaque page cursor from last secret ID of a page.
+    '''
+    return base64.urlsafe_b64encode(_CURSOR.pack(secret_id)).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Get last secret ID of previous page from cursor.
+    '''
+    try:
+        return _CURSOR.unpack(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))[0]
+    except (binascii.Error, struct.error, TypeError):
+        raise ValueError('Invalid page cursor !')
+
+
+def get_etag(rows):
+    '''
+    Get entity tag from query rows of IDs, versions and encrypted columns, without decrypting.
+    '''
+    digest = hashlib.sha256()
+    for row in rows:
+        for value in row:
+            if value is None:
+                value = b''
+            elif not isinstance(value, bytes):
+                value = str(value).encode('ascii')
+            digest.update(struct.pack('>I', len(value)) + value)
+    return digest.hexdigest()[:32]
+
+
+def get_groups_etag(db_session, user_id):
+    '''
+    Get entity tag of user groups, see UserManager.get_group_names().
+    Entity tags don't need user credentials, so they are checked before restoring them.
+    '''
+    group_key = arao_secret.db.model.UserGroupKey
+    return get_etag(db_session.query(group_key.id, group_key.group_id, group_key.group_name,
+                                     group_key.group_key)
+                    .filter(group_key.user_id == user_id)
+                    .order_by(group_key.group_id))
+
+
+def get_secret_etag(db_session, user_id, secret_id):
+    '''
+    Get entity tag of secret, see UserManager.get_secret().
+    Raises NoResultFound if secret is not found in user groups.
+    '''
+    secret = arao_secret.db.model.Secret
+    group_key = arao_secret.db.model.UserGroupKey
+    columns = [secret.id, secret.version, secret.record_format, secret.data]
+    row = (db_session.query(*columns + [getattr(secret, field) for field in secret.FIELDS]
+                            + [group_key.group_key])
+           .join(group_key, group_key.group_id == secret.group_id)
+           .filter(secret.id == secret_id)
+           .filter(group_key.user_id == user_id)
+           .one())
+    return get_etag([row])
+
+
+def get_secrets_page_etag(db_session, user_id, group_id, cursor=None, limit=PAGE_SIZE):
+    '''
+    Get entity tag of a page of group secrets, see UserManager.list_secrets_page().
+    Raises NoResultFound if user is not in group and ValueError for invalid cursor.
+    '''
+    secret = arao_secret.db.model.Secret
+    group_key = arao_secret.db.model.UserGroupKey
+    limit = max(1, min(limit or PAGE_SIZE, PAGE_SIZE_MAX))
+    key_row = (db_session.query(group_key.id, group_key.group_key)
+               .filter(group_key.user_id == user_id)
+               .filter(group_key.group_id == group_id)
+               .one())
+    query = (db_session.query(secret.id, secret.version, secret.record_format, secret.data,
+                              secret.name)
+             .filter(secret.group_id == group_id)
+             .order_by(secret.id))
+    if cursor:
+        query = query.filter(secret.id > decode_cursor(cursor))
+    # One more secret, as next page cursor depends on it
+    return get_etag([key_row] + query.limit(limit + 1).all())
+
+
 def create_user(db_session, alias, email, password):
     pass_bytes = arao_secret.helper.to_bytes(password)
     SecureString.clearmem(password)
-    user = arao_secret.db.model.User(alias, email, pass_bytes)
+    # Generated by crypto executor if pool is empty, see User.generate_key()
+    rsa_key = arao_secret.keypool.take()
+    user = arao_secret.db.model.User(alias, email, pass_bytes, rsa_key=rsa_key)
     db_session.add(user)
     db_session.commit()
-    return get_user(db_session, alias, pass_bytes)
+    # Password was just hashed, so it's not verified again, nor pooled keys imported again
+    return UserManager(user, pass_bytes, rsa_key=rsa_key)
 
 
 def get_user(db_session, alias, password):
+    '''
+    Login user, password is verified by authentication pool.
+    Raises NoResultFound for wrong alias or password and LoginOverloaded if pool is full.
+    '''
     pass_bytes = arao_secret.helper.to_bytes(password)
     user = (db_session.query(arao_secret.db.model.User)
             .filter(arao_secret.db.model.User.alias == alias)
-            .filter(arao_secret.db.model.User.pass_hash
-                    == arao_secret.helper.get_pass_hash(pass_bytes))
+            .one_or_none())
+    pass_hash = user.pass_hash if user else arao_secret.auth.get_dummy_hash()
+    if not arao_secret.auth.get_pool().verify(pass_bytes, pass_hash) or user is None:
+        SecureString.clearmem(pass_bytes)
+        raise sqlalchemy.orm.exc.NoResultFound('Wrong alias or password !')
+    hasher = arao_secret.auth.get_hasher()
+    if hasher.needs_update(user.pass_hash):
+        LOGGER.info('Updating password hash of user %i to %s', user.id, hasher.name)
+        user.pass_hash = hasher.hash(pass_bytes)
+        db_session.commit()
+    return UserManager(user, pass_bytes)
+
+
+def restore_user(db_session, user_id, handle):
+    '''
+    Get manager of logged user from credentials saved on key agent,
+    see UserManager.put_credentials().
+    Raises KeyError if credentials expired and AgentError if agent is not available.
+    '''
+    client = arao_secret.agent.get_client()
+    if client is None:
+        raise arao_secret.agent.AgentError('Key agent is not configured !')
+    pass_bytes = client.get(handle)
+    user = (db_session.query(arao_secret.db.model.User)
+            .filter(arao_secret.db.model.User.id == user_id)
             .one())
     return UserManager(user, pass_bytes)
 
 
+class SecretRecord:
+    '''
+    Clear secret fields, compact record for batch decryptions.
+    Note: After use it, call to self.clear()
+    '''
+    __slots__ = ('id', 'group_id', 'name', 'url', 'login', 'password', 'comment')
+
+    def __init__(self, **fields):
+        for attribute in self.__slots__:
+            setattr(self, attribute, fields.get(attribute))
+
+    def clear(self):
+        '''
+        Clean record info in memory.
+        '''
+        for attribute in self.__slots__:
+            value = getattr(self, attribute)
+            # Single characters are strings shared by the interpreter
+            if isinstance(value, str) and len(value) > 1:
+                SecureString.clearmem(value)
+            setattr(self, attribute, None)
+
+
 class UserManager:
     '''
     User manager.
     '''
-    def __init__(self, user, password):
+    def __init__(self, user, password, rsa_key=None):
         self.user = user
+        # Unwrapped group keys, offuscated by application key
+        self.group_keys = arao_secret.cache.LRUCache(
+            arao_secret.conf.get('Session', 'group_keys_size', int, fallback=64),
+            ttl=arao_secret.conf.get('Session', 'group_keys_ttl', int, fallback=900),
+            on_evict=SecureString.clearmem
+        )
+        # Master password is removed with the keyring, so idle sessions must login again
+        self.keyring = arao_secret.keyring.Keyring(user, group_keys=self.group_keys,
+                                                   on_lock=self._clear_password)
+        self.keyring.unlock(password, rsa_key)
         self.password = arao_secret.helper.encrypt_for_session(password)
         if not arao_secret.helper.cleaned(password):
             raise RuntimeError('Master password NOT cleaned from memory !')
 
+    def _clear_password(self):
+        '''
+        Remove master password from memory, keyring was locked.
+        '''
+        password, self.password = self.password, None
+        if password is not None:
+            SecureString.clearmem(password)
+
+    def _get_keyring(self):
+        '''
+        Get user keyring.
+        Raises KeyringLocked if it was locked by idle timeout, user must login again.
+        '''
+        if self.keyring.is_locked():
+            raise arao_secret.keyring.KeyringLocked(
+                'Session of user {} expired, login again !'.format(self.user.id)
+            )
+        return self.keyring
+
+    def _get_group_key(self, db_session, group_id):
+        '''
+        Get user group key with its group and user in a single query.
+        '''
+        return (db_session.query(arao_secret.db.model.UserGroupKey)
+                .filter(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
+                .filter(arao_secret.db.model.UserGroupKey.group_id == group_id)
+                .options(sqlalchemy.orm.joinedload(arao_secret.db.model.UserGroupKey.group),
+                         sqlalchemy.orm.joinedload(arao_secret.db.model.UserGroupKey.user))
+                .one())
+
     def _get_password(self):
         '''
         Decrypt master user password from session.
         NOTE : After use it, remove password from memory.
         '''
-        return arao_secret.helper.decrypt_from_session(self.password)
+        password = self.password
+        if password is None:
+            raise arao_secret.keyring.KeyringLocked(
+                'Session of user {} expired, login again !'.format(self.user.id)
+            )
+        return arao_secret.helper.decrypt_from_session(password)
 
-    def create_group(self, db_session, name):
-        group = arao_secret.db.model.Group()
+    def create_group(self, db_session, name, cipher=None):
+        group = arao_secret.db.model.Group(cipher)
         db_session.add(group)
         db_session.flush()  # We need the Group ID to create UserGroupKey
         group_name = arao_secret.helper.to_bytes(name)
@@ -82,28 +288,201 @@ class UserManager:
         pass
 
     def create_secret(self, db_session, user_group_key, name, url, login, password, comment):
-        user_pass = self._get_password()
-        secret = arao_secret.db.model.Secret(user_pass, user_group_key,
-                                             name, url, login, password, comment)
-        # Clean sensitive data from memory
-        for string in (user_pass, name, url, login, password, comment):
-            SecureString.clearmem(string)
-        db_session.add(secret)
-        db_session.commit()
+        try:
+            secret = arao_secret.db.model.Secret(self._get_keyring(), user_group_key,
+                                                 name, url, login, password, comment)
+            db_session.add(secret)
+            db_session.commit()
+        except Exception:
+            # AES-GCM secrets are flushed before encryption, they must not be committed later
+            db_session.rollback()
+            raise
+        finally:
+            # Clean sensitive data from memory
+            for string in (name, url, login, password, comment):
+                SecureString.clearmem(string)
         return secret
 
+    def get_clear_many(self, db_session, group_id, fields=('id', 'name'), after_id=None,
+                       limit=None):
+        '''
+        Decrypt given fields for group secrets, unwrapping group key once.
+        Secrets are sorted by ID, after_id and limit select a page of them (keyset pagination).
+        Note: After use them, call to clear() of every record.
+        '''
+        for field in fields:
+            if field not in SecretRecord.__slots__:
+                raise ValueError('Unknown secret field "{}" !'.format(field))
+        group_key = self._get_group_key(db_session, group_id)
+        group = group_key.group
+        LOGGER.info('User %i reading %s from group %i secrets',
+                    self.user.id, ', '.join(fields), group_id)
+        secret = arao_secret.db.model.Secret
+        # Only needed columns, legacy ones or packed data
+        columns = {'id', 'group_id', 'key_version', 'record_format', 'data'}.union(fields)
+        query = (db_session.query(*[getattr(secret, column) for column in sorted(columns)])
+                 .filter(secret.group_id == group_id)
+                 .order_by(secret.id))
+        if after_id is not None:
+            query = query.filter(secret.id > after_id)
+        if limit is not None:
+            query = query.limit(limit)
+        keys = group_key.get_keys(self._get_keyring())
+        records = list()
+        try:
+            for row in query:
+                records.append(SecretRecord(**secret.decrypt_fields(group, keys, row, fields)))
+        finally:
+            # Memory clean
+            for key in keys.values():
+                SecureString.clearmem(key)
+        return records
+
+    def list_secrets_page(self, db_session, group_id, cursor=None, limit=PAGE_SIZE,
+                          fields=('id', 'name')):
+        '''
+        Get a page of group secrets and the cursor for next page, None if it's the last one.
+        Only secrets of the page are read and decrypted, whatever the group size.
+        Raises ValueError for invalid cursor.
+        Note: After use them, call to clear() of every record.
+        '''
+        limit = max(1, min(limit or PAGE_SIZE, PAGE_SIZE_MAX))
+        after_id = decode_cursor(cursor) if cursor else None
+        fields = tuple(fields) if 'id' in fields else ('id', ) + tuple(fields)
+        # One more secret to know if there is a next page
+        records = self.get_clear_many(db_session, group_id, fields=fields, after_id=after_id,
+                                      limit=limit + 1)
+        next_cursor = None
+        if len(records) > limit:
+            records.pop().clear()
+            next_cursor = encode_cursor(records[-1].id)
+        return records, next_cursor
+
+    def index_group(self, db_session, group_id):
+        '''
+        Add to blind index group secrets saved before it existed, see search_secrets().
+        '''
+        secret = arao_secret.db.model.Secret
+        token = arao_secret.db.model.SecretToken
+        group_key = self._get_group_key(db_session, group_id)
+        indexed = (db_session.query(token.secret_id)
+                   .filter(token.group_id == group_id)
+                   .distinct())
+        query = (db_session.query(secret.id, secret.key_version, secret.record_format,
+                                  secret.data, secret.name, secret.url)
+                 .filter(secret.group_id == group_id)
+                 .filter(secret.id.notin_(indexed))
+                 .order_by(secret.id))
+        # Tokens depend on the key of every secret, see Secret.key_version
+        keys = group_key.get_keys(self._get_keyring())
+        tokens = list()
+        try:
+            for row in query:
+                record = SecretRecord(**secret.decrypt_fields(group_key.group, keys, row,
+                                                              ('id', 'name', 'url')))
+                tokens.extend({'secret_id': record.id, 'group_id': group_id, 'token': value}
+                              for value in secret.index_tokens(keys[row.key_version],
+                                                               (record.name, record.url)))
+                record.clear()
+        finally:
+            # Memory clean
+            for key in keys.values():
+                SecureString.clearmem(key)
+        db_session.bulk_insert_mappings(token, tokens)
+        db_session.commit()
+
+    def export_group(self, db_session, group_id, passphrase, chunk_size=500):
+        '''
+        Get encrypted archive of group secrets by pieces, see arao_secret.archive.
+        '''
+        return arao_secret.archive.export_group(db_session,
+                                                self._get_group_key(db_session, group_id),
+                                                self._get_keyring(), passphrase,
+                                                chunk_size=chunk_size)
+
+    def import_secrets(self, db_session, group_id, records, chunk_size=500, workers=None,
+                       progress=None):
+        '''
+        Import secret records (fields dictionaries) into group, see arao_secret.importer.
+        Get the number of imported secrets.
+        '''
+        return arao_secret.importer.import_secrets(db_session,
+                                                   self._get_group_key(db_session, group_id),
+                                                   self._get_keyring(), records,
+                                                   chunk_size=chunk_size, workers=workers,
+                                                   progress=progress)
+
+    def get_group_names(self, db_session):
+        '''
+        Get group ID and name tuples of user groups.
+        '''
+        keyring = self._get_keyring()
+        group_keys = (db_session.query(arao_secret.db.model.UserGroupKey)
+                      .filter(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
+                      .order_by(arao_secret.db.model.UserGroupKey.group_id))
+        return [(group_key.group_id, arao_secret.helper.from_bytes(
+            group_key.get_name(keyring)
+        )) for group_key in group_keys]
+
+    def get_groups_etag(self, db_session):
+        '''
+        Get entity tag of user groups, see get_group_names().
+        '''
+        return get_groups_etag(db_session, self.user.id)
+
+    def get_secret(self, db_session, secret_id):
+        '''
+        Get secret record with all fields.
+        Note: After use it, call to its clear()
+        '''
+        # Secret with its group key and group in a single query
+        secret, group_key = (
+            db_session.query(arao_secret.db.model.Secret, arao_secret.db.model.UserGroupKey)
+            .join(arao_secret.db.model.UserGroupKey,
+                  arao_secret.db.model.UserGroupKey.group_id
+                  == arao_secret.db.model.Secret.group_id)
+            .filter(arao_secret.db.model.Secret.id == secret_id)
+            .filter(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
+            .options(sqlalchemy.orm.joinedload(arao_secret.db.model.UserGroupKey.group))
+            .one()
+        )
+        LOGGER.info('User %i reading all from secret %i', self.user.id, secret_id)
+        keys = group_key.get_keys(self._get_keyring())
+        try:
+            return SecretRecord(**secret.decrypt_fields(
+                group_key.group, keys, secret, ('id', 'group_id') + secret.FIELDS
+            ))
+        finally:
+            # Memory clean
+            for key in keys.values():
+                SecureString.clearmem(key)
+
+    def get_secret_etag(self, db_session, secret_id):
+        '''
+        Get entity tag of secret, see get_secret().
+        Raises NoResultFound if secret is not found in user groups.
+        '''
+        return get_secret_etag(db_session, self.user.id, secret_id)
+
+    def get_secrets_page_etag(self, db_session, group_id, cursor=None, limit=PAGE_SIZE):
+        '''
+        Get entity tag of a page of group secrets, see list_secrets_page().
+        Raises NoResultFound if user is not in group and ValueError for invalid cursor.
+        '''
+        return get_secrets_page_etag(db_session, self.user.id, group_id, cursor=cursor,
+                                     limit=limit)
+
     def list_groups(self):
         '''
         Show groups.
         '''
         print('Group ID  Group Name')
         print('--------  ----------')
-        user_pass = self._get_password()
+        keyring = self._get_keyring()
         for group_key in self.user.group_keys:
-            group_key_clear = group_key.get_clear(user_pass)
+            group_key_clear = group_key.get_clear(keyring)
             print('{:8}  {}'.format(group_key_clear['group_id'], group_key_clear['group_name']))
             group_key.clear()
-        SecureString.clearmem(user_pass)
 
     def list_secrets(self, db_session, group_id):
         '''
@@ -111,40 +490,288 @@ class UserManager:
         '''
         print('Secret ID  Secret Name')
         print('---------  -----------')
-        group = (db_session.query(arao_secret.db.model.Group)
-                 .filter(arao_secret.db.model.Group.id == group_id)
-                 .one())
-        group_key = (db_session.query(arao_secret.db.model.UserGroupKey)
-                     .filter(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
-                     .filter(arao_secret.db.model.UserGroupKey.group_id == group_id)
-                     .one())
-        user_pass = self._get_password()
-        for secret in group.secrets:
-            secret_clear = secret.get_clear(user_pass, group_key, attribute='id')
-            secret_clear = secret.get_clear(user_pass, group_key, attribute='name')
-            print('{:9}  {}'.format(secret_clear['id'], secret_clear['name']))
-            secret_clear.clear()
-        SecureString.clearmem(user_pass)
+        for record in self.get_clear_many(db_session, group_id, fields=('id', 'name')):
+            print('{:9}  {}'.format(record.id, record.name))
+            record.clear()
+
+    def search_secrets(self, db_session, text, fields=('id', 'group_id', 'name')):
+        '''
+        Search secrets with all words of text in their name or URL, in all user groups.
+        Secrets are matched in SQL by blind index, so only matching ones are decrypted, and
+        only exact whole words match, not prefixes nor parts of them.
+        Secrets saved before the index existed are not found, see arao_secret.indexer.
+        Note: After use them, call to clear() of every record.
+        '''
+        for field in fields:
+            if field not in SecretRecord.__slots__:
+                raise ValueError('Unknown secret field "{}" !'.format(field))
+        words = arao_secret.helper.normalize_words(text)
+        if not words:
+            return list()
+        secret = arao_secret.db.model.Secret
+        token = arao_secret.db.model.SecretToken
+        keyring = self._get_keyring()
+        group_keys = (db_session.query(arao_secret.db.model.UserGroupKey)
+                      .filter(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
+                      .options(sqlalchemy.orm.joinedload(arao_secret.db.model.UserGroupKey.group))
+                      .all())
+        if not group_keys:
+            return list()
+        # Keys by group and version, every version is searched while group is re-encrypted
+        keys = {group_key.group_id: group_key.get_keys(keyring) for group_key in group_keys}
+        groups = {group_key.group_id: group_key.group for group_key in group_keys}
+        records = list()
+        try:
+            conditions = [sqlalchemy.and_(token.group_id == group_id,
+                                          token.token.in_(set().union(*[
+                                              secret.index_tokens(key, words)
+                                              for key in versions.values()
+                                          ])))
+                          for group_id, versions in keys.items()]
+            matches = (db_session.query(token.secret_id)
+                       .filter(sqlalchemy.or_(*conditions))
+                       .group_by(token.secret_id)
+                       .having(sqlalchemy.func.count(sqlalchemy.distinct(token.token))
+                               == len(words)))
+            # Only needed columns, legacy ones or packed data
+            columns = {'id', 'group_id', 'key_version', 'record_format', 'data'}.union(fields)
+            query = (db_session.query(*[getattr(secret, column) for column in sorted(columns)])
+                     .filter(secret.id.in_(matches))
+                     .order_by(secret.group_id, secret.id))
+            for row in query:
+                LOGGER.info('User %i reading %s from secret %i found by search',
+                            self.user.id, ', '.join(fields), row.id)
+                records.append(SecretRecord(**secret.decrypt_fields(
+                    groups[row.group_id], keys[row.group_id], row, fields
+                )))
+        finally:
+            # Memory clean
+            for versions in keys.values():
+                for key in versions.values():
+                    SecureString.clearmem(key)
+        return records
 
     def show_secret(self, db_session, id):
         '''
         Show secret data.
         '''
-        secret = (db_session.query(arao_secret.db.model.Secret)
-                  .filter(arao_secret.db.model.Secret.id == id)
-                  .one())
-        group_key = (db_session.query(arao_secret.db.model.UserGroupKey)
-                     .filter(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
-                     .filter(arao_secret.db.model.UserGroupKey.group_id == secret.group_id)
-                     .one())
-        user_pass = self._get_password()
-        secret_clear = secret.get_clear(user_pass, group_key)
+        # Secret with its group key, group and user in a single query
+        secret, group_key = (
+            db_session.query(arao_secret.db.model.Secret, arao_secret.db.model.UserGroupKey)
+            .join(arao_secret.db.model.UserGroupKey,
+                  arao_secret.db.model.UserGroupKey.group_id
+                  == arao_secret.db.model.Secret.group_id)
+            .filter(arao_secret.db.model.Secret.id == id)
+            .filter(arao_secret.db.model.UserGroupKey.user_id == self.user.id)
+            .options(sqlalchemy.orm.joinedload(arao_secret.db.model.UserGroupKey.group),
+                     sqlalchemy.orm.joinedload(arao_secret.db.model.UserGroupKey.user))
+            .one()
+        )
+        secret_clear = secret.get_clear(self._get_keyring(), group_key)
         print('Name: {}'.format(secret_clear['name']))
         print('URL: {}'.format(secret_clear['url']))
         print('Login: {}'.format(secret_clear['login']))
         print('Password: {}'.format(secret_clear['password']))
         print('Comments\n{}'.format(secret_clear['comment']))
         secret_clear.clear()
-        SecureString.clearmem(user_pass)
 
+    def restore_group(self, db_session, group_id, stream, passphrase, chunk_size=500,
+                      workers=None, progress=None):
+        '''
+        Import secrets of an encrypted archive into group, see arao_secret.archive.
+        Get the number of restored secrets.
+        '''
+        return arao_secret.archive.restore_group(db_session,
+                                                 self._get_group_key(db_session, group_id),
+                                                 self._get_keyring(), stream, passphrase,
+                                                 chunk_size=chunk_size, workers=workers,
+                                                 progress=progress)
+
+    def rekey_group(self, db_session, group_id, remove=(), cipher=None, chunk_size=500,
+                    workers=None):
+        '''
+        Re-encrypt group secrets with a new group key, removing given user IDs from group.
+        '''
+        arao_secret.rekey.rekey_group(db_session, self.user, self._get_keyring(), group_id,
+                                      remove=remove, cipher=cipher, chunk_size=chunk_size,
+                                      workers=workers)
+
+    def put_credentials(self):
+        '''
+        Save master password on key agent, get its handle, so other processes of the host
+        can restore this manager, see restore_user().
+        '''
+        client = arao_secret.agent.get_client()
+        if client is None:
+            raise arao_secret.agent.AgentError('Key agent is not configured !')
+        return client.put(self._get_password())
+
+    def logout(self, handle=None):
+        '''
+        Remove user credentials from memory, and from key agent if handle is given.
+        '''
+        self.keyring.lock()
+        self._clear_password()
+        if handle is not None:
+            arao_secret.agent.get_client().delete(handle)
+
+
+class _Session:
+    '''
+    Registry entry, logged user manager, its credentials handle on key agent, its last use
+    and its users.
+    '''
+    __slots__ = ('manager', 'handle', 'last_use', 'removed', 'evicted', 'users')
+
+    def __init__(self, manager, handle=None):
+        self.manager = manager
+        self.handle = handle
+        self.last_use = time.monotonic()
+        self.removed = False
+        self.evicted = False
+        self.users = 0
+
+
+class SessionRegistry:
+    '''
+    Managers of logged users by session ID, so requests after login reuse their
+    unlocked keyring and cached group keys.
+
+    Sessions are removed when not used for idle TTL seconds, after TTL seconds since login
+    or when registry is full (least recently used one), then their credentials are cleaned
+    from memory by UserManager.logout(). Managers got by get() are in use until release(),
+    credentials of sessions removed meanwhile are cleaned on their last release, so no
+    thread loses them halfway.
+    Sessions with credentials on key agent are shared by processes of the host, so they
+    are removed when their credentials are not on agent anymore (logout by another process).
+    '''
+    def __init__(self, size, idle_ttl=None, ttl=None):
+        self.idle_ttl = idle_ttl
+        self.evictions = 0
+        self.logouts = 0
+        self._sessions = arao_secret.cache.LRUCache(size, ttl=ttl, on_evict=self._evicted)
+        # Sessions in use by manager ID, see get() and release()
+        self._in_use = dict()
+        # Cache is only used with registry locked, so evictions are done with it too
+        self._lock = threading.RLock()
+
+    def _evicted(self, session):
+        '''
+        Clean credentials of removed session, if it's not in use.
+        '''
+        if session.removed:
+            self.logouts += 1
+        else:
+            self.evictions += 1
+            LOGGER.info('Session of user %i evicted', session.manager.user.id)
+        session.evicted = True
+        if not session.users:
+            session.manager.logout()
+
+    def add(self, manager, handle=None):
+        '''
+        Add manager of logged user, with its credentials handle on key agent if any,
+        get its new session ID.
+        '''
+        with self._lock:
+            self.expire()
+            session_id = secrets.token_urlsafe(16)
+            self._sessions.set(session_id, _Session(manager, handle))
+            return session_id
 
+    def expire(self):
+        '''
+        Remove expired and idle sessions.
+        '''
+        with self._lock:
+            self._sessions.expire()
+            if self.idle_ttl:
+                limit = time.monotonic() - self.idle_ttl
+                for session_id, session in self._sessions.items():
+                    if session.last_use < limit:
+                        self._sessions.pop(session_id)
+
+    def get(self, session_id):
+        '''
+        Get manager of session, None if not found or expired.
+        Note: After use it, call to release().
+        '''
+        with self._lock:
+            self.expire()
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session.last_use = time.monotonic()
+            session.users += 1
+            self._in_use[id(session.manager)] = session
+        # Agent is called unlocked, other sessions don't wait
+        if session.handle is not None and not self._has_credentials(session):
+            LOGGER.info('Session of user %i logged out by another process',
+                        session.manager.user.id)
+            self.remove(session_id)
+            self.release(session.manager)
+            return None
+        return session.manager
+
+    @staticmethod
+    def _has_credentials(session):
+        '''
+        Check if session credentials are still on key agent, unavailable agent means no.
+        '''
+        client = arao_secret.agent.get_client()
+        if client is None:
+            return False
+        try:
+            return client.has(session.handle)
+        except arao_secret.agent.AgentError:
+            LOGGER.exception('Credentials of user %i not checked on key agent',
+                             session.manager.user.id)
+            return False
+
+    def release(self, manager):
+        '''
+        Release manager got by get(), its credentials are cleaned if session was removed.
+        '''
+        with self._lock:
+            session = self._in_use.get(id(manager))
+            if session is None:
+                return
+            session.users -= 1
+            if session.users:
+                return
+            del self._in_use[id(manager)]
+        if session.evicted:
+            manager.logout()
+
+    def remove(self, session_id):
+        '''
+        Logout session.
+        '''
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.removed = True
+                self._sessions.pop(session_id)
+
+    def stats(self):
+        '''
+        Get registry counters.
+        '''
+        with self._lock:
+            return {'active': len(self._sessions), 'in_use': len(self._in_use),
+                    'evictions': self.evictions, 'logouts': self.logouts}
+
+
+def get_registry():
+    '''
+    Get process session registry.
+    '''
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            _REGISTRY = SessionRegistry(
+                arao_secret.conf.get('Session', 'registry_size', int, fallback=1000),
+                idle_ttl=arao_secret.conf.get('Session', 'registry_idle_ttl', int, fallback=1800),
+                ttl=arao_secret.conf.get('Session', 'registry_ttl', int, fallback=43200)
+            )
+        return _REGISTRY
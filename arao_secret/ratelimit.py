@@ -0,0 +1,193 @@
+'''
+Token bucket rate limiting, for expensive anonymous requests like login and registration.
+
+Every key (remote address, alias...) has a bucket of burst tokens, refilled at rate tokens
+by second, every request takes one. Buckets are kept in memory, or in a file shared by
+all workers of the host, locked with fcntl. File has a fixed number of slots, so its size
+is constant; when all probed slots are in use, the least recently updated one is reused.
+
+Usage example:
+
+    limiter = arao_secret.ratelimit.get_limiter('login')
+    allowed, retry_after = limiter.acquire('127.0.0.1')
+
+'''
+
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+import time
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Slot: key hash, tokens and update time
+SLOT = struct.Struct('>16sdd')
+# Slots probed for a key
+PROBES = 8
+
+# Process limiters by name, see get_limiter()
+_LIMITERS = dict()
+_STORE = None
+_LOCK = threading.Lock()
+
+
+def _hash(key):
+    '''
+    Get fixed size hash of key.
+    '''
+    return hashlib.blake2b(key.encode(arao_secret.ENCODING), digest_size=16).digest()
+
+
+def _refill(tokens, updated, now, rate, burst):
+    '''
+    Get bucket tokens refilled since last update.
+    '''
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryStore:
+    '''
+    Buckets of this process.
+    '''
+    def __init__(self, size=100000):
+        self._buckets = arao_secret.cache.LRUCache(size)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        '''
+        Take a token from key bucket, get seconds to wait for it, 0 if taken.
+        '''
+        key_hash = _hash(key)
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key_hash, (burst, now))
+            tokens = _refill(tokens, updated, now, rate, burst)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets.set(key_hash, (tokens, now))
+        return wait
+
+
+class FileStore:
+    '''
+    Buckets shared by processes through a file of fixed slots.
+    '''
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < slots * SLOT.size:
+            os.ftruncate(self._fd, slots * SLOT.size)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        '''
+        Take a token from key bucket, get seconds to wait for it, 0 if taken.
+        '''
+        key_hash = _hash(key)
+        first = int.from_bytes(key_hash[:8], 'big') % self.slots
+        positions = [(first + probe) % self.slots for probe in range(PROBES)]
+        # Threads of this process and the other processes
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                slot = None
+                oldest = None
+                for position in positions:
+                    slot_hash, tokens, updated = SLOT.unpack(
+                        os.pread(self._fd, SLOT.size, position * SLOT.size)
+                    )
+                    if slot_hash == key_hash:
+                        slot = (position, tokens, updated)
+                        break
+                    if oldest is None or updated < oldest[1]:
+                        oldest = (position, updated)
+                if slot is None:
+                    slot = (oldest[0], burst, now)
+                position, tokens, updated = slot
+                tokens = _refill(tokens, updated, now, rate, burst)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                os.pwrite(self._fd, SLOT.pack(key_hash, tokens, now), position * SLOT.size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return wait
+
+
+class RateLimiter:
+    '''
+    Token buckets with the same rate (tokens by second) and burst, in given store.
+    Raises ValueError if rate is not positive or burst is lower than one token.
+    '''
+    def __init__(self, name, store, rate, burst):
+        if rate <= 0:
+            raise ValueError('Rate of limiter {} must be positive !'.format(name))
+        if burst < 1:
+            raise ValueError('Burst of limiter {} must be at least 1 !'.format(name))
+        self.name = name
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        self.rejected = 0
+
+    def acquire(self, key):
+        '''
+        Take a token for key, get if it was allowed and seconds to retry.
+        '''
+        wait = self.store.take('{}:{}'.format(self.name, key), self.rate, self.burst)
+        if wait:
+            self.rejected += 1
+            LOGGER.warning('Rate limit %s exceeded by %s', self.name, key)
+            return False, math.ceil(wait)
+        return True, 0
+
+
+def get_store():
+    '''
+    Get process buckets store, [RateLimit] path file if configured.
+    '''
+    global _STORE
+    with _LOCK:
+        if _STORE is None:
+            path = arao_secret.conf.get('RateLimit', 'path', fallback='')
+            if path:
+                _STORE = FileStore(path, arao_secret.conf.get('RateLimit', 'slots', int,
+                                                              fallback=65536))
+            else:
+                _STORE = MemoryStore()
+        return _STORE
+
+
+def get_limiter(name):
+    '''
+    Get process limiter by name, rate and burst from [RateLimit] <name>_rate and <name>_burst.
+    None if rate limiting is disabled.
+    '''
+    if not arao_secret.conf.get('RateLimit', 'enabled', bool, fallback=True):
+        return None
+    store = get_store()
+    with _LOCK:
+        if name not in _LIMITERS:
+            _LIMITERS[name] = RateLimiter(
+                name, store,
+                arao_secret.conf.get('RateLimit', '{}_rate'.format(name), float, fallback=0.1),
+                arao_secret.conf.get('RateLimit', '{}_burst'.format(name), int, fallback=5)
+            )
+        return _LIMITERS[name]
@@ -0,0 +1,254 @@
+'''
+Group re-encryption, needed when a member leaves a group.
+
+A new group key is encrypted for remaining members as the next key version of the group
+(see UserGroupKey.next_group_key), and every secret saves the version of its key, so
+secrets of both versions are readable while running and after an interrupted run.
+Group secrets are streamed from a server side cursor (pages of IDs on SQLite) in chunks,
+re-encrypted by worker processes and saved with one short transaction per chunk, with
+progress on group_rekey table, so interrupted runs resume.
+Secrets created or updated meanwhile take the next version. At the end, with group locked,
+secrets saved with previous key since the cursor was opened are re-encrypted too, and the
+next key replaces the current one for remaining members. Cached group keys are by version
+(see arao_secret.keyring), so no web worker uses the previous key after that.
+
+Usage example:
+
+    python3 -m arao_secret.rekey --alias admin --group 3 --remove 7
+
+'''
+
+import argparse
+import collections
+import getpass
+import logging
+import sys
+
+import sqlalchemy
+import SecureString
+
+import arao_secret
+
+
+LOGGER = logging.getLogger(__name__)
+
+FIELDS = arao_secret.db.model.Secret.FIELDS
+COLUMNS = ('id', 'key_version', 'record_format', 'data') + FIELDS
+Row = collections.namedtuple('Row', COLUMNS)
+
+
+def rekey_chunk(group_id, aes_iv, old_version, old_key, new_key, new_cipher, rows):
+    '''
+    Re-encrypt secret rows, worker process task.
+    Get ID, record format, encrypted data and blind index tokens for every row.
+    '''
+    group = arao_secret.db.model.Group(new_cipher)
+    group.id = group_id
+    group.aes_iv = aes_iv
+    old_keys = {old_version: old_key}
+    result = list()
+    for row in rows:
+        row = Row(*row)
+        clear = arao_secret.db.model.Secret.decrypt_fields(group, old_keys, row, FIELDS)
+        tokens = arao_secret.db.model.Secret.index_tokens(new_key, (clear['name'], clear['url']))
+        record_format, data = arao_secret.db.model.Secret.encrypt_fields(
+            group, new_key, [clear[field] for field in FIELDS], row.id
+        )
+        result.append((row.id, record_format, data, tokens))
+    return result
+
+
+def _save_chunk(db_session, group_id, old_version, rows):
+    '''
+    Save re-encrypted rows and their blind index, without commit.
+    Rows updated meanwhile have the next key version already, they are kept.
+    '''
+    secret = arao_secret.db.model.Secret
+    pending = {secret_id for secret_id, in (db_session.query(secret.id)
+                                            .filter(secret.id.in_([row[0] for row in rows]))
+                                            .filter(secret.key_version == old_version)
+                                            .with_for_update())}
+    mappings = list()
+    tokens = list()
+    for secret_id, record_format, data, secret_tokens in rows:
+        if secret_id not in pending:
+            continue
+        mapping = {'id': secret_id, 'key_version': old_version + 1,
+                   'record_format': record_format, 'data': data}
+        mapping.update({field: None for field in FIELDS})
+        mappings.append(mapping)
+        tokens.extend({'secret_id': secret_id, 'group_id': group_id, 'token': token}
+                      for token in secret_tokens)
+    db_session.bulk_update_mappings(secret, mappings)
+    # Blind index depends on group key too
+    (db_session.query(arao_secret.db.model.SecretToken)
+     .filter(arao_secret.db.model.SecretToken.secret_id.in_(pending))
+     .delete(synchronize_session=False))
+    db_session.bulk_insert_mappings(arao_secret.db.model.SecretToken, tokens)
+
+
+def _read_chunks(db_session, query, chunk_size):
+    '''
+    Read rows of query sorted by ID in chunks.
+    Reading connection is apart, so chunks are committed while its server side cursor is
+    open. SQLite readers block writers, so there rows are read by pages of IDs instead.
+    '''
+    table = arao_secret.db.model.Secret.__table__
+    if db_session.get_bind().dialect.name == 'sqlite':
+        rows = db_session.execute(query.limit(chunk_size)).fetchall()
+        while rows:
+            yield rows
+            rows = db_session.execute(query.where(table.c.id > rows[-1].id)
+                                      .limit(chunk_size)).fetchall()
+        return
+    with db_session.get_bind().connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
+def _start(db_session, user, group, remove, cipher):
+    '''
+    Encrypt a new group key for remaining members as next key version, get progress record.
+    '''
+    new_key = arao_secret.helper.aes_key_gen()
+    for user_group_key in (db_session.query(arao_secret.db.model.UserGroupKey)
+                           .filter(arao_secret.db.model.UserGroupKey.group_id == group.id)):
+        if user_group_key.user_id not in remove:
+            # User encryption cleans given key, so every member gets a copy
+            user_group_key.set_encrypted('next_group_key', bytes(bytearray(new_key)))
+    SecureString.clearmem(new_key)
+    rekey = arao_secret.db.model.GroupRekey(user, group, cipher or group.cipher, remove)
+    db_session.add(rekey)
+    db_session.commit()
+    LOGGER.info('Group %i re-encryption started by user %i', group.id, user.id)
+    return rekey
+
+
+def _finish(db_session, rekey, old_version, old_key, new_key):
+    '''
+    Re-encrypt secrets saved with previous key meanwhile, set next key version as current
+    one for remaining members and remove the others.
+    '''
+    group = rekey.group
+    # Writers lock group until commit, so no more secrets are saved with previous key
+    db_session.refresh(group, with_for_update=True)
+    table = arao_secret.db.model.Secret.__table__
+    rows = db_session.execute(sqlalchemy.select([table.c[column] for column in COLUMNS])
+                              .where(table.c.group_id == group.id)
+                              .where(table.c.key_version == old_version)
+                              .order_by(table.c.id)).fetchall()
+    if rows:
+        LOGGER.info('Group %i: re-encrypting %i secrets saved while running',
+                    group.id, len(rows))
+        _save_chunk(db_session, group.id, old_version,
+                    rekey_chunk(group.id, group.aes_iv, old_version, old_key, new_key,
+                                rekey.cipher, [tuple(row) for row in rows]))
+    group.key_version = old_version + 1
+    group.cipher = rekey.cipher
+    removed = rekey.get_removed()
+    for user_group_key in (db_session.query(arao_secret.db.model.UserGroupKey)
+                           .filter(arao_secret.db.model.UserGroupKey.group_id == group.id)):
+        if user_group_key.user_id in removed:
+            db_session.delete(user_group_key)
+        else:
+            # Members added meanwhile have no next key, so every member gets a new copy
+            user_group_key.set_encrypted('group_key', bytes(bytearray(new_key)))
+            user_group_key.next_group_key = None
+    db_session.delete(rekey)
+    db_session.commit()
+    LOGGER.info('Group %i re-encryption finished, removed users: %s', group.id, removed or '-')
+
+
+def rekey_group(db_session, user, keyring, group_id, remove=(), cipher=None, chunk_size=500,
+                workers=None):
+    '''
+    Re-encrypt group secrets with a new group key, resuming previous run if interrupted.
+    Given user IDs are removed from group.
+    '''
+    if user.id in remove:
+        raise ValueError("User running re-encryption can't be removed from group !")
+    user_group_key = (db_session.query(arao_secret.db.model.UserGroupKey)
+                      .filter(arao_secret.db.model.UserGroupKey.user_id == user.id)
+                      .filter(arao_secret.db.model.UserGroupKey.group_id == group_id)
+                      .one())
+    group = user_group_key.group
+    rekey = (db_session.query(arao_secret.db.model.GroupRekey)
+             .filter(arao_secret.db.model.GroupRekey.group_id == group_id)
+             .one_or_none())
+    if rekey is None:
+        rekey = _start(db_session, user, group, set(remove), cipher)
+    elif rekey.user_id != user.id:
+        raise RuntimeError('Group {} re-encryption was started by user {}, only he can resume it !'
+                           .format(group_id, rekey.user_id))
+    else:
+        LOGGER.info('Group %i re-encryption resumed from secret %i',
+                    group_id, rekey.last_secret_id)
+
+    old_version = group.key_version
+    old_key = user_group_key.get_key(keyring, old_version)
+    new_key = user_group_key.get_key(keyring, old_version + 1)
+    table = arao_secret.db.model.Secret.__table__
+    query = (sqlalchemy.select([table.c[column] for column in COLUMNS])
+             .where(table.c.group_id == group_id)
+             .where(table.c.key_version == old_version)
+             .where(table.c.id > rekey.last_secret_id)
+             .order_by(table.c.id))
+    executor = arao_secret.executor.CryptoExecutor(workers)
+
+    def save(rows):
+        _save_chunk(db_session, group_id, old_version, rows)
+        rekey.last_secret_id = rows[-1][0]
+        db_session.commit()
+        LOGGER.info('Group %i re-encrypted up to secret %i', group_id, rekey.last_secret_id)
+
+    try:
+        futures = collections.deque()
+        for rows in _read_chunks(db_session, query, chunk_size):
+            futures.append(executor.submit(rekey_chunk, group_id, group.aes_iv, old_version,
+                                           old_key, new_key, rekey.cipher,
+                                           [tuple(row) for row in rows]))
+            # Limit chunks in flight to keep memory constant, saving them in order
+            while len(futures) > executor.workers:
+                save(futures.popleft().result())
+        while futures:
+            save(futures.popleft().result())
+        _finish(db_session, rekey, old_version, old_key, new_key)
+    finally:
+        executor.shutdown()
+        # Memory clean
+        SecureString.clearmem(old_key)
+        SecureString.clearmem(new_key)
+        if keyring.group_keys is not None:
+            keyring.group_keys.pop((group_id, old_version))
+
+
+def parse_arguments(argv):
+    '''
+    Arguments parser.
+    '''
+    parser = argparse.ArgumentParser(description='AraoSecret group re-encryption')
+    parser.add_argument('--alias', type=str, required=True,
+                        help='Alias of group member running it.')
+    parser.add_argument('--group', type=int, required=True, help='Group ID.')
+    parser.add_argument('--remove', type=int, nargs='*', default=[],
+                        help='User IDs to remove from group.')
+    parser.add_argument('--cipher', type=str,
+                        choices=(arao_secret.db.model.Group.CIPHER_CBC,
+                                 arao_secret.db.model.Group.CIPHER_GCM),
+                        help='New group cipher, current one by default.')
+    parser.add_argument('--chunk-size', type=int, default=500, help='Secrets by chunk.')
+    parser.add_argument('--workers', type=int, help='Worker processes, one per core by default.')
+    return parser.parse_args(argv[1:])
+
+
+if __name__ == '__main__':
+    ARGS = parse_arguments(sys.argv)
+    DB_SESSION = arao_secret.db.create_session()
+    MANAGER = arao_secret.manager.get_user(DB_SESSION, ARGS.alias, getpass.getpass())
+    MANAGER.rekey_group(DB_SESSION, ARGS.group, remove=ARGS.remove, cipher=ARGS.cipher,
+                        chunk_size=ARGS.chunk_size, workers=ARGS.workers)
+    MANAGER.logout()
@@ -0,0 +1,73 @@
+'''
+AraoSecret crypto and manager benchmarks.
+
+Usage example:
+
+    python3 -m benchmarks --output results.json
+    python3 -m benchmarks --baseline baseline.json --threshold 0.2
+
+'''
+
+import os
+import statistics
+import tempfile
+import time
+
+import sqlalchemy
+
+import arao_secret
+
+
+# Benchmarks only use APIs of the first AraoSecret versions, or check if they exist,
+# so results can be compared with any previous version
+
+
+def create_session():
+    '''
+    Create session on a new local SQLite DataBase.
+    '''
+    descriptor, path = tempfile.mkstemp(prefix='arao_bench_', suffix='.sqlite')
+    os.close(descriptor)
+    engine = sqlalchemy.create_engine('sqlite:///' + path)
+    db_session = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=engine))
+    arao_secret.db.create_tables(db_session)
+    return db_session, path
+
+
+def drop_session(db_session, path):
+    '''
+    Close session and remove its DataBase.
+    '''
+    db_session.close()
+    db_session.bind.dispose()
+    os.remove(path)
+
+
+def get_user_pass(manager):
+    '''
+    Get credentials taken by models: session keyring, or master password on versions without it.
+    '''
+    if hasattr(manager, '_get_keyring'):
+        return manager._get_keyring()  # pylint: disable=W0212
+    return manager._get_password()  # pylint: disable=W0212
+
+
+def measure(function, inputs):
+    '''
+    Get median seconds per call of function for every prepared input.
+
+    Inputs are prepared before timing, because most helpers clean their arguments from memory.
+    '''
+    timings = list()
+    for args in inputs:
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def text(size=32):
+    '''
+    Get a new string, never a shared constant, so it can be cleaned from memory.
+    '''
+    return os.urandom(size // 2).hex()
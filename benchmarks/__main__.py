@@ -0,0 +1,75 @@
+'''
+Run benchmarks, save results and check regressions against a baseline.
+'''
+
+import argparse
+import json
+import sys
+
+import arao_secret
+
+import benchmarks
+import benchmarks.crypto
+import benchmarks.manager
+
+
+def compare(results, baseline, threshold):
+    '''
+    Get regressions, benchmarks slower than baseline more than given ratio.
+    '''
+    regressions = dict()
+    for name, seconds in baseline.items():
+        if name in results and results[name] > seconds * (1 + threshold):
+            regressions[name] = (seconds, results[name])
+    return regressions
+
+
+def parse_arguments(argv):
+    '''
+    Arguments parser.
+    '''
+    parser = argparse.ArgumentParser(description='AraoSecret benchmarks')
+    parser.add_argument('--output', type=str, default='benchmark_results.json',
+                        help='JSON file to save results.')
+    parser.add_argument('--baseline', type=str, help='JSON file with baseline results.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slowdown ratio over baseline.')
+    parser.add_argument('--repeat', type=int, default=20, help='Runs by benchmark.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='Group sizes for secrets listing.')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    '''
+    Run benchmarks, returns exit code.
+    '''
+    args = parse_arguments(argv)
+    db_session, path = benchmarks.create_session()
+    try:
+        manager = arao_secret.manager.create_user(db_session, benchmarks.text(16),
+                                                  benchmarks.text(), benchmarks.text())
+        _, user_group_key = manager.create_group(db_session, benchmarks.text())
+        results = benchmarks.crypto.run(db_session, manager, user_group_key, args.repeat)
+        results.update(benchmarks.manager.run(db_session, manager, user_group_key,
+                                              args.repeat, args.sizes))
+    finally:
+        benchmarks.drop_session(db_session, path)
+
+    for name, seconds in sorted(results.items()):
+        print('{:40}  {:12.6f} s'.format(name, seconds))
+    with open(args.output, 'w') as _file:
+        json.dump(results, _file, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as _file:
+            regressions = compare(results, json.load(_file), args.threshold)
+        for name, (before, after) in sorted(regressions.items()):
+            print('REGRESSION {}: {:.6f} s -> {:.6f} s'.format(name, before, after))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,63 @@
+'''
+Crypto helpers and models benchmarks.
+'''
+
+import SecureString
+
+import arao_secret
+
+from benchmarks import get_user_pass
+from benchmarks import measure
+from benchmarks import text
+
+
+def run(db_session, manager, user_group_key, repeat):
+    '''
+    Run crypto benchmarks, get median seconds by benchmark name.
+    '''
+    results = dict()
+    user_pass = get_user_pass(manager)
+
+    results['helper.to_bytes'] = measure(arao_secret.helper.to_bytes,
+                                         [(text(),) for _ in range(repeat)])
+    results['helper.from_bytes'] = measure(
+        arao_secret.helper.from_bytes,
+        [(arao_secret.helper.to_bytes(text()),) for _ in range(repeat)]
+    )
+
+    results['helper.encrypt_for_session'] = measure(
+        arao_secret.helper.encrypt_for_session,
+        [(arao_secret.helper.to_bytes(text()),) for _ in range(repeat)]
+    )
+    results['helper.decrypt_from_session'] = measure(
+        lambda pass_enc: SecureString.clearmem(arao_secret.helper.decrypt_from_session(pass_enc)),
+        [(arao_secret.helper.encrypt_for_session(arao_secret.helper.to_bytes(text())),)
+         for _ in range(repeat)]
+    )
+
+    results['UserGroupKey.encrypt'] = measure(user_group_key.encrypt,
+                                              [(user_pass, text()) for _ in range(repeat)])
+    results['UserGroupKey.decrypt'] = measure(
+        lambda text_enc: SecureString.clearmem(user_group_key.decrypt(user_pass, text_enc)),
+        [(user_group_key.encrypt(user_pass, text()),) for _ in range(repeat)]
+    )
+
+    results['Secret.__init__'] = measure(
+        arao_secret.db.model.Secret,
+        [(user_pass, user_group_key, text(), text(), text(), text(), text(128))
+         for _ in range(repeat)]
+    )
+    # Discard secrets added to session through group relationship
+    db_session.rollback()
+
+    secrets = [arao_secret.db.model.Secret(user_pass, user_group_key,
+                                           text(), text(), text(), text(), text(128))
+               for _ in range(repeat)]
+    db_session.add_all(secrets)
+    db_session.commit()
+    results['Secret.get_clear'] = measure(
+        lambda secret: secret.get_clear(user_pass, user_group_key) and secret.clear(),
+        [(secret,) for secret in secrets]
+    )
+
+    return results
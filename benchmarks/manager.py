@@ -0,0 +1,49 @@
+'''
+UserManager benchmarks.
+'''
+
+import contextlib
+import io
+
+import arao_secret
+
+from benchmarks import get_user_pass
+from benchmarks import measure
+from benchmarks import text
+
+
+def fill_group(db_session, manager, user_group_key, size):
+    '''
+    Add secrets to group up to given size.
+    '''
+    user_pass = get_user_pass(manager)
+    count = (db_session.query(arao_secret.db.model.Secret)
+             .filter(arao_secret.db.model.Secret.group_id == user_group_key.group_id)
+             .count())
+    for _ in range(size - count):
+        db_session.add(arao_secret.db.model.Secret(user_pass, user_group_key,
+                                                   text(), text(), text(), text(), text(128)))
+    db_session.commit()
+
+
+def run(db_session, manager, user_group_key, repeat, sizes):
+    '''
+    Run manager benchmarks, get median seconds by benchmark name.
+    '''
+    results = dict()
+
+    for size in sorted(sizes):
+        fill_group(db_session, manager, user_group_key, size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results['UserManager.list_secrets[{}]'.format(size)] = measure(
+                manager.list_secrets,
+                [(db_session, user_group_key.group_id) for _ in range(repeat)]
+            )
+
+    # RSA key generation is slow, so fewer runs
+    results['manager.create_user'] = measure(
+        arao_secret.manager.create_user,
+        [(db_session, text(16), text(), text()) for _ in range(max(1, repeat // 10))]
+    )
+
+    return results
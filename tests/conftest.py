@@ -0,0 +1,94 @@
+'''
+Common fixtures, every test gets its own SQLite DataBase.
+'''
+
+import os
+import threading
+
+import pytest
+
+import arao_secret
+
+
+def text(size=32):
+    '''
+    Get a new string, never a shared constant, so it can be cleaned from memory.
+    '''
+    return os.urandom(size // 2).hex()
+
+
+def get_names(db_session, manager, group_id):
+    '''
+    Get clear secret names of group, as bytes because records are cleaned.
+    '''
+    records = manager.get_clear_many(db_session, group_id, fields=('id', 'name'))
+    names = [record.name.encode() for record in records]
+    for record in records:
+        record.clear()
+    return names
+
+
+@pytest.fixture(autouse=True)
+def rsa_bits(monkeypatch):
+    '''
+    Small RSA keys, generation of default ones takes seconds.
+    '''
+    monkeypatch.setattr(arao_secret.keypool, 'RSA_BITS', 1024)
+
+
+@pytest.fixture
+def agent_client(tmp_path):
+    '''
+    Client of a key agent running in a thread.
+    '''
+    path = str(tmp_path / 'agent.sock')
+    server = arao_secret.agent.AgentServer(path, arao_secret.agent.KeyAgent(10))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield arao_secret.agent.AgentClient(path)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def db_uri(tmp_path):
+    '''
+    URI of a new SQLite DataBase, its process engine is disposed after the test.
+    '''
+    uri = 'sqlite:///{}'.format(tmp_path / 'arao_secret.sqlite')
+    yield uri
+    arao_secret.db.dispose_engine(uri)
+
+
+@pytest.fixture
+def db_session(db_uri):
+    '''
+    Session on a new DataBase with all tables.
+    '''
+    db_session = arao_secret.db.create_session(uri=db_uri)
+    arao_secret.db.create_tables(db_session)
+    yield db_session
+    db_session.remove()
+
+
+@pytest.fixture
+def manager(db_session):
+    '''
+    Logged manager of a new user.
+    '''
+    manager = arao_secret.manager.create_user(db_session, 'alias_' + text(8), 'test@example.com',
+                                              text(16))
+    yield manager
+    manager.logout()
+
+
+@pytest.fixture
+def group(db_session, manager):
+    '''
+    New group of manager user, with some secrets.
+    '''
+    group, user_group_key = manager.create_group(db_session, 'group_' + text(8))
+    for index in range(5):
+        manager.create_secret(db_session, user_group_key, 'name_{}_{}'.format(index, text(8)),
+                              'https://example.com/' + text(8), text(8), text(16), text(32))
+    return group
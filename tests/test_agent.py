@@ -0,0 +1,30 @@
+'''
+Key agent server and client over a Unix socket, see arao_secret.agent.
+'''
+
+import os
+
+import pytest
+
+import arao_secret
+
+
+def test_put_get_delete(agent_client):
+    credentials = os.urandom(48)
+    handle = agent_client.put(bytes(bytearray(credentials)))
+    assert len(handle) == arao_secret.agent.HANDLE_SIZE
+    # Credentials are padded to AES block size
+    assert agent_client.get(handle)[:len(credentials)] == credentials
+    assert agent_client.get(handle)[:len(credentials)] == credentials
+    assert agent_client.has(handle)
+    agent_client.delete(handle)
+    assert not agent_client.has(handle)
+    with pytest.raises(KeyError):
+        agent_client.get(handle)
+
+
+def test_encrypt_decrypt(agent_client):
+    data = os.urandom(32)
+    data_enc = agent_client.encrypt(bytes(bytearray(data)))
+    assert data_enc != data
+    assert agent_client.decrypt(data_enc) == data
@@ -0,0 +1,131 @@
+'''
+Asyncio user manager on aiosqlite, see arao_secret.aio.
+'''
+
+import asyncio
+
+import pytest
+
+import arao_secret
+from conftest import text
+
+
+@pytest.fixture
+def aio_uri(db_uri):
+    '''
+    Async URI of test DataBase, its process async engine is disposed after the test.
+    '''
+    uri = db_uri.replace('sqlite://', 'sqlite+aiosqlite://', 1)
+    yield uri
+    asyncio.run(arao_secret.aio.dispose_engine(uri))
+
+
+def run(aio_uri, test):
+    '''
+    Run test coroutine function with a new async session, closed even on failures, as
+    aiosqlite connection threads would block interpreter exit.
+    '''
+    async def main():
+        db_session = arao_secret.aio.create_session(uri=aio_uri)
+        try:
+            await test(db_session)
+        finally:
+            await db_session.close()
+
+    asyncio.run(main())
+
+
+async def create_manager(db_session):
+    '''
+    Create tables and a logged manager of a new user.
+    '''
+    await arao_secret.aio.create_tables(db_session)
+    return await arao_secret.aio.create_user(db_session, 'alias_' + text(8),
+                                             'test@example.com', text(16))
+
+
+def test_engine_by_process(aio_uri):
+    engine = arao_secret.aio.get_engine(aio_uri)
+    assert arao_secret.aio.get_engine(aio_uri) is engine
+    assert arao_secret.aio.create_session(uri=aio_uri).bind is engine
+
+
+def test_secrets(aio_uri):
+    async def test(db_session):
+        manager = await create_manager(db_session)
+        group, _ = await manager.create_group(db_session, 'group_' + text(8))
+        suffix = text(8)
+        # Created secret texts are cleaned from memory, so names are formatted again
+        names = ['common name_{}_{}'.format(index, suffix) for index in range(3)]
+        for index in range(3):
+            await manager.create_secret(db_session, group.id,
+                                        'common name_{}_{}'.format(index, suffix),
+                                        'https://example.com/' + suffix, text(8), text(16),
+                                        text(32))
+        assert [group_id for group_id, _ in await manager.list_groups(db_session)] == [group.id]
+        records, cursor = await manager.list_secrets_page(db_session, group.id, limit=2)
+        assert [record.name for record in records] == names[:2] and cursor
+        records, cursor = await manager.list_secrets_page(db_session, group.id, cursor=cursor)
+        assert [record.name for record in records] == names[2:] and cursor is None
+        record = await manager.get_secret(db_session, records[0].id)
+        assert record.url == 'https://example.com/' + suffix
+        record.clear()
+        found = await manager.search_secrets(db_session, 'Common EXAMPLE', fields=('id', ))
+        assert len(found) == 3
+        await manager.logout()
+
+    run(aio_uri, test)
+
+
+def test_index_group(aio_uri):
+    async def test(db_session):
+        manager = await create_manager(db_session)
+        group, _ = await manager.create_group(db_session, 'group_' + text(8))
+        for _ in range(3):
+            await manager.create_secret(db_session, group.id, 'indexed ' + text(8), text(8),
+                                        text(8), text(16), text(32))
+        # Secrets saved before the index existed
+        await db_session.execute(arao_secret.db.model.SecretToken.__table__.delete())
+        await db_session.commit()
+        assert await manager.search_secrets(db_session, 'indexed') == []
+        await manager.index_group(db_session, group.id)
+        found = await manager.search_secrets(db_session, 'indexed', fields=('id', ))
+        assert len(found) == 3
+        await manager.logout()
+
+    run(aio_uri, test)
+
+
+def test_concurrent_reads(aio_uri):
+    async def test(db_session):
+        manager = await create_manager(db_session)
+        group, _ = await manager.create_group(db_session, 'group_' + text(8))
+        await manager.create_secret(db_session, group.id, text(8), text(8), text(8), text(16),
+                                    text(32))
+        manager.manager.keyring.group_keys.clear()
+        sessions = [arao_secret.aio.create_session(uri=aio_uri) for _ in range(8)]
+        try:
+            await read_concurrently(manager, sessions, group.id)
+        finally:
+            for session in sessions:
+                await session.close()
+
+    run(aio_uri, test)
+
+
+async def read_concurrently(manager, sessions, group_id):
+    '''
+    Read group secrets from every session at the same time, then logout.
+    '''
+    # Group key is unwrapped by executor threads at the same time
+    results = await asyncio.gather(*[manager.get_clear_many(session, group_id)
+                                     for session in sessions])
+    assert len({records[0].name for records in results}) == 1
+    for records in results:
+        records[0].clear()
+    assert list(manager.manager.keyring.group_keys.items()) != []
+    # Keys are not cached again once locked
+    await manager.logout()
+    assert list(manager.manager.keyring.group_keys.items()) == []
+    with pytest.raises(arao_secret.keyring.KeyringLocked):
+        await manager.get_clear_many(sessions[0], group_id)
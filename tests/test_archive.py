@@ -0,0 +1,108 @@
+'''
+Encrypted group exports, see arao_secret.archive.
+'''
+
+import io
+
+import pytest
+
+import arao_secret
+from conftest import get_names
+from conftest import text
+
+
+PASSPHRASE = 'passphrase_test'
+
+
+@pytest.fixture(autouse=True)
+def scrypt_cost(monkeypatch):
+    '''
+    Cheap archive keys, configured cost takes a while.
+    '''
+    get = arao_secret.conf.get
+    cost = {'scrypt_log2_n': 10, 'scrypt_r': 8, 'scrypt_p': 1}
+
+    def get_conf(section, key, *args, **kwargs):
+        if section == 'Archive' and key in cost:
+            return cost[key]
+        return get(section, key, *args, **kwargs)
+
+    monkeypatch.setattr(arao_secret.conf, 'get', get_conf)
+
+
+def export(db_session, manager, group, chunk_size=2):
+    return b''.join(manager.export_group(db_session, group.id, PASSPHRASE,
+                                         chunk_size=chunk_size))
+
+
+def restore(db_session, manager, archive, passphrase=PASSPHRASE):
+    '''
+    Restore archive into a new group, get its ID.
+    '''
+    group, _ = manager.create_group(db_session, 'restored_' + text(8))
+    manager.restore_group(db_session, group.id, io.BytesIO(archive), passphrase, workers=1)
+    return group.id
+
+
+def test_export_restore(db_session, manager, group):
+    group_id = restore(db_session, manager, export(db_session, manager, group))
+    assert get_names(db_session, manager, group_id) == get_names(db_session, manager, group.id)
+
+
+def chunks(archive):
+    '''
+    Split archive in header and chunks, with their lengths.
+    '''
+    offset = arao_secret.archive.HEADER.size
+    pieces = [archive[:offset]]
+    while offset < len(archive):
+        length = arao_secret.archive.CHUNK_LENGTH.unpack_from(archive, offset)[0]
+        end = offset + arao_secret.archive.CHUNK_LENGTH.size + length
+        pieces.append(archive[offset:end])
+        offset = end
+    return pieces
+
+
+def tampered(archive):
+    '''
+    Get modified versions of archive: a flipped bit, swapped, truncated and extra chunks.
+    '''
+    pieces = chunks(archive)
+    flipped = bytearray(archive)
+    flipped[-1] ^= 1
+    yield bytes(flipped)
+    yield b''.join([pieces[0], pieces[2], pieces[1]] + pieces[3:])
+    yield b''.join(pieces[:-1])
+    yield archive + pieces[1]
+    yield archive[:-1]
+
+
+def test_tampered_archives_rejected(db_session, manager, group):
+    archive = export(db_session, manager, group)
+    assert len(chunks(archive)) == 4
+    for archive_tampered in tampered(archive):
+        with pytest.raises(ValueError):
+            restore(db_session, manager, archive_tampered)
+        db_session.rollback()
+    with pytest.raises(ValueError):
+        restore(db_session, manager, archive, 'wrong_' + PASSPHRASE)
+
+
+@pytest.mark.parametrize('log2_n, r, p', [(40, 8, 1), (10, 255, 1), (10, 8, 255), (0, 8, 1)])
+def test_header_cost_bounded(log2_n, r, p):
+    header = arao_secret.archive.HEADER.pack(arao_secret.archive.MAGIC,
+                                             arao_secret.archive.VERSION, log2_n, r, p,
+                                             bytes(16))
+    with pytest.raises(ValueError):
+        next(arao_secret.archive.read_archive(io.BytesIO(header), PASSPHRASE))
+
+
+def test_chunk_length_bounded(db_session, manager, group):
+    archive = export(db_session, manager, group)
+    header = archive[:arao_secret.archive.HEADER.size]
+    length = arao_secret.archive.get_max_chunk_length() + 1
+    stream = io.BytesIO(header + arao_secret.archive.CHUNK_LENGTH.pack(length))
+    with pytest.raises(ValueError, match='exceeds'):
+        next(arao_secret.archive.read_archive(stream, PASSPHRASE))
+    with pytest.raises(ValueError):
+        export(db_session, manager, group, chunk_size=10 ** 6)
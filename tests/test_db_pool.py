@@ -0,0 +1,130 @@
+'''
+Process engine and connection pool reuse, see arao_secret.db.get_engine().
+'''
+
+import time
+
+import pytest
+import sqlalchemy
+
+import arao_secret
+
+
+def checkouts(db_uri):
+    '''
+    Get connection checkouts of process engine.
+    '''
+    return arao_secret.db.pool_stats(db_uri)['checkouts']
+
+
+def test_engine_by_process(db_uri):
+    first = arao_secret.db.create_session(uri=db_uri)
+    second = arao_secret.db.create_session(uri=db_uri)
+    assert first.get_bind() is second.get_bind() is arao_secret.db.get_engine(db_uri)
+    first.remove()
+    second.remove()
+
+
+def test_engine_inherited_by_fork(db_uri, monkeypatch):
+    engine = arao_secret.db.get_engine(db_uri)
+    disposed = list()
+    monkeypatch.setattr(engine, 'pid', -1)
+    monkeypatch.setattr(engine, 'dispose', lambda close=True: disposed.append(close))
+    # Parent process connections are dropped, not closed
+    assert arao_secret.db.get_engine(db_uri) is not engine
+    assert disposed == [False]
+
+
+def test_single_checkout_by_transaction(db_session, db_uri):
+    start = checkouts(db_uri)
+    for _ in range(10):
+        db_session.query(arao_secret.db.model.User).count()
+    assert checkouts(db_uri) - start == 1
+    db_session.commit()
+    stats = arao_secret.db.pool_stats(db_uri)
+    assert stats['checked_out'] == 0
+
+
+def test_single_checkout_by_request(db_session, db_uri, manager, group):
+    db_session.commit()
+    start = checkouts(db_uri)
+    # Reads of a request share its transaction connection
+    records, _ = manager.list_secrets_page(db_session, group.id)
+    for record in records:
+        manager.get_secret(db_session, record.id).clear()
+        record.clear()
+    manager.get_group_names(db_session)
+    assert checkouts(db_uri) - start == 1
+
+
+@pytest.fixture
+def replicas(monkeypatch, tmp_path):
+    '''
+    Read replica without tables, so reads sent to it fail, and writes cache.
+    '''
+    uri = 'sqlite:///{}'.format(tmp_path / 'replica.sqlite')
+    replica_set = arao_secret.db.ReplicaSet([uri], check_interval=3600)
+    monkeypatch.setattr(arao_secret.db, '_REPLICAS', replica_set)
+    monkeypatch.setattr(arao_secret.db, '_WRITES', arao_secret.cache.LRUCache(10, ttl=5))
+    yield replica_set
+    arao_secret.db.dispose_engine(uri)
+
+
+def routing_session(db_uri, sticky_key=None):
+    '''
+    Session reading from replicas.
+    '''
+    return sqlalchemy.orm.sessionmaker(class_=arao_secret.db.RoutingSession,
+                                       bind=arao_secret.db.get_engine(db_uri),
+                                       info={'sticky_key': sticky_key})()
+
+
+def test_replica_checks_off_request_path(tmp_path):
+    uri = 'sqlite:///{}'.format(tmp_path / 'missing' / 'replica.sqlite')
+    replica_set = arao_secret.db.ReplicaSet([uri], check_interval=3600)
+    # Replica is not checked by requests
+    assert replica_set.get() is arao_secret.db.get_engine(uri)
+    assert arao_secret.db.pool_stats(uri)['checkouts'] == 0
+    assert not replica_set._check(uri)  # pylint: disable=W0212
+    assert replica_set.get() is None
+    arao_secret.db.dispose_engine(uri)
+
+
+def test_read_own_writes_from_primary(db_session, db_uri, replicas):
+    session = routing_session(db_uri)
+    group = arao_secret.db.model.Group(arao_secret.db.model.Group.CIPHER_CBC)
+    session.add(group)
+    session.commit()
+    # Expired by commit, reloaded from primary
+    assert group.id
+    session.close()
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        routing_session(db_uri).query(arao_secret.db.model.Group).all()
+
+
+def test_sticky_writes_expire(db_session, db_uri, replicas, monkeypatch):
+    session = routing_session(db_uri, sticky_key=7)
+    session.add(arao_secret.db.model.Group(arao_secret.db.model.Group.CIPHER_CBC))
+    session.commit()
+    session.close()
+    assert routing_session(db_uri, sticky_key=7).query(arao_secret.db.model.Group).count() == 1
+    # Once expired, reads go to replicas
+    monkeypatch.setattr(arao_secret.db._WRITES, 'ttl', 0.001)  # pylint: disable=W0212
+    arao_secret.db._WRITES.set(7, 0)  # pylint: disable=W0212
+    time.sleep(0.01)
+    session = routing_session(db_uri, sticky_key=7)
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        session.query(arao_secret.db.model.Group).count()
+
+
+def test_locking_reads_from_primary(db_session, db_uri, replicas):
+    db_session.add(arao_secret.db.model.Group(arao_secret.db.model.Group.CIPHER_CBC))
+    db_session.commit()
+    session = routing_session(db_uri)
+    group = (session.query(arao_secret.db.model.Group)
+             .with_for_update(read=True)
+             .one())
+    session.refresh(group, with_for_update=True)
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        session.refresh(group)
+    session.close()
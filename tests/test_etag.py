@@ -0,0 +1,45 @@
+'''
+Entity tags of API responses, see arao_secret.manager.get_etag().
+'''
+
+import werkzeug.http
+
+import arao_secret
+from conftest import text
+
+
+def get_etags(db_session, user_id, group_id, secret_id):
+    return (arao_secret.manager.get_groups_etag(db_session, user_id),
+            arao_secret.manager.get_secrets_page_etag(db_session, user_id, group_id),
+            arao_secret.manager.get_secret_etag(db_session, user_id, secret_id))
+
+
+def test_etags_need_no_credentials(db_session, manager, group):
+    secret_id = group.secrets[0].id
+    etags = get_etags(db_session, manager.user.id, group.id, secret_id)
+    assert etags == (manager.get_groups_etag(db_session),
+                     manager.get_secrets_page_etag(db_session, group.id),
+                     manager.get_secret_etag(db_session, secret_id))
+    manager.logout()
+    assert get_etags(db_session, manager.user.id, group.id, secret_id) == etags
+
+
+def test_etags_change_with_data(db_session, manager, group):
+    secret = group.secrets[0]
+    etags = get_etags(db_session, manager.user.id, group.id, secret.id)
+    user_group_key = manager._get_group_key(db_session, group.id)  # pylint: disable=W0212
+    secret.update(manager._get_keyring(), user_group_key,  # pylint: disable=W0212
+                  text(8), text(8), text(8), text(8), text(8))
+    db_session.commit()
+    changed = get_etags(db_session, manager.user.id, group.id, secret.id)
+    assert [old != new for old, new in zip(etags, changed)] == [False, True, True]
+    manager.create_group(db_session, 'group_' + text(8))
+    assert arao_secret.manager.get_groups_etag(db_session, manager.user.id) != etags[0]
+
+
+def test_weak_etags_match():
+    # Proxies compressing responses turn entity tags into weak ones
+    etag = 'a' * 32
+    assert werkzeug.http.parse_etags('W/"{}"'.format(etag)).contains_weak(etag)
+    assert werkzeug.http.parse_etags('"{}"'.format(etag)).contains_weak(etag)
+    assert not werkzeug.http.parse_etags('W/"{}"'.format(etag)).contains(etag)
@@ -0,0 +1,43 @@
+'''
+Crypto process pool, see arao_secret.executor.
+'''
+
+import pytest
+
+from Crypto.PublicKey import RSA
+
+import arao_secret
+from conftest import text
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    '''
+    Crypto executor with a single worker process.
+    '''
+    executor = arao_secret.executor.CryptoExecutor(1)
+    monkeypatch.setattr(arao_secret.executor, 'get_executor', lambda: executor)
+    yield executor
+    executor.shutdown()
+
+
+def test_generated_key_leaves_worker_protected(executor):
+    key_enc, key_pub = executor.run(arao_secret.executor.rsa_generate, 1024, b'pass_test')
+    with pytest.raises(ValueError):
+        RSA.importKey(key_enc)
+    rsa_key = RSA.importKey(key_enc, passphrase=b'pass_test')
+    assert rsa_key.publickey().exportKey() == key_pub
+
+
+def test_create_user_with_executor(db_session, executor):
+    alias = 'alias_' + text(8)
+    password = text(16)
+    # Given password is cleaned from memory, so a copy is given
+    manager = arao_secret.manager.create_user(db_session, alias, 'test@example.com',
+                                              ''.join(list(password)))
+    assert executor.stats()['completed'] == 1
+    group, _ = manager.create_group(db_session, 'group_' + text(8))
+    manager.logout()
+    manager = arao_secret.manager.get_user(db_session, alias, password)
+    assert [group_id for group_id, _ in manager.get_group_names(db_session)] == [group.id]
+    manager.logout()
@@ -0,0 +1,58 @@
+'''
+Bulk import of secrets, see arao_secret.importer.
+'''
+
+import io
+
+import pytest
+
+import arao_secret
+from conftest import get_names
+from conftest import text
+
+
+CSV = '''Title,Username,Password,Web Site,Notes,Unknown
+{}
+'''
+
+
+def test_import_csv(db_session, manager, group):
+    names = ['imported_{}_{}'.format(index, text(8)) for index in range(7)]
+    rows = '\n'.join('{},login_{},{},https://site{}.example.org,,x'.format(name, index, text(8),
+                                                                          index)
+                     for index, name in enumerate(names))
+    records = arao_secret.importer.read_csv(io.StringIO(CSV.format(rows)))
+    progress = list()
+    imported = manager.import_secrets(db_session, group.id, records, chunk_size=3, workers=1,
+                                      progress=progress.append)
+    assert imported == 7
+    assert progress == [3, 6, 7]
+    # After secrets of group fixture, in file order
+    assert get_names(db_session, manager, group.id)[5:] == [name.encode() for name in names]
+    records = manager.search_secrets(db_session, 'site3 example')
+    assert [record.name for record in records] == [names[3]]
+    for record in records:
+        record.clear()
+
+
+def test_import_missing_values(db_session, manager, group):
+    name = 'imported_' + text(8)
+    records = [{'name': ''.join(name), 'url': None, 'login': 'x', 'comment': None}]
+    assert manager.import_secrets(db_session, group.id, records, workers=1) == 1
+    assert get_names(db_session, manager, group.id)[-1] == name.encode()
+
+
+def test_import_failure_saves_nothing(db_session, manager, group):
+    def records():
+        yield {'name': 'imported_' + text(8)}
+        raise ValueError('Broken file')
+
+    with pytest.raises(ValueError):
+        manager.import_secrets(db_session, group.id, records(), chunk_size=1, workers=1)
+    db_session.commit()
+    assert len(get_names(db_session, manager, group.id)) == 5
+
+
+def test_csv_needs_name_column():
+    with pytest.raises(ValueError):
+        list(arao_secret.importer.read_csv(io.StringIO('url,password\nx,y\n')))
@@ -0,0 +1,30 @@
+'''
+Blind index of secrets saved before it existed, see arao_secret.indexer.
+'''
+
+import arao_secret
+
+
+def search(db_session, manager, text):
+    '''
+    Get IDs of secrets found by text.
+    '''
+    records = manager.search_secrets(db_session, text, fields=('id', ))
+    return sorted(record.id for record in records)
+
+
+def test_index_groups(db_session, manager, group):
+    found = search(db_session, manager, 'example')
+    assert len(found) == 5
+    # Secrets saved before the index existed
+    db_session.query(arao_secret.db.model.SecretToken).delete()
+    db_session.commit()
+    assert search(db_session, manager, 'example') == []
+    arao_secret.indexer.index_groups(db_session, manager)
+    assert search(db_session, manager, 'example') == found
+    # Already indexed secrets are skipped
+    tokens = db_session.query(arao_secret.db.model.SecretToken).count()
+    arao_secret.indexer.index_groups(db_session, manager, [group.id])
+    assert db_session.query(arao_secret.db.model.SecretToken).count() == tokens
+    # Only whole words match
+    assert search(db_session, manager, 'exampl') == []
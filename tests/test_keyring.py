@@ -0,0 +1,73 @@
+'''
+User session keyrings, see arao_secret.keyring.
+'''
+
+import threading
+import types
+
+import arao_secret
+
+
+def test_reaper_while_keyrings_change():
+    keyrings = [arao_secret.keyring.Keyring(types.SimpleNamespace(id=user_id), idle_timeout=3600)
+                for user_id in range(4)]
+    done = threading.Event()
+
+    def login_logout(keyring):
+        while not done.is_set():
+            keyring.unlock(None, rsa_key=object())
+            keyring.lock()
+
+    threads = [threading.Thread(target=login_logout, args=(keyring, )) for keyring in keyrings]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in range(2000):
+            arao_secret.keyring._reap_once()  # pylint: disable=W0212
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+    assert all(keyring.is_locked() for keyring in keyrings)
+
+
+def test_reaper_locks_idle_keyrings():
+    def on_lock():
+        raise RuntimeError('Lock callback failed !')
+
+    failing = arao_secret.keyring.Keyring(types.SimpleNamespace(id=1), idle_timeout=0,
+                                          on_lock=on_lock)
+    keyring = arao_secret.keyring.Keyring(types.SimpleNamespace(id=2), idle_timeout=0)
+    for item in (failing, keyring):
+        item.unlock(None, rsa_key=object())
+    # Errors of a keyring don't stop the reaper
+    arao_secret.keyring._reap_once()  # pylint: disable=W0212
+    assert failing._rsa_key is None and keyring._rsa_key is None  # pylint: disable=W0212
+
+
+def test_group_keys_read_while_evicted(db_session, manager, group):
+    user_group_key = manager._get_group_key(db_session, group.id)  # pylint: disable=W0212
+    keyring = manager._get_keyring()  # pylint: disable=W0212
+    expected = keyring.get_group_key(user_group_key)
+    done = threading.Event()
+    wrong = list()
+
+    def read():
+        for _ in range(300):
+            group_key = keyring.get_group_key(user_group_key)
+            if group_key != expected:
+                wrong.append(group_key)
+
+    def clear():
+        while not done.is_set():
+            keyring.group_keys.clear()
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    cleaner = threading.Thread(target=clear)
+    for thread in readers + [cleaner]:
+        thread.start()
+    for thread in readers:
+        thread.join()
+    done.set()
+    cleaner.join()
+    assert wrong == []
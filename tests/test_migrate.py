@@ -0,0 +1,51 @@
+'''
+Schema upgrade of DataBases created by first versions, see arao_secret.db.migrate.
+'''
+
+import sqlalchemy
+
+import arao_secret
+
+
+# Tables of first version
+SCHEMA_0 = (
+    'CREATE TABLE user (id INTEGER PRIMARY KEY, alias VARCHAR(32) NOT NULL UNIQUE,'
+    ' email VARCHAR(128) NOT NULL, email_validated BOOLEAN, pass_hash BLOB NOT NULL,'
+    ' rsa_key BLOB NOT NULL, rsa_key_pub BLOB NOT NULL)',
+    'CREATE TABLE "group" (id INTEGER PRIMARY KEY, aes_iv BLOB NOT NULL)',
+    'CREATE TABLE user_group_key (id INTEGER PRIMARY KEY,'
+    ' user_id INTEGER NOT NULL REFERENCES user (id),'
+    ' group_id INTEGER NOT NULL REFERENCES "group" (id),'
+    ' group_name BLOB NOT NULL, group_key BLOB NOT NULL)',
+    'CREATE TABLE secret (id INTEGER PRIMARY KEY,'
+    ' group_id INTEGER NOT NULL REFERENCES "group" (id),'
+    ' name BLOB NOT NULL, url BLOB NOT NULL, login BLOB NOT NULL, password BLOB NOT NULL,'
+    ' comment BLOB)',
+    'INSERT INTO "group" (id, aes_iv) VALUES (1, x\'00\')',
+    'INSERT INTO secret (id, group_id, name, url, login, password)'
+    ' VALUES (7, 1, x\'01\', x\'02\', x\'03\', x\'04\')',
+)
+
+
+def test_upgrade_sqlite_legacy_columns(db_uri):
+    engine = arao_secret.db.get_engine(db_uri)
+    with engine.begin() as connection:
+        for sql in SCHEMA_0:
+            connection.execute(sqlalchemy.text(sql))
+    db_session = arao_secret.db.create_session(uri=db_uri)
+    arao_secret.db.create_tables(db_session)
+    inspector = sqlalchemy.inspect(engine)
+    columns = {column['name']: column for column in inspector.get_columns('secret')}
+    for field in arao_secret.db.model.Secret.FIELDS:
+        assert columns[field]['nullable']
+    assert not columns['key_version']['nullable']
+    assert 'oaep' in {column['name'] for column in inspector.get_columns('user_group_key')}
+    indexes = {index['name'] for index in inspector.get_indexes('secret')}
+    assert 'ix_secret_group_id_id' in indexes
+    assert {key['referred_table'] for key in inspector.get_foreign_keys('secret_token')} \
+        == {'secret', 'group'}
+    row = db_session.query(arao_secret.db.model.Secret).one()
+    assert (row.id, row.name, row.record_format, row.key_version) == (7, b'\x01', 1, 1)
+    assert arao_secret.db.migrate.current_version(db_session) \
+        == len(arao_secret.db.migrate.MIGRATIONS)
+    db_session.remove()
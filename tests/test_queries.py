@@ -0,0 +1,92 @@
+'''
+Number of queries by manager operation, it must not depend on the number of secrets.
+'''
+
+import contextlib
+
+import sqlalchemy
+
+import arao_secret
+from conftest import text
+
+
+@contextlib.contextmanager
+def count_queries(db_session):
+    '''
+    Count statements executed by session engine, in a list with a single item.
+    '''
+    count = [0]
+
+    def before_cursor_execute(*_):
+        count[0] += 1
+
+    engine = db_session.get_bind()
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield count
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def expire(db_session, manager):
+    '''
+    Expire loaded objects, so lazy loads are counted too, except the logged user.
+    '''
+    db_session.expire_all()
+    assert manager.user.id
+
+
+def add_secrets(db_session, manager, group, number):
+    '''
+    Add number secrets to group.
+    '''
+    user_group_key = manager._get_group_key(db_session, group.id)  # pylint: disable=W0212
+    for _ in range(number):
+        manager.create_secret(db_session, user_group_key, 'common ' + text(8), text(8), text(8),
+                              text(16), text(16))
+
+
+def list_queries(db_session, manager, group):
+    '''
+    Get number of queries to list and decrypt all group secrets.
+    '''
+    expire(db_session, manager)
+    with count_queries(db_session) as count:
+        records = manager.get_clear_many(db_session, group.id,
+                                         fields=('id', 'name', 'url', 'password'))
+    for record in records:
+        record.clear()
+    return count[0], len(records)
+
+
+def test_list_secrets_queries(db_session, manager, group):
+    queries, listed = list_queries(db_session, manager, group)
+    assert listed == 5
+    add_secrets(db_session, manager, group, 20)
+    assert list_queries(db_session, manager, group) == (queries, 25)
+
+
+def test_search_queries(db_session, manager, group):
+    expire(db_session, manager)
+    with count_queries(db_session) as count:
+        records = manager.search_secrets(db_session, 'common', fields=('id', 'name'))
+    assert records == []
+    queries = count[0]
+    add_secrets(db_session, manager, group, 10)
+    expire(db_session, manager)
+    with count_queries(db_session) as count:
+        records = manager.search_secrets(db_session, 'common', fields=('id', 'name'))
+    assert len(records) == 10
+    assert count[0] == queries
+    for record in records:
+        record.clear()
+
+
+def test_get_secret_queries(db_session, manager, group):
+    secret_id = (db_session.query(arao_secret.db.model.Secret.id)
+                 .filter(arao_secret.db.model.Secret.group_id == group.id)
+                 .first()[0])
+    expire(db_session, manager)
+    with count_queries(db_session) as count:
+        manager.get_secret(db_session, secret_id).clear()
+    assert count[0] == 1
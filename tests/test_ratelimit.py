@@ -0,0 +1,35 @@
+'''
+Token bucket rate limiting, see arao_secret.ratelimit.
+'''
+
+import pytest
+
+import arao_secret
+
+
+def check_burst(store):
+    '''
+    Check that a burst of requests is allowed and the next one must wait.
+    '''
+    limiter = arao_secret.ratelimit.RateLimiter('login', store, 0.5, 3)
+    assert [limiter.acquire('127.0.0.1') for _ in range(3)] == [(True, 0)] * 3
+    assert limiter.acquire('127.0.0.1') == (False, 2)
+    assert limiter.acquire('127.0.0.2') == (True, 0)
+    assert limiter.rejected == 1
+
+
+def test_memory_store():
+    check_burst(arao_secret.ratelimit.MemoryStore())
+
+
+def test_file_store_creates_directory(tmp_path):
+    path = tmp_path / 'missing' / 'ratelimit'
+    check_burst(arao_secret.ratelimit.FileStore(str(path), slots=64))
+    assert path.stat().st_size == 64 * arao_secret.ratelimit.SLOT.size
+
+
+@pytest.mark.parametrize('rate, burst', [(0, 5), (-1, 5), (0.1, 0)])
+def test_invalid_limits(rate, burst):
+    with pytest.raises(ValueError):
+        arao_secret.ratelimit.RateLimiter('login', arao_secret.ratelimit.MemoryStore(), rate,
+                                          burst)
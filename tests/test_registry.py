@@ -0,0 +1,94 @@
+'''
+Session registry of logged user managers, see arao_secret.manager.SessionRegistry.
+'''
+
+import os
+import time
+import types
+
+import arao_secret
+
+
+class Manager:
+    '''
+    User manager stand-in, counting its logouts.
+    '''
+    def __init__(self, user_id):
+        self.user = types.SimpleNamespace(id=user_id)
+        self.logouts = 0
+
+    def logout(self):
+        self.logouts += 1
+
+
+def test_idle_sessions_expire_on_get():
+    registry = arao_secret.manager.SessionRegistry(10, idle_ttl=0.05)
+    managers = [Manager(user_id) for user_id in range(3)]
+    session_ids = [registry.add(manager) for manager in managers]
+    time.sleep(0.1)
+    assert registry.get('unknown') is None
+    assert registry.stats()['active'] == 0
+    assert [manager.logouts for manager in managers] == [1, 1, 1]
+    assert registry.get(session_ids[0]) is None
+
+
+def test_eviction_waits_for_release():
+    registry = arao_secret.manager.SessionRegistry(1)
+    first = Manager(1)
+    session_id = registry.add(first)
+    assert registry.get(session_id) is first
+    assert registry.get(session_id) is first
+    # Full registry evicts the session in use
+    registry.add(Manager(2))
+    assert registry.get(session_id) is None
+    assert first.logouts == 0
+    registry.release(first)
+    assert first.logouts == 0
+    registry.release(first)
+    assert first.logouts == 1
+    assert registry.stats() == {'active': 1, 'in_use': 0, 'evictions': 1, 'logouts': 0}
+
+
+def test_remove_waits_for_release():
+    registry = arao_secret.manager.SessionRegistry(10)
+    manager = Manager(1)
+    session_id = registry.add(manager)
+    assert registry.get(session_id) is manager
+    registry.remove(session_id)
+    assert manager.logouts == 0
+    registry.release(manager)
+    assert manager.logouts == 1
+    # Sessions not in use are cleaned at once
+    other = Manager(2)
+    registry.remove(registry.add(other))
+    assert other.logouts == 1
+    assert registry.stats()['logouts'] == 2
+
+
+def test_logout_by_another_process(agent_client, monkeypatch):
+    monkeypatch.setattr(arao_secret.agent, 'get_client', lambda: agent_client)
+    handle = agent_client.put(os.urandom(16))
+    # Same user session on two web workers
+    first, second = Manager(1), Manager(1)
+    registries = [arao_secret.manager.SessionRegistry(10) for _ in range(2)]
+    session_ids = [registry.add(manager, handle)
+                   for registry, manager in zip(registries, (first, second))]
+    assert registries[1].get(session_ids[1]) is second
+    registries[1].release(second)
+    registries[0].remove(session_ids[0])
+    agent_client.delete(handle)
+    assert first.logouts == 1
+    assert registries[1].get(session_ids[1]) is None
+    assert second.logouts == 1
+    assert registries[1].stats() == {'active': 0, 'in_use': 0, 'evictions': 0, 'logouts': 1}
+
+
+def test_unavailable_agent_drops_sessions(monkeypatch):
+    monkeypatch.setattr(arao_secret.agent, 'get_client', lambda: None)
+    registry = arao_secret.manager.SessionRegistry(10)
+    manager = Manager(1)
+    assert registry.get(registry.add(manager, os.urandom(16))) is None
+    assert manager.logouts == 1
+    # Sessions without credentials on agent are not checked
+    other = Manager(2)
+    assert registry.get(registry.add(other)) is other
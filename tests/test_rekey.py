@@ -0,0 +1,97 @@
+'''
+Group re-encryption, see arao_secret.rekey.
+'''
+
+import pytest
+
+import arao_secret
+from conftest import get_names
+from conftest import text
+
+
+def get_versions(db_session, group_id):
+    '''
+    Get key versions of group secrets, sorted by ID.
+    '''
+    secret = arao_secret.db.model.Secret
+    return [version for version, in (db_session.query(secret.key_version)
+                                     .filter(secret.group_id == group_id)
+                                     .order_by(secret.id))]
+
+
+def test_rekey_resumes(db_session, manager, group, monkeypatch):
+    names = get_names(db_session, manager, group.id)
+    save_chunk = arao_secret.rekey._save_chunk  # pylint: disable=W0212
+    saved = list()
+
+    def fail_second(db_session, group_id, old_version, rows):
+        if len(saved) == 1:
+            raise RuntimeError('Interrupted')
+        saved.append([row[0] for row in rows])
+        save_chunk(db_session, group_id, old_version, rows)
+
+    monkeypatch.setattr(arao_secret.rekey, '_save_chunk', fail_second)
+    with pytest.raises(RuntimeError):
+        manager.rekey_group(db_session, group.id, chunk_size=2, workers=1)
+    db_session.rollback()
+    # Both key versions are readable while interrupted
+    assert get_versions(db_session, group.id) == [2, 2, 1, 1, 1]
+    assert get_names(db_session, manager, group.id) == names
+    monkeypatch.undo()
+    manager.rekey_group(db_session, group.id, chunk_size=2, workers=1)
+    db_session.expire_all()
+    assert get_versions(db_session, group.id) == [2] * 5
+    assert group.key_version == 2
+    assert db_session.query(arao_secret.db.model.GroupRekey).count() == 0
+    assert get_names(db_session, manager, group.id) == names
+
+
+def test_rekey_keeps_secrets_updated_meanwhile(db_session, manager, group, monkeypatch):
+    save_chunk = arao_secret.rekey._save_chunk  # pylint: disable=W0212
+    secret = (db_session.query(arao_secret.db.model.Secret)
+              .filter(arao_secret.db.model.Secret.group_id == group.id)
+              .order_by(arao_secret.db.model.Secret.id)
+              .first())
+    name = 'updated_' + text(8)
+
+    def update_first(db_session, group_id, old_version, rows):
+        if secret.key_version == old_version:
+            # Saved with next key version, after its old version was read by cursor
+            user_group_key = manager._get_group_key(db_session, group_id)  # pylint: disable=W0212
+            secret.update(manager._get_keyring(), user_group_key,  # pylint: disable=W0212
+                          ''.join(name), text(8), text(8), text(8), text(8))
+            db_session.flush()
+            assert secret.key_version == old_version + 1
+        save_chunk(db_session, group_id, old_version, rows)
+
+    monkeypatch.setattr(arao_secret.rekey, '_save_chunk', update_first)
+    manager.rekey_group(db_session, group.id, chunk_size=2, workers=1)
+    db_session.expire_all()
+    assert get_versions(db_session, group.id) == [2] * 5
+    assert get_names(db_session, manager, group.id)[0] == name.encode()
+    assert secret.version == 2
+
+
+def test_rekey_removes_members(db_session, manager, group):
+    names = get_names(db_session, manager, group.id)
+    other = arao_secret.manager.create_user(db_session, 'alias_' + text(8), 'test@example.com',
+                                            text(16))
+    try:
+        user_group_key = manager._get_group_key(db_session, group.id)  # pylint: disable=W0212
+        old_key = user_group_key.get_key(manager._get_keyring())  # pylint: disable=W0212
+        db_session.add(arao_secret.db.model.UserGroupKey(
+            other.user, group, arao_secret.helper.to_bytes('shared_' + text(8)),
+            bytes(bytearray(old_key))
+        ))
+        db_session.commit()
+        with pytest.raises(ValueError):
+            manager.rekey_group(db_session, group.id, remove=[manager.user.id], workers=1)
+        manager.rekey_group(db_session, group.id, remove=[other.user.id], workers=1)
+        db_session.expire_all()
+        members = {user_group_key.user_id for user_group_key in group.group_keys}
+        assert members == {manager.user.id}
+        new_key = user_group_key.get_key(manager._get_keyring())  # pylint: disable=W0212
+        assert new_key != old_key
+        assert get_names(db_session, manager, group.id) == names
+    finally:
+        other.logout()
@@ -0,0 +1,106 @@
+'''
+Secret records encryption, see arao_secret.db.model.Secret.
+'''
+
+import os
+
+import pytest
+from Crypto.PublicKey import RSA
+from Crypto.Util import number
+
+import arao_secret
+from conftest import get_names
+from conftest import text
+
+
+@pytest.fixture
+def gcm_group_key(db_session, manager):
+    '''
+    User group key of a new AES-GCM group.
+    '''
+    _, user_group_key = manager.create_group(db_session, 'group_' + text(8),
+                                             arao_secret.db.model.Group.CIPHER_GCM)
+    return user_group_key
+
+
+def count_secrets(db_session):
+    return db_session.query(arao_secret.db.model.Secret).count()
+
+
+def test_failed_creation_saves_nothing(db_session, manager, gcm_group_key, monkeypatch):
+    def fail(*_):
+        raise RuntimeError('Encryption failed')
+
+    monkeypatch.setattr(arao_secret.db.model.Secret, 'index_tokens', fail)
+    with pytest.raises(RuntimeError):
+        manager.create_secret(db_session, gcm_group_key, text(8), text(8), text(8), text(8),
+                              text(8))
+    monkeypatch.undo()
+    # Flushed row was rolled back, so next commit doesn't save it
+    manager.create_secret(db_session, gcm_group_key, text(8), text(8), text(8), text(8),
+                          text(8))
+    assert count_secrets(db_session) == 1
+    assert db_session.query(arao_secret.db.model.Secret).one().data
+
+
+def test_gcm_secret_needs_session(db_session, manager, gcm_group_key):
+    assert gcm_group_key.group.cipher == arao_secret.db.model.Group.CIPHER_GCM
+    db_session.expunge(gcm_group_key)
+    with pytest.raises(ValueError):
+        arao_secret.db.model.Secret(manager._get_keyring(),  # pylint: disable=W0212
+                                    gcm_group_key, text(8), text(8), text(8), text(8), text(8))
+    assert count_secrets(db_session) == 0
+
+
+def create_secrets(db_session, manager, user_group_key, number):
+    '''
+    Create number secrets, get their expected clear names.
+    '''
+    names = ['name_{}_{}'.format(index, text(8)) for index in range(number)]
+    for name in names:
+        # Given strings are cleaned
+        manager.create_secret(db_session, user_group_key, ''.join(name), text(8), text(8),
+                              text(8), text(8))
+    return names
+
+
+def test_gcm_secrets_format(db_session, manager, gcm_group_key):
+    names = create_secrets(db_session, manager, gcm_group_key, 3)
+    formats = {row.record_format for row in db_session.query(arao_secret.db.model.Secret)}
+    assert formats == {arao_secret.db.model.Secret.FORMAT_PACKED_GCM}
+    assert get_names(db_session, manager, gcm_group_key.group_id) \
+        == [name.encode() for name in names]
+
+
+def test_gcm_secrets_bound_to_id(db_session, manager, gcm_group_key):
+    create_secrets(db_session, manager, gcm_group_key, 2)
+    first, second = db_session.query(arao_secret.db.model.Secret).order_by('id')
+    # Valid record of the same group and key moved to another ID
+    second.data = first.data
+    db_session.commit()
+    with pytest.raises(ValueError):
+        get_names(db_session, manager, gcm_group_key.group_id)
+
+
+def test_tampered_oaep_key_fails(db_session, manager, gcm_group_key):
+    assert gcm_group_key.is_oaep('group_key')
+    key_enc = bytearray(gcm_group_key.group_key)
+    key_enc[-1] ^= 1
+    gcm_group_key.group_key = bytes(key_enc)
+    db_session.commit()
+    with pytest.raises(ValueError):
+        gcm_group_key.get_key(manager._get_keyring())  # pylint: disable=W0212
+
+
+def test_legacy_raw_rsa_key(db_session, manager, gcm_group_key):
+    '''
+    Raw RSA group keys of previous versions, starting with zeros too.
+    '''
+    rsa_key = RSA.importKey(manager.user.rsa_key_pub)
+    group_key = b'\x00\x00' + os.urandom(arao_secret.helper.AES_KEY_SIZE - 2)
+    gcm_group_key.group_key = number.long_to_bytes(pow(number.bytes_to_long(group_key),
+                                                       rsa_key.e, rsa_key.n))
+    gcm_group_key.oaep = 0
+    db_session.commit()
+    assert not gcm_group_key.is_oaep('group_key')
+    assert gcm_group_key.get_key(manager._get_keyring()) == group_key  # pylint: disable=W0212
@@ -25,7 +25,52 @@ import controllers.index
 LOGGER = arao_secret.conf.get_logger('AraoSecretWeb', None)
 
 APP = flask.Flask(__name__)
-APP.secret_key = os.urandom(24)
+# Shared by workers, so sessions are valid on all of them
+APP.secret_key = arao_secret.conf.get('Web', 'secret_key', fallback='') or os.urandom(24)
+
+# Seconds to suggest to rejected logins
+LOGIN_RETRY_AFTER = '5'
+
+# RSA key pool processes, if enabled, forked before any request thread exists
+arao_secret.keypool.get_pool()
+
+
+def start_crypto_executor():
+    '''
+    Start crypto process pool of this worker, if enabled, before serving users.
+    '''
+    executor = arao_secret.executor.get_executor()
+    if executor:
+        LOGGER.info('Crypto executor stats: %s', executor.stats())
+
+
+start_crypto_executor()
+
+
+@APP.before_request
+def start_sql_profile():
+    '''
+    Profile request queries, if enabled, see arao_secret.db.profiler.
+    '''
+    if arao_secret.db.profiler.is_enabled():
+        arao_secret.db.profiler.start()
+
+
+@APP.after_request
+def stop_sql_profile(response):
+    '''
+    Show request queries stats as headers in debug mode.
+    '''
+    profile = arao_secret.db.profiler.stop()
+    if profile is not None and APP.debug:
+        response.headers['X-SQL-Queries'] = str(profile.count)
+        response.headers['X-SQL-Time'] = '{:.1f}ms'.format(profile.total * 1000)
+        response.headers['X-SQL-Repeated'] = str(len(profile.get_repeated()))
+        for position, (seconds, statement) in enumerate(profile.get_slowest(), start=1):
+            response.headers['X-SQL-Slowest-{}'.format(position)] = '{:.1f}ms {}'.format(
+                seconds * 1000, ' '.join(statement.split())
+            )
+    return response
 
 
 @APP.before_request
@@ -42,7 +87,10 @@ def get_db():
     Opens a new database connection if there is none yet for the current application context.
     '''
     if not hasattr(flask.g, 'db_session'):
-        flask.g.db_session = arao_secret.db.create_session()
+        # Logged users read their own writes, see arao_secret.db.RoutingSession
+        flask.g.db_session = arao_secret.db.create_session(
+            sticky_key=flask.session.get('_user_id')
+        )
     return flask.g.db_session
 
 
@@ -55,6 +103,15 @@ def close_db(error):
         flask.g.db_session.close()
 
 
+@APP.teardown_appcontext
+def release_managers(error):
+    '''
+    Release managers used by the request, see use_manager().
+    '''
+    for manager in flask.g.pop('managers', ()):
+        arao_secret.manager.get_registry().release(manager)
+
+
 @APP.errorhandler(500)
 def internal_server_error(error):
     '''
@@ -91,6 +148,20 @@ LOGIN_MANAGER = flask_login.LoginManager()
 LOGIN_MANAGER.init_app(APP)
 LOGIN_MANAGER.login_view = 'view_login'
 
+
+@LOGIN_MANAGER.unauthorized_handler
+def unauthorized():
+    '''
+    API clients get 401 with JSON error, browsers are redirected to login view.
+    '''
+    if flask.request.path.startswith('/api/'):
+        return api_login_needed()
+    if LOGIN_MANAGER.login_message:
+        flask.flash(LOGIN_MANAGER.login_message, category=LOGIN_MANAGER.login_message_category)
+    return flask.redirect(flask_login.login_url(LOGIN_MANAGER.login_view,
+                                                next_url=flask.request.url))
+
+
 class AnonymousUserMixin(flask_login.AnonymousUserMixin):
     def has_role(self, _):
         return False
@@ -108,14 +179,122 @@ class User(flask_login.UserMixin):
     @classmethod
     def get(cls, user_id):
         '''
-        Get User from alias.
+        Get User from ID, cached, see USERS.
         '''
+        user_id = int(user_id)
+        user = USERS.get(user_id)
+        if user is not None:
+            return user
         try:
-            return User(get_db().query(arao_secret.db.model.User)
+            user = User(get_db().query(arao_secret.db.model.User)
                         .filter(arao_secret.db.model.User.id == user_id)
                         .one())
         except sqlalchemy.orm.exc.NoResultFound:
             return None
+        USERS.set(user_id, user)
+        return user
+
+
+# Users proxies by ID, so authenticated requests don't query user table
+# Changes on this process remove them at once, changes on other ones after TTL
+USERS = arao_secret.cache.LRUCache(arao_secret.conf.get('Web', 'user_cache_size', int,
+                                                        fallback=10000),
+                                   ttl=arao_secret.conf.get('Web', 'user_cache_ttl', int,
+                                                            fallback=60))
+
+
+@sqlalchemy.event.listens_for(arao_secret.db.model.User.alias, 'set')
+@sqlalchemy.event.listens_for(arao_secret.db.model.User.email, 'set')
+def invalidate_user(target, value, old_value, _):
+    '''
+    Remove proxy of changed user from cache.
+    '''
+    if target.id is not None and value != old_value:
+        USERS.pop(target.id)
+
+
+@sqlalchemy.event.listens_for(arao_secret.db.model.User, 'after_delete')
+def invalidate_deleted_user(_, __, target):
+    '''
+    Remove proxy of deleted user from cache.
+    '''
+    USERS.pop(target.id)
+
+
+def use_manager(manager):
+    '''
+    Keep manager got from session registry in use until the end of the request.
+    '''
+    if manager is not None:
+        flask.g.setdefault('managers', []).append(manager)
+    return manager
+
+
+def get_manager():
+    '''
+    Get manager of current user, None if his credentials are not in this process
+    nor in key agent.
+    '''
+    registry = arao_secret.manager.get_registry()
+    manager = use_manager(registry.get(flask.session.get('manager_id')))
+    if manager is not None and manager.user.id == flask_login.current_user.id:
+        if manager.keyring.is_locked():
+            # Idle timeout, credentials on key agent must not revive the session
+            forget_manager()
+            return None
+        return manager
+    if 'credentials' not in flask.session:
+        return None
+    # Logged on another worker, or evicted from this one
+    try:
+        handle = bytes.fromhex(flask.session['credentials'])
+        manager = arao_secret.manager.restore_user(get_db(), flask_login.current_user.id,
+                                                   handle)
+    except (KeyError, ValueError, arao_secret.agent.AgentError,
+            sqlalchemy.orm.exc.NoResultFound):
+        LOGGER.warning('Credentials of user %s not found on key agent',
+                       flask_login.current_user.id)
+        return None
+    flask.session['manager_id'] = registry.add(manager, handle)
+    return use_manager(registry.get(flask.session['manager_id']))
+
+
+def save_manager(manager):
+    '''
+    Keep manager of logged user, and its credentials on key agent if configured.
+    '''
+    handle = None
+    if arao_secret.agent.get_client() is not None:
+        handle = manager.put_credentials()
+        flask.session['credentials'] = handle.hex()
+    # Sessions of other workers are removed by logout, see SessionRegistry
+    flask.session['manager_id'] = arao_secret.manager.get_registry().add(manager, handle)
+
+
+def forget_manager():
+    '''
+    Remove manager of current user from this process and its credentials from key agent.
+    '''
+    manager_id = flask.session.pop('manager_id', None)
+    if manager_id:
+        arao_secret.manager.get_registry().remove(manager_id)
+    handle = flask.session.pop('credentials', None)
+    try:
+        if handle:
+            arao_secret.agent.get_client().delete(bytes.fromhex(handle))
+    except arao_secret.agent.AgentError:
+        LOGGER.exception('Credentials of user %s not removed from key agent',
+                         flask_login.current_user.id)
+
+
+@APP.errorhandler(arao_secret.keyring.KeyringLocked)
+def keyring_locked(_):
+    '''
+    Keyring locked by idle timeout while serving the request, master password is needed again.
+    '''
+    forget_manager()
+    flask_login.logout_user()
+    return flask.redirect(flask.url_for('view_login', next=flask.request.path))
 
 
 @LOGIN_MANAGER.user_loader
@@ -127,6 +306,19 @@ def load_user(user_id):
     return User.get(user_id)
 
 
+def check_rate(name, key):
+    '''
+    Take a token of rate limiter for key, get 429 response if exceeded, None if allowed.
+    '''
+    limiter = arao_secret.ratelimit.get_limiter(name)
+    if limiter is None:
+        return None
+    allowed, retry_after = limiter.acquire(key)
+    if allowed:
+        return None
+    return flask.render_template('429.html'), 429, {'Retry-After': str(retry_after)}
+
+
 def is_safe_url(target):
     '''
     Check if URL is safe, in our domain.
@@ -146,12 +338,20 @@ def view_login():
     errors = list()
     if alias:
 
+        # By address against floods, by alias against guessing one password from many hosts
+        rejected = (check_rate('login', flask.request.remote_addr)
+                    or check_rate('login_alias', alias))
+        if rejected:
+            SecureString.clearmem(password)
+            return rejected
+
         try:
             # Login and validate the user
-            user = arao_secret.manager.get_user(get_db(), alias, password).user
+            manager = arao_secret.manager.get_user(get_db(), alias, password)
             SecureString.clearmem(password)
+            save_manager(manager)
             # user should be an instance of your `User` class
-            flask_login.login_user(User(user))
+            flask_login.login_user(User(manager.user))
 
             return flask.redirect(flask.request.args.get('next') or flask.url_for('view_index'))
 
@@ -159,6 +359,13 @@ def view_login():
 
             errors.append('Sorry, wrong user or password !')
 
+        except arao_secret.auth.LoginOverloaded:
+
+            LOGGER.warning('Login rejected, verification pool is full')
+            errors.append('Sorry, too many logins right now, please, try again in a moment.')
+            return (flask.render_template('login.html', errors=errors), 503,
+                    {'Retry-After': LOGIN_RETRY_AFTER})
+
     return flask.render_template('login.html', errors=errors)
 
 
@@ -169,6 +376,7 @@ def view_logout():
     Simple logout.
     '''
     # Remove the user information from the session
+    forget_manager()
     flask_login.logout_user()
     return flask.redirect(flask.url_for('view_login'))
 
@@ -182,6 +390,160 @@ def view_index():
     return flask.render_template('index.html')
 
 
+def get_page_args():
+    '''
+    Get cursor and limit of requested secrets page, abort with 400 if cursor is invalid.
+    '''
+    cursor = flask.request.args.get('cursor')
+    if cursor:
+        try:
+            arao_secret.manager.decode_cursor(cursor)
+        except ValueError:
+            flask.abort(400)
+    return cursor, flask.request.args.get('limit', type=int)
+
+
+@APP.route('/groups/<int:group_id>/secrets')
+@flask_login.login_required
+def view_secrets(group_id):
+    '''
+    Group secrets, by pages.
+    '''
+    manager = get_manager()
+    if manager is None:
+        # Master password is needed again
+        flask_login.logout_user()
+        return flask.redirect(flask.url_for('view_login', next=flask.request.path))
+    cursor, limit = get_page_args()
+    try:
+        records, next_cursor = manager.list_secrets_page(get_db(), group_id, cursor=cursor,
+                                                         limit=limit)
+    except sqlalchemy.orm.exc.NoResultFound:
+        return flask.abort(404)
+    response = flask.render_template('secrets.html', group_id=group_id, records=records,
+                                     cursor=next_cursor, limit=limit)
+    for record in records:
+        record.clear()
+    return response
+
+
+@APP.route('/groups/<int:group_id>/export', methods=('POST', ))
+@flask_login.login_required
+def view_export(group_id):
+    '''
+    Group encrypted archive, streamed while secrets are read.
+    '''
+    manager = get_manager()
+    if manager is None:
+        # Master password is needed again
+        flask_login.logout_user()
+        return flask.redirect(flask.url_for('view_login'))
+    passphrase = flask.request.form.get('passphrase', '')
+    if not passphrase:
+        return flask.abort(400)
+    try:
+        pieces = manager.export_group(get_db(), group_id, passphrase)
+    except sqlalchemy.orm.exc.NoResultFound:
+        return flask.abort(404)
+    return flask.Response(
+        flask.stream_with_context(pieces), mimetype='application/octet-stream',
+        headers={'Content-Disposition': 'attachment; filename=group_{}.arao'.format(group_id)}
+    )
+
+
+def api_response(etag, get_response):
+    '''
+    Get JSON response with entity tag, 304 without decrypting data if client has it.
+    Entity tag is computed from DataBase rows, so 304 doesn't restore user credentials.
+    '''
+    # Weak comparison, proxies compressing responses mark their tags as weak (RFC 7232)
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    else:
+        response = get_response()
+    response.set_etag(etag)
+    # Clients must revalidate, secrets can't be cached by proxies
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def api_login_needed():
+    '''
+    Get 401 JSON response of API.
+    '''
+    return flask.make_response(flask.jsonify(error='Login needed'), 401)
+
+
+def get_api_manager():
+    '''
+    Get manager of current user, abort with 401 if his credentials are not available.
+    '''
+    manager = get_manager()
+    if manager is None:
+        flask.abort(api_login_needed())
+    return manager
+
+
+@APP.route('/api/groups')
+@flask_login.login_required
+def api_groups():
+    '''
+    User groups.
+    '''
+    return api_response(
+        arao_secret.manager.get_groups_etag(get_db(), flask_login.current_user.id),
+        lambda: flask.jsonify(groups=[{'id': group_id, 'name': name} for group_id, name
+                                      in get_api_manager().get_group_names(get_db())])
+    )
+
+
+@APP.route('/api/groups/<int:group_id>/secrets')
+@flask_login.login_required
+def api_secrets(group_id):
+    '''
+    Group secrets, by pages.
+    '''
+    cursor, limit = get_page_args()
+
+    def get_response():
+        records, next_cursor = get_api_manager().list_secrets_page(get_db(), group_id,
+                                                                   cursor=cursor, limit=limit)
+        response = flask.jsonify(secrets=[{'id': record.id, 'name': record.name}
+                                          for record in records],
+                                 cursor=next_cursor)
+        for record in records:
+            record.clear()
+        return response
+
+    try:
+        return api_response(arao_secret.manager.get_secrets_page_etag(
+            get_db(), flask_login.current_user.id, group_id, cursor=cursor, limit=limit
+        ), get_response)
+    except sqlalchemy.orm.exc.NoResultFound:
+        return flask.abort(404)
+
+
+@APP.route('/api/secrets/<int:secret_id>')
+@flask_login.login_required
+def api_secret(secret_id):
+    '''
+    Secret with all its fields.
+    '''
+    def get_response():
+        record = get_api_manager().get_secret(get_db(), secret_id)
+        response = flask.jsonify({attribute: getattr(record, attribute)
+                                  for attribute in record.__slots__})
+        record.clear()
+        return response
+
+    try:
+        return api_response(arao_secret.manager.get_secret_etag(
+            get_db(), flask_login.current_user.id, secret_id
+        ), get_response)
+    except sqlalchemy.orm.exc.NoResultFound:
+        return flask.abort(404)
+
+
 @APP.route('/register', methods=('GET', 'POST'))
 def view_register():
     '''
@@ -191,6 +553,10 @@ def view_register():
     email = ''
     errors = list()
     if flask.request.method == 'POST':
+        # Every registration generates an RSA key
+        rejected = check_rate('register', flask.request.remote_addr)
+        if rejected:
+            return rejected
         alias = flask.request.form.get('alias')
         email = flask.request.form.get('email')
         pass_1 = flask.request.form.get('password')
@@ -198,11 +564,12 @@ def view_register():
         # TODO : Verify password strong
         if pass_1 == pass_2:
             try:
-                user = arao_secret.manager.create_user(get_db(), alias, email, pass_1).user
+                manager = arao_secret.manager.create_user(get_db(), alias, email, pass_1)
                 SecureString.clearmem(pass_1)
                 SecureString.clearmem(pass_2)
+                save_manager(manager)
                 # user should be an instance of your `User` class
-                flask_login.login_user(User(user))
+                flask_login.login_user(User(manager.user))
                 return flask.redirect(flask.request.args.get('next') or flask.url_for('view_index'))
             except sqlalchemy.exc.IntegrityError:
                 errors.append("I'm sorry, your alias is already registered, please,"